@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+
+# -----------------------
+# -------------------------------------------------
+# ------------------------------------------------------------------------------------------------
+# De profundiS : Disk-space-aware admission control
+# ------------------------------------------------------------------------------------------------
+# -------------------------------------------------
+# -----------------------
+
+
+
+# ---
+# Standard library imports
+# ---
+import os
+import uuid
+import json
+import shutil
+import getpass
+import logging
+import subprocess
+from time import time
+
+
+
+log = logging.getLogger("rich")
+EXPANSION_FACTOR = 2.0 # Extracted size / archive size, when nothing better is known
+RESERVE = 10 # GB always left free on scratch for the jobs running next to us
+QUOTA_TIMEOUT = 30
+RESERVATIONS_FILENAME = ".de-profundis-reservations.json"
+RESERVATION_TTL = 24 * 3600 # Reservations of a job that died without releasing them expire
+
+
+
+def existing_parent(
+    path,
+):
+    # statvfs needs an existing path : datasets/ may not have been built yet
+    path = os.path.abspath(path)
+    while not os.path.exists(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    return path
+
+
+
+def free_space(
+    path,
+):
+    st = os.statvfs(existing_parent(path))
+    return st.f_bavail * st.f_frsize
+
+
+
+def quota_headroom(
+    path,
+):
+    # Bytes left under the Lustre user quota of `path`, or None when there is no `lfs`
+    # tool or no quota. `lfs quota -q` prints : filesystem kbytes quota limit grace ...
+    lfs = shutil.which("lfs")
+    if lfs is None:
+        return None
+    try:
+        output = subprocess.run(
+            [lfs, "quota", "-q", "-u", getpass.getuser(), existing_parent(path)],
+            capture_output=True,
+            text=True,
+            timeout=QUOTA_TIMEOUT,
+            check=True,
+        ).stdout
+        fields = output.split()
+        used, soft, hard = (int(f.rstrip("*")) for f in fields[1:4])
+    except (OSError, subprocess.SubprocessError, ValueError) as e:
+        log.warning(f"Could not read the quota of {path} : {e}")
+        return None
+    limit = soft or hard
+    return None if limit == 0 else max(0, limit - used) * 1024
+
+
+
+def headroom(
+    path,
+    reserve=RESERVE,
+):
+    # Bytes that can still be written below `path`, keeping `reserve` GB free
+    space = free_space(path)
+    quota = quota_headroom(path)
+    if quota is not None:
+        space = min(space, quota)
+    return max(0, space - int(reserve * 1024 ** 3))
+
+
+
+def admit(
+    footprints,
+    budget,
+):
+    # First fit over the datasets in their scheduling order (largest first) : a dataset
+    # too large for what is left is held back, but smaller ones behind it may still fit.
+    # Returns the indices of the admitted datasets.
+    admitted = []
+    for i, footprint in enumerate(footprints):
+        if footprint <= budget:
+            admitted.append(i)
+            budget -= footprint
+    return admitted
+
+
+
+class Reservations:
+    # Space promised to the datasets admitted on a scratch and not extracted yet, by every
+    # job and shard writing to it : {owner: {"updated_at": ..., "datasets": {key: bytes}}}
+    # in one JSON file. Its free space only shows what was written so far, so without
+    # this, shards admitting at the same time would each hand out the same bytes.
+    # Callers hold a lock around each read-modify-write (see main.scratch_lock).
+    def __init__(
+        self,
+        path,
+        owner,
+        ttl=RESERVATION_TTL,
+    ):
+        self.path = path
+        self.owner = owner
+        self.ttl = ttl
+
+    def load(
+        self,
+    ):
+        try:
+            with open(self.path, "r") as f:
+                owners = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            log.warning(f"Could not read the reservations in {self.path}, starting over : {e}")
+            return {}
+        return {owner: entry for owner, entry in owners.items() if time() - entry["updated_at"] < self.ttl}
+
+    def total(
+        self,
+    ):
+        # Bytes reserved by every owner, this one included
+        return sum(sum(entry["datasets"].values()) for entry in self.load().values())
+
+    def reserve(
+        self,
+        sizes,
+    ):
+        # Sets the reservation of each dataset of {key: bytes} for this owner, 0 releasing it
+        owners = self.load()
+        datasets = owners.get(self.owner, {}).get("datasets", {})
+        datasets.update(sizes)
+        owners[self.owner] = {"updated_at": time(), "datasets": {key: size for key, size in datasets.items() if size > 0}}
+        self._save(owners)
+
+    def clear(
+        self,
+    ):
+        owners = self.load()
+        if owners.pop(self.owner, None) is not None:
+            self._save(owners)
+
+    def _save(
+        self,
+        owners,
+    ):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        partial = f"{self.path}.{uuid.uuid4().hex}"
+        with open(partial, "w") as f:
+            json.dump({owner: entry for owner, entry in owners.items() if entry["datasets"]}, f)
+        os.replace(partial, self.path)
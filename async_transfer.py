@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+
+# -----------------------
+# -------------------------------------------------
+# ------------------------------------------------------------------------------------------------
+# De profundiS : Asyncio download backend for datasets made of many small files
+# ------------------------------------------------------------------------------------------------
+# -------------------------------------------------
+# -----------------------
+
+
+
+# ---
+# Standard library imports
+# ---
+import os
+import asyncio
+import logging
+import collections
+import contextlib
+import urllib.parse
+import concurrent.futures
+from time import perf_counter
+
+
+
+# ---
+# Local imports
+# ---
+from http_client import normalize_url
+from http_client import is_drive_url
+from http_client import parse_confirm_page
+from http_client import confirm_params
+from http_client import PEEK_SIZE
+from http_client import backoff_delay
+from http_client import RETRIES
+from http_client import RETRY_STATUSES
+from http_client import TIMEOUT
+from transfer import TransferInterrupted
+from transfer import STOP
+from transfer import CHUNK_SIZE
+from transfer import copy_duplicates
+from integrity import StreamHasher
+from integrity import ChecksumMismatch
+
+
+
+log = logging.getLogger("rich")
+MAX_CONNECTIONS = 1024
+PER_HOST = 32
+PER_DATASET = 256
+IO_THREADS = 4
+
+
+
+class _Retryable(Exception):
+    def __init__(
+        self,
+        message,
+        retry_after=None,
+    ):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+
+def _resume_offset(
+    part_path,
+):
+    # Size of the contiguous `.part` to resume from. A `.part.json` journal means the threads
+    # backend wrote it in segments, with possible holes : it is started over.
+    journal_path = part_path + ".json"
+    if os.path.exists(journal_path):
+        for path in (part_path, journal_path):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+        return 0
+    return os.path.getsize(part_path) if os.path.exists(part_path) else 0
+
+
+
+class AsyncDownloader:
+    # Thousands of transfers on one event loop : a global, a per-host and a per-dataset
+    # semaphore bound the concurrency, and file writes go through a small thread pool
+    # so that a slow filesystem never stalls the loop.
+    def __init__(
+        self,
+        limiter,
+        max_connections=MAX_CONNECTIONS,
+        per_host=PER_HOST,
+        per_dataset=PER_DATASET,
+        io_threads=IO_THREADS,
+        retries=RETRIES,
+        on_progress=None,
+        checksums=None,
+        on_verified=None,
+        on_fetched=None,
+        controller=None,
+    ):
+        self.limiter = limiter
+        self.max_connections = max_connections
+        self.per_host = per_host
+        self.per_dataset = per_dataset
+        self.io_threads = io_threads
+        self.retries = retries
+        self.on_progress = on_progress
+        self.checksums = checksums or {}
+        self.on_verified = on_verified
+        self.on_fetched = on_fetched
+        self.controller = controller
+        self.digests = {} # {url: (algorithm, digest)} verified during this run
+
+    async def _open(
+        self,
+        session,
+        url,
+        headers=None,
+    ):
+        # aiohttp counterpart of http_client.open_url : Drive confirmation pages are resolved
+        # (the session's cookie jar keeps the `download_warning` cookie for the second request)
+        url = normalize_url(url)
+        response = await session.get(url, headers=headers)
+        if not is_drive_url(str(response.url)):
+            return response
+        token, uuid = None, None
+        for key, morsel in response.cookies.items():
+            if key.startswith("download_warning"):
+                token = morsel.value
+        peeked = "text/html" in response.headers.get("Content-Type", "")
+        if token is None and peeked:
+            token, uuid = parse_confirm_page((await response.content.read(PEEK_SIZE)).decode("utf-8", "replace"))
+        if not (token or peeked):
+            return response
+        response.release()
+        # Re-issued even without a token : the peek consumed the start of a genuine HTML file
+        return await session.get(url, headers=headers, params=confirm_params(url, None, token, uuid))
+
+    async def _fetch(
+        self,
+        session,
+        io_pool,
+        url,
+        destination,
+        timing,
+    ):
+        loop = asyncio.get_running_loop()
+        requested = perf_counter()
+        part_path = destination + ".part"
+        checksum = self.checksums.get(url)
+        await loop.run_in_executor(io_pool, lambda: os.makedirs(os.path.dirname(destination) or ".", exist_ok=True))
+        # The bytes already in `.part` (an earlier attempt, or an interrupted run) are kept
+        # and only the rest is requested
+        offset = await loop.run_in_executor(io_pool, _resume_offset, part_path)
+        async with await self._open(session, url, {"Range": f"bytes={offset}-"} if offset else None) as response:
+            digest = StreamHasher(checksum[0]) if checksum else None
+            if response.status == 416:
+                # Nothing left past the offset. A `.part` as long as the file is complete (the
+                # run stopped before its rename) : only verified and renamed below. Any other
+                # is not the file it was started from.
+                total = response.headers.get("Content-Range", "").rpartition("/")[2]
+                if not (total.isdigit() and int(total) == offset):
+                    await loop.run_in_executor(io_pool, os.remove, part_path)
+                    return await self._fetch(session, io_pool, url, destination, timing)
+                if digest is not None:
+                    await loop.run_in_executor(io_pool, digest.catch_up, part_path)
+            else:
+                await self._receive(response, io_pool, url, part_path, offset, digest, timing, requested)
+        if digest is not None and digest.hexdigest() != checksum[1]:
+            await loop.run_in_executor(io_pool, os.remove, part_path)
+            raise ChecksumMismatch(f"{url} : expected {checksum[1]}, got {digest.hexdigest()}")
+        await loop.run_in_executor(io_pool, os.replace, part_path, destination)
+        if digest is not None:
+            self.digests[url] = (checksum[0], digest.hexdigest())
+            if self.on_verified is not None:
+                self.on_verified(url, destination, checksum[0], digest.hexdigest())
+
+    async def _receive(
+        self,
+        response,
+        io_pool,
+        url,
+        part_path,
+        offset,
+        digest,
+        timing,
+        requested,
+    ):
+        # Appends the body to `.part` from `offset` on, or rewrites it when the server
+        # ignored the Range request
+        loop = asyncio.get_running_loop()
+        if response.status in RETRY_STATUSES:
+            raise _Retryable(f"HTTP {response.status}", response.headers.get("Retry-After"))
+        response.raise_for_status()
+        if offset and response.status != 206:
+            # Range ignored : the whole file comes again, the bytes counted for the
+            # previous attempts of this run are taken back (the controller keeps them :
+            # they did go through the link)
+            if self.on_progress is not None:
+                self.on_progress(-timing["bytes"])
+            timing["bytes"], offset = 0, 0
+        if digest is not None and offset:
+            await loop.run_in_executor(io_pool, digest.catch_up, part_path)
+        f = await loop.run_in_executor(io_pool, open, part_path, "ab" if offset else "wb")
+        try:
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                if STOP.is_set():
+                    raise TransferInterrupted(url)
+                timing.setdefault("ttfb", perf_counter() - requested)
+                timing["bytes"] += len(chunk)
+                wait = self.limiter.reserve(len(chunk))
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                await loop.run_in_executor(io_pool, f.write, chunk)
+                if digest is not None:
+                    digest.feed(offset, chunk)
+                offset += len(chunk)
+                if self.controller is not None:
+                    self.controller.observe(url, len(chunk))
+                if self.on_progress is not None:
+                    self.on_progress(len(chunk))
+        finally:
+            await loop.run_in_executor(io_pool, f.close)
+
+    async def _download(
+        self,
+        session,
+        io_pool,
+        semaphores,
+        url,
+        destination,
+        dataset,
+    ):
+        import aiohttp
+        if os.path.exists(destination):
+            return url, None # Already downloaded by a previous run
+        host = urllib.parse.urlparse(url).hostname
+        timing, attempt = {"bytes": 0, "seconds": 0.0}, 0
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    # The adaptive controller, when there is one, tunes the connections below --per_host
+                    slot = self.controller.async_slot(url) if self.controller is not None else contextlib.nullcontext()
+                    async with semaphores["host"][host], semaphores["dataset"][dataset], slot:
+                        started = perf_counter() # Time spent waiting for the semaphores is not transfer time
+                        try:
+                            await self._fetch(session, io_pool, url, destination, timing)
+                        finally:
+                            timing["seconds"] += perf_counter() - started
+                    return url, None
+                except (TransferInterrupted, aiohttp.ClientResponseError) as e:
+                    # Interrupted, or an HTTP error that retrying will not fix (404, 403, ...)
+                    if not isinstance(e, TransferInterrupted):
+                        log.error(f"Failed to download {url} : {e}")
+                    return url, e
+                except (aiohttp.ClientError, asyncio.TimeoutError, _Retryable) as e:
+                    if self.controller is not None:
+                        self.controller.congestion(url)
+                    if attempt == self.retries or STOP.is_set():
+                        log.error(f"Failed to download {url} : {e}")
+                        return url, e
+                    retry_after = getattr(e, "retry_after", None)
+                    await asyncio.sleep(float(retry_after) if retry_after and retry_after.isdigit() else backoff_delay(attempt))
+                except Exception as e:
+                    log.error(f"Failed to download {url} : {e}")
+                    return url, e
+        finally:
+            if self.on_fetched is not None:
+                self.on_fetched(url, timing["bytes"], timing["seconds"], timing.get("ttfb"), attempt)
+
+    async def run(
+        self,
+        jobs,
+    ):
+        import aiohttp
+        semaphores = {
+            "host": collections.defaultdict(lambda: asyncio.Semaphore(self.per_host)),
+            "dataset": collections.defaultdict(lambda: asyncio.Semaphore(self.per_dataset)),
+        }
+        connector = aiohttp.TCPConnector(limit=self.max_connections, limit_per_host=self.per_host)
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=TIMEOUT, sock_read=TIMEOUT)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.io_threads) as io_pool:
+            async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+                results = await asyncio.gather(*(
+                    self._download(session, io_pool, semaphores, url, destination, dataset)
+                    for url, destination, dataset in jobs
+                ))
+        return dict(results)
+
+
+
+def download_urls_async(
+    jobs,
+    limiter,
+    max_connections=MAX_CONNECTIONS,
+    per_host=PER_HOST,
+    per_dataset=PER_DATASET,
+    io_threads=IO_THREADS,
+    on_progress=None,
+    checksums=None,
+    on_verified=None,
+    on_fetched=None,
+    controller=None,
+):
+    # `jobs` is a list of (url, destination, dataset key) triples. Returns {url: exception
+    # or None}, like transfer.download_urls. Requires the optional `aiohttp` package.
+    # A URL listed with several destinations is fetched once, then copied to the others.
+    try:
+        import aiohttp # noqa: F401
+    except ImportError:
+        raise ImportError("The asyncio backend requires aiohttp : pip install aiohttp")
+    downloader = AsyncDownloader(
+        limiter,
+        max_connections=max_connections,
+        per_host=per_host,
+        per_dataset=per_dataset,
+        io_threads=io_threads,
+        on_progress=on_progress,
+        checksums=checksums,
+        on_verified=on_verified,
+        on_fetched=on_fetched,
+        controller=controller,
+    )
+    sources, copies, unique = {}, {}, []
+    for url, destination, dataset in jobs:
+        if url not in sources:
+            sources[url] = destination
+            unique.append((url, destination, dataset))
+        elif sources[url] != destination:
+            copies.setdefault(url, []).append(destination)
+    errors = asyncio.run(downloader.run(unique))
+    copy_duplicates(sources, copies, errors, downloader.digests, on_verified)
+    return errors
@@ -0,0 +1,396 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+
+# -----------------------
+# -------------------------------------------------
+# ------------------------------------------------------------------------------------------------
+# De profundiS : Offline benchmark suite of the download and extraction hot paths
+# ------------------------------------------------------------------------------------------------
+# -------------------------------------------------
+# -----------------------
+
+
+
+# ---
+# Standard library imports
+# ---
+import os
+import sys
+import json
+import glob
+import shutil
+import socket
+import fnmatch
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+from time import time
+from time import perf_counter
+
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+
+
+# ---
+# Local imports
+# ---
+import http_client
+from transfer import TokenBucket
+from transfer import download_urls
+from async_transfer import download_urls_async
+from concurrency import AdaptiveConcurrency
+from extract import extract_archives
+from extract import stream_extract_urls
+from server import Catalog
+from server import Shape
+from server import ShapedServer
+
+
+
+# ---
+# Default CLI parameters' values
+# ---
+RESULTS_DIR = os.path.join(ROOT_DIR, "benchmarks/results/")
+REPEAT = 3
+HUGE_SIZE = 256 # MB
+TINY_FILES = 1000
+TINY_SIZE = 4096
+ARCHIVE_FILES = 5000
+ARCHIVE_FILE_SIZE = 16 * 1024
+WORKERS = 16
+PROCESSES = os.cpu_count()
+REGRESSION = 0.10 # A median more than 10 % slower than the baseline is flagged
+
+SHAPES = {
+    "lan": Shape(),
+    "wan": Shape(latency=0.02, bandwidth=50 * 1024 * 1024),
+    "flaky": Shape(fail_rate=0.05, reset_rate=0.05, seed=1),
+    "no-ranges": Shape(ranges=False),
+}
+SCENARIOS = {}
+
+
+
+def scenario(
+    name,
+    shape="lan",
+):
+    def register(function):
+        SCENARIOS[name] = (function, shape)
+        return function
+    return register
+
+
+
+class Context:
+    def __init__(
+        self,
+        args,
+        work_dir,
+    ):
+        self.args = args
+        self.work_dir = work_dir
+        self.catalog = Catalog(os.path.join(work_dir, "served"))
+        self.huge = self.catalog.add_synthetic("huge.bin", args.huge_size * 1024 * 1024)
+        self.tiny = [self.catalog.add_synthetic(f"tiny/{i:06d}.bin", args.tiny_size) for i in range(args.tiny_files)]
+        self.zip = self.catalog.add_archive("archive.zip", args.archive_files, args.archive_file_size)
+        self.tar = self.catalog.add_archive("archive.tar.gz", args.archive_files, args.archive_file_size)
+        self.out_dir = os.path.join(work_dir, "out")
+        self.server = None
+
+    def fresh_out(
+        self,
+    ):
+        shutil.rmtree(self.out_dir, ignore_errors=True)
+        os.makedirs(self.out_dir)
+        return self.out_dir
+
+    def jobs(
+        self,
+        names,
+        route="files",
+    ):
+        return [(f"{self.server.url}/{route}/{name}", os.path.join(self.out_dir, name)) for name in names]
+
+    def total_size(
+        self,
+        names,
+    ):
+        return sum(self.catalog.size(name) for name in names)
+
+
+
+# ---
+# Download scenarios
+# ---
+@scenario("download/huge-segmented")
+def _(ctx):
+    download_urls(ctx.jobs([ctx.huge]), ctx.args.workers, TokenBucket(0), segment_size=32 * 1024 * 1024)
+    return ctx.total_size([ctx.huge])
+
+
+@scenario("download/huge-single-stream")
+def _(ctx):
+    download_urls(ctx.jobs([ctx.huge]), ctx.args.workers, TokenBucket(0), max_segments=1)
+    return ctx.total_size([ctx.huge])
+
+
+@scenario("download/huge-segmented-wan", shape="wan")
+def _(ctx):
+    download_urls(ctx.jobs([ctx.huge]), ctx.args.workers, TokenBucket(0), segment_size=32 * 1024 * 1024)
+    return ctx.total_size([ctx.huge])
+
+
+@scenario("download/huge-adaptive-wan", shape="wan")
+def _(ctx):
+    controller = AdaptiveConcurrency(maximum=ctx.args.workers, interval=0.5)
+    download_urls(ctx.jobs([ctx.huge]), ctx.args.workers, TokenBucket(0), segment_size=32 * 1024 * 1024, controller=controller)
+    return ctx.total_size([ctx.huge])
+
+
+@scenario("download/huge-flaky", shape="flaky")
+def _(ctx):
+    download_urls(ctx.jobs([ctx.huge]), ctx.args.workers, TokenBucket(0), segment_size=32 * 1024 * 1024)
+    return ctx.total_size([ctx.huge])
+
+
+@scenario("download/huge-no-ranges", shape="no-ranges")
+def _(ctx):
+    download_urls(ctx.jobs([ctx.huge]), ctx.args.workers, TokenBucket(0))
+    return ctx.total_size([ctx.huge])
+
+
+@scenario("download/tiny-threads")
+def _(ctx):
+    download_urls(ctx.jobs(ctx.tiny), ctx.args.workers, TokenBucket(0))
+    return ctx.total_size(ctx.tiny)
+
+
+@scenario("download/tiny-asyncio")
+def _(ctx):
+    download_urls_async([job + ("tiny",) for job in ctx.jobs(ctx.tiny)], TokenBucket(0))
+    return ctx.total_size(ctx.tiny)
+
+
+@scenario("download/tiny-asyncio-wan", shape="wan")
+def _(ctx):
+    download_urls_async([job + ("tiny",) for job in ctx.jobs(ctx.tiny)], TokenBucket(0))
+    return ctx.total_size(ctx.tiny)
+
+
+@scenario("download/drive-confirm")
+def _(ctx):
+    # The client only resolves confirmation pages on Drive hosts : the local server stands in for one
+    # (for this scenario only : the others must not pay for the peek at every response)
+    names = ctx.tiny[:100]
+    drive_hosts = http_client.DRIVE_HOSTS
+    http_client.DRIVE_HOSTS = drive_hosts + ("127.0.0.1",)
+    try:
+        download_urls(ctx.jobs(names, route="drive"), ctx.args.workers, TokenBucket(0))
+    finally:
+        http_client.DRIVE_HOSTS = drive_hosts
+    return ctx.total_size(names)
+
+
+
+# ---
+# Extraction scenarios
+# ---
+@scenario("extract/zip")
+def _(ctx):
+    extract_archives([(ctx.catalog.files[ctx.zip], ctx.out_dir)], ctx.args.processes)
+    return ctx.total_size([ctx.zip])
+
+
+@scenario("extract/tar.gz")
+def _(ctx):
+    extract_archives([(ctx.catalog.files[ctx.tar], ctx.out_dir)], ctx.args.processes)
+    return ctx.total_size([ctx.tar])
+
+
+@scenario("extract/stream-tar.gz")
+def _(ctx):
+    stream_extract_urls([(f"{ctx.server.url}/files/{ctx.tar}", ctx.out_dir)], ctx.args.workers, TokenBucket(0))
+    return ctx.total_size([ctx.tar])
+
+
+@scenario("extract/stream-zip")
+def _(ctx):
+    stream_extract_urls([(f"{ctx.server.url}/files/{ctx.zip}", ctx.out_dir)], ctx.args.workers, TokenBucket(0))
+    return ctx.total_size([ctx.zip])
+
+
+
+# ---
+# Full pipeline
+# ---
+@scenario("pipeline/main")
+def _(ctx):
+    # Runs main.py end to end in a fresh $HOME, against a spreadsheet served by the local server,
+    # and returns the stage timings it logged in logs/de-profundis/
+    home = os.path.join(ctx.out_dir, "home")
+    os.makedirs(os.path.join(home, "scratch"))
+    os.makedirs(os.path.join(home, "bench-project"))
+    rows = [
+        ("bench-project", "huge", "huge", f"{ctx.server.url}/files/{ctx.huge}"),
+        ("bench-project", "archives", "zip", f"{ctx.server.url}/files/{ctx.zip}"),
+        ("bench-project", "archives", "tar", f"{ctx.server.url}/files/{ctx.tar}"),
+        ("bench-project", "tiny", "tiny", ";".join(f"{ctx.server.url}/files/{name}" for name in ctx.tiny[:200])),
+    ]
+    ctx.catalog.add_file("spreadsheet-bench.csv", (
+        "Project,Task,Dataset name,URL(s)\n" + "".join(",".join(row) + "\n" for row in rows)
+    ).encode())
+
+    env = {k: v for k, v in os.environ.items() if not k.startswith("SLURM_")}
+    env["HOME"] = home
+    command = [
+        ctx.args.python, os.path.join(ROOT_DIR, "main.py"),
+        "--root", home,
+        "--spreadsheet_id", "bench",
+        "--spreadsheet_url", f"{ctx.server.url}/spreadsheet/ccc?key={{id}}&output=csv",
+        "--spreadsheet_filename", os.path.join(ctx.out_dir, "datasets_index.csv"),
+        "--cache_dir", os.path.join(ctx.out_dir, "cache"),
+        "--multiprocessing",
+        "--workers", str(ctx.args.workers),
+        "--processes", str(ctx.args.processes),
+        "--BANDWIDTH_LIMIT", "0",
+        "--reserve", "0",
+    ]
+    with open(os.path.join(ctx.work_dir, "pipeline.log"), "w") as log_file:
+        code = subprocess.run(command, env=env, cwd=ROOT_DIR, stdout=log_file, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL).returncode
+    if code != 0:
+        raise RuntimeError(f"main.py exited with code {code}, see {log_file.name}")
+
+    stages = {}
+    for path in glob.glob(os.path.join(home, "scratch/logs/de-profundis/events-*.jsonl")):
+        with open(path, "r") as f:
+            for event in map(json.loads, f):
+                if event["event"] == "stage_end":
+                    stages[event["stage"]] = stages.get(event["stage"], 0) + event["wall"]
+    return ctx.total_size([ctx.huge, ctx.zip, ctx.tar] + ctx.tiny[:200]), {"stages": stages}
+
+
+
+def run_scenario(
+    ctx,
+    name,
+):
+    function, shape = SCENARIOS[name]
+    walls, extra = [], {}
+    with ShapedServer(ctx.catalog, SHAPES[shape]) as server:
+        ctx.server = server
+        for _ in range(ctx.args.repeat):
+            ctx.fresh_out()
+            http_client.configure(pool_size=max(http_client.POOL_SIZE, ctx.args.workers))
+            started = perf_counter()
+            result = function(ctx)
+            walls.append(perf_counter() - started)
+            size, extra = result if isinstance(result, tuple) else (result, extra)
+        stats = server.stats
+    return {
+        "name": name,
+        "shape": shape,
+        "repeat": len(walls),
+        "wall": walls,
+        "wall_min": min(walls),
+        "wall_median": statistics.median(walls),
+        "bytes": size,
+        "mb_per_s": size / min(walls) / 1e6,
+        "server": stats,
+        **extra,
+    }
+
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, capture_output=True, text=True).stdout.strip() or "unknown"
+    except OSError:
+        return "unknown"
+
+
+
+def compare(
+    results,
+    baseline_path,
+    threshold=REGRESSION,
+):
+    with open(baseline_path, "r") as f:
+        baseline = {r["name"]: r for r in json.load(f)["results"]}
+    regressions = []
+    print(f"\n{'scenario':<32} {'baseline':>10} {'current':>10} {'change':>8}")
+    for r in results:
+        if r["name"] not in baseline:
+            continue
+        before, after = baseline[r["name"]]["wall_median"], r["wall_median"]
+        change = after / before - 1
+        flag = " <- regression" if change > threshold else ""
+        print(f"{r['name']:<32} {before:>9.3f}s {after:>9.3f}s {change:>+7.1%}{flag}")
+        if flag:
+            regressions.append(r["name"])
+    return regressions
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="De profundiS : offline benchmarks against a local shaped HTTP server",
+    )
+    parser.add_argument("--only", help="Only run the scenarios matching these glob patterns (e.g. 'download/*')", nargs="*", default=[])
+    parser.add_argument("--list", help="List the scenarios and exit", action="store_true")
+    parser.add_argument("--repeat", help="Repetitions of each scenario (the median is compared)", type=int, default=REPEAT)
+    parser.add_argument("--huge_size", help="Size of the huge file, in MB", type=int, default=HUGE_SIZE)
+    parser.add_argument("--tiny_files", help="Number of tiny files", type=int, default=TINY_FILES)
+    parser.add_argument("--tiny_size", help="Size of each tiny file, in bytes", type=int, default=TINY_SIZE)
+    parser.add_argument("--archive_files", help="Number of members of the zip and tar.gz archives", type=int, default=ARCHIVE_FILES)
+    parser.add_argument("--archive_file_size", help="Size of each archive member, in bytes", type=int, default=ARCHIVE_FILE_SIZE)
+    parser.add_argument("--workers", help="Concurrent connections", type=int, default=WORKERS)
+    parser.add_argument("--processes", help="Extraction processes", type=int, default=PROCESSES)
+    parser.add_argument("--python", help="Interpreter running main.py in the pipeline scenario", type=str, default=sys.executable)
+    parser.add_argument("--results_dir", help="Where the results are written", type=str, default=RESULTS_DIR)
+    parser.add_argument("--compare", help="Results file to compare against", type=str, default=None)
+    args = parser.parse_args()
+
+    names = [n for n in SCENARIOS if not args.only or any(fnmatch.fnmatch(n, p) for p in args.only)]
+    if args.list:
+        print("\n".join(f"{n} ({SCENARIOS[n][1]})" for n in SCENARIOS))
+        sys.exit(0)
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="de-profundis-bench-") as work_dir:
+        ctx = Context(args, work_dir)
+        for name in names:
+            try:
+                result = run_scenario(ctx, name)
+            except Exception as e:
+                print(f"{name:<32} failed : {e}")
+                continue
+            results.append(result)
+            print(f"{name:<32} {result['wall_median']:>8.3f}s median  {result['mb_per_s']:>9.1f} MB/s")
+            for stage, wall in result.get("stages", {}).items():
+                print(f"    {stage:<28} {wall:>8.3f}s")
+
+    os.makedirs(args.results_dir, exist_ok=True)
+    revision = git_revision()
+    path = os.path.join(args.results_dir, f"{int(time())}-{revision}.json")
+    with open(path, "w") as f:
+        json.dump({
+            "revision": revision,
+            "time": time(),
+            "host": socket.gethostname(),
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+            "config": {k: v for k, v in vars(args).items() if k not in ("only", "list", "compare", "results_dir")},
+            "results": results,
+        }, f, indent=2)
+    print(f"\nWrote {path}")
+
+    if args.compare and compare(results, args.compare):
+        sys.exit(1)
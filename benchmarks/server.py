@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+
+# -----------------------
+# -------------------------------------------------
+# ------------------------------------------------------------------------------------------------
+# De profundiS : Local HTTP server with shaped links for the benchmarks
+# ------------------------------------------------------------------------------------------------
+# -------------------------------------------------
+# -----------------------
+
+
+
+# ---
+# Standard library imports
+# ---
+import os
+import io
+import re
+import time
+import random
+import socket
+import tarfile
+import zipfile
+import threading
+import urllib.parse
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+
+
+BLOCK_SIZE = 1024 * 1024 # Synthetic files repeat one pseudo-random block
+CHUNK_SIZE = 64 * 1024
+RANGE_PATTERN = re.compile(r"bytes=(\d*)-(\d*)")
+
+
+
+@dataclass
+class Shape:
+    latency: float = 0.0 # Seconds before the response headers, per request
+    bandwidth: int = 0 # Bytes/s per connection (0 : unlimited)
+    ranges: bool = True # Honour Range requests (206) or always answer 200
+    fail_rate: float = 0.0 # Probability of a 503 instead of the response
+    reset_rate: float = 0.0 # Probability of closing the connection halfway through a body
+    seed: int = 0
+
+
+
+class Catalog:
+    # name -> content : synthetic files are generated on the fly at any offset, archives
+    # and small files are built once into `data_dir` and served from disk
+    def __init__(
+        self,
+        data_dir,
+        seed=0,
+    ):
+        self.data_dir = data_dir
+        self.block = random.Random(seed).randbytes(BLOCK_SIZE)
+        self.synthetic = {}
+        self.files = {}
+        os.makedirs(data_dir, exist_ok=True)
+
+    def add_synthetic(
+        self,
+        name,
+        size,
+    ):
+        self.synthetic[name] = size
+        return name
+
+    def add_file(
+        self,
+        name,
+        data,
+    ):
+        path = os.path.join(self.data_dir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+        self.files[name] = path
+        return name
+
+    def add_archive(
+        self,
+        name,
+        n_files,
+        file_size,
+    ):
+        # Compressible members (text-like), as real datasets mostly are
+        path = os.path.join(self.data_dir, name)
+        member = lambda i: (f"{os.path.splitext(name)[0]}/part-{i // 1000:03d}/item-{i:06d}.txt", (f"{i:08d} " * (file_size // 9 + 1)).encode()[:file_size])
+        if name.endswith(".zip"):
+            with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as z:
+                for i in range(n_files):
+                    z.writestr(*member(i))
+        else:
+            with tarfile.open(path, "w:gz") as t:
+                for i in range(n_files):
+                    arcname, data = member(i)
+                    info = tarfile.TarInfo(arcname)
+                    info.size = len(data)
+                    t.addfile(info, io.BytesIO(data))
+        self.files[name] = path
+        return name
+
+    def size(
+        self,
+        name,
+    ):
+        if name in self.synthetic:
+            return self.synthetic[name]
+        return os.path.getsize(self.files[name])
+
+    def read(
+        self,
+        name,
+        start,
+        end,
+    ):
+        # Yields the bytes [start, end] of `name` in chunks
+        if name in self.synthetic:
+            offset = start
+            while offset <= end:
+                i = offset % BLOCK_SIZE
+                n = min(CHUNK_SIZE, BLOCK_SIZE - i, end - offset + 1)
+                yield self.block[i:i + n]
+                offset += n
+            return
+        with open(self.files[name], "rb") as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    return
+                remaining -= len(chunk)
+                yield chunk
+
+
+
+class ShapedHandler(BaseHTTPRequestHandler):
+    # /files/<name> : plain downloads. /drive/<name> : the first request gets a
+    # Drive-like HTML warning page with a `download_warning` cookie, and the file is only
+    # served once the request carries `confirm=<token>`. /spreadsheet/ccc?key=<id> : the CSV index.
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True # Headers and small bodies are separate writes : no 40 ms delayed-ACK stalls
+    catalog = None
+    shape = Shape()
+    rng = random.Random(0)
+    lock = threading.Lock()
+    stats = {"requests": 0, "failures": 0, "resets": 0, "bytes": 0}
+
+    def log_message(self, format, *args):
+        pass
+
+    def count(
+        self,
+        key,
+        n=1,
+    ):
+        with self.lock:
+            self.stats[key] += n
+
+    def roll(
+        self,
+        probability,
+    ):
+        with self.lock:
+            return probability > 0 and self.rng.random() < probability
+
+    def do_HEAD(self):
+        self.respond(body=False)
+
+    def do_GET(self):
+        self.respond(body=True)
+
+    def respond(
+        self,
+        body,
+    ):
+        self.count("requests")
+        if self.shape.latency:
+            time.sleep(self.shape.latency)
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        if self.roll(self.shape.fail_rate):
+            self.count("failures")
+            return self.send_text(503, "Injected failure", body)
+
+        if url.path.startswith("/spreadsheet/"):
+            name = f"spreadsheet-{query.get('key', [''])[0]}.csv"
+        elif url.path.startswith("/drive/"):
+            name = urllib.parse.unquote(url.path[len("/drive/"):])
+            token = f"t{abs(hash(name)) % 10 ** 8}"
+            if query.get("confirm", [None])[0] != token:
+                page = f'<html><form action="/drive/{name}"><input name="confirm" value="{token}"></form></html>'
+                return self.send_text(200, page, body, content_type="text/html", cookie=f"download_warning_{token}={token}; Path=/")
+        else:
+            name = urllib.parse.unquote(url.path[len("/files/"):])
+        if name not in self.catalog.synthetic and name not in self.catalog.files:
+            return self.send_text(404, "Not found", body)
+
+        size = self.catalog.size(name)
+        start, end, status = 0, size - 1, 200
+        match = RANGE_PATTERN.fullmatch(self.headers.get("Range", ""))
+        if match and self.shape.ranges and size > 0:
+            first, last = match.groups()
+            start = int(first) if first else max(0, size - int(last))
+            end = min(int(last), size - 1) if first and last else size - 1
+            status = 206
+            if start >= size:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+        self.send_response(status)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(end - start + 1))
+        if self.shape.ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.end_headers()
+        if body:
+            self.send_body(name, start, end)
+
+    def send_body(
+        self,
+        name,
+        start,
+        end,
+    ):
+        reset_at = start + (end - start) // 2 if self.roll(self.shape.reset_rate) else None
+        sent, began = 0, time.monotonic()
+        try:
+            for chunk in self.catalog.read(name, start, end):
+                if reset_at is not None and start + sent + len(chunk) > reset_at:
+                    self.count("resets")
+                    self.connection.shutdown(socket.SHUT_RDWR)
+                    self.close_connection = True
+                    return
+                self.wfile.write(chunk)
+                sent += len(chunk)
+                if self.shape.bandwidth:
+                    ahead = sent / self.shape.bandwidth - (time.monotonic() - began)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+        finally:
+            self.count("bytes", sent)
+
+    def send_text(
+        self,
+        status,
+        text,
+        body,
+        content_type="text/plain",
+        cookie=None,
+    ):
+        data = text.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        if cookie:
+            self.send_header("Set-Cookie", cookie)
+        self.end_headers()
+        if body:
+            self.wfile.write(data)
+
+
+
+class QuietServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        pass # Clients resetting connections (cancelled segments, injected failures) are expected
+
+
+
+class ShapedServer:
+    # Runs the server on a background thread : `with ShapedServer(catalog, shape) as url:`
+    def __init__(
+        self,
+        catalog,
+        shape=None,
+        host="127.0.0.1",
+    ):
+        shape = shape or Shape()
+        handler = type("Handler", (ShapedHandler,), {
+            "catalog": catalog,
+            "shape": shape,
+            "rng": random.Random(shape.seed),
+            "lock": threading.Lock(),
+            "stats": {"requests": 0, "failures": 0, "resets": 0, "bytes": 0},
+        })
+        self.handler = handler
+        self.server = QuietServer((host, 0), handler)
+        self.url = f"http://{host}:{self.server.server_port}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def stats(self):
+        return dict(self.handler.stats)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+
+# -----------------------
+# -------------------------------------------------
+# ------------------------------------------------------------------------------------------------
+# De profundiS : Normalized dataset and URL tables of the spreadsheet
+# ------------------------------------------------------------------------------------------------
+# -------------------------------------------------
+# -----------------------
+
+
+
+# ---
+# Standard library imports
+# ---
+import os
+
+
+
+# ---
+# Scientific imports
+# ---
+import numpy as np
+import pandas as pd
+
+
+
+# ---
+# Local imports
+# ---
+from integrity import DIGEST_LENGTHS
+from integrity import DEFAULT_ALGORITHM
+from transfer import url_basename
+from extract import is_archive
+from selection import categorize
+
+
+
+MANUAL = "manual"
+SEPARATOR = ";"
+EMPTY_CHECKSUMS = ("", "nan", "none", "-")
+
+# Per-URL states of the "State" column of the URL table
+PENDING = 0
+DOWNLOADED = 1
+STREAMED = 2 # Extracted on the fly, the archive never landed on disk
+FAILED = 3
+INTERRUPTED = 4
+SKIPPED = 5 # Locked by another node
+SYNCED = 6 # Copied from a mirror tree
+CACHED = 7 # Materialized from the shared cache
+
+
+
+def _explode(
+    column,
+):
+    # One row per ';'-separated item, indexed by dataset id, with the position of the item
+    # in its cell (URLs and checksums are aligned by position)
+    items = column.fillna("").astype(str).str.split(SEPARATOR).explode()
+    return pd.DataFrame({
+        "dataset": items.index.to_numpy(np.int32),
+        "position": items.groupby(level=0).cumcount().to_numpy(np.int32),
+        "value": items.str.strip().to_numpy(object),
+    })
+
+
+
+def _parse_checksums(
+    values,
+):
+    # Vectorized integrity.parse_checksum : "sha256:<hex>", "md5:<hex>" or a bare hex
+    # digest whose length gives the algorithm. Empty cells give a missing algorithm.
+    values = values.str.lower()
+    empty = values.isin(EMPTY_CHECKSUMS).to_numpy()
+    prefixed = values.str.contains(":", regex=False).to_numpy()
+    parts = values.str.partition(":")
+    by_length = values.str.len().map(DIGEST_LENGTHS).fillna(DEFAULT_ALGORITHM)
+    algorithm = np.where(prefixed, parts[0], by_length).astype(object)
+    digest = np.where(prefixed, parts[2], values).astype(object)
+    algorithm[empty], digest[empty] = None, None
+    return pd.Categorical(algorithm), digest
+
+
+
+def normalize(
+    df,
+    statuses,
+    status,
+):
+    # Splits the raw spreadsheet into the dataset table (one row per dataset, indexed by an
+    # integer id, categorical Project/Task) and the URL table (one row per URL, pointing
+    # to its dataset id, with the per-URL state in array-backed columns).
+    df = df.reset_index(drop=True).rename_axis("dataset")
+    cells = df["URL(s)"].fillna("").astype(str).str.strip()
+    is_manual = cells.eq(MANUAL)
+
+    urls = _explode(cells.mask(is_manual, ""))
+    if "Checksum(s)" in df.columns:
+        checksums = _explode(df["Checksum(s)"])
+        urls = urls.merge(checksums, on=["dataset", "position"], how="left", suffixes=("", "_checksum"))
+        urls["value_checksum"] = urls["value_checksum"].fillna("")
+    else:
+        urls["value_checksum"] = ""
+    urls = urls[urls["value"].ne("")].reset_index(drop=True)
+
+    algorithm, digest = _parse_checksums(urls["value_checksum"])
+    basenames = urls["value"].map(url_basename)
+    table = pd.DataFrame({
+        "dataset": urls["dataset"].to_numpy(np.int32),
+        "URL": urls["value"].to_numpy(object),
+        "Basename": basenames.to_numpy(object),
+        "is_archive": basenames.map(is_archive).to_numpy(bool),
+        "Algorithm": algorithm,
+        "Digest": digest,
+        "Size": np.full(len(urls), -1, dtype=np.int64),
+        "Done": np.zeros(len(urls), dtype=np.int64),
+        "State": np.full(len(urls), PENDING, dtype=np.int8),
+    })
+
+    df = df.drop(columns=["URL(s)", "Checksum(s)"], errors="ignore")
+    categorize(df)
+    df["Key"] = df["Project"].astype(str) + "/" + df["Task"].astype(str) + "/" + df["Dataset name"].astype(str)
+    df["is_manual"] = is_manual.to_numpy(bool)
+    df["# of URLs"] = np.bincount(table["dataset"], minlength=len(df)).astype(np.int32)
+    df["Status"] = pd.Categorical(np.full(len(df), status, dtype=object), categories=statuses)
+    df["Total size"] = np.zeros(len(df), dtype=np.int64)
+    return df, table
+
+
+
+def lookup(
+    df,
+    urls,
+    column,
+):
+    # A column of the dataset table, aligned with the rows of the URL table
+    return df[column].reindex(urls["dataset"]).to_numpy()
+
+
+
+def locate(
+    df,
+    urls,
+    datasets_dir,
+):
+    # Where each URL is downloaded : <datasets_dir>/<Project>/<Task>/<basename>
+    project = pd.Series(lookup(df, urls, "Project"), index=urls.index).astype(str)
+    task = pd.Series(lookup(df, urls, "Task"), index=urls.index).astype(str)
+    urls["Destination"] = os.path.join(datasets_dir, "") + project + os.sep + task + os.sep + urls["Basename"]
+    return urls
+
+
+
+def urls_of(
+    df,
+    urls,
+):
+    # The rows of the URL table that belong to the datasets of `df`
+    return urls[np.isin(urls["dataset"].to_numpy(), df.index.to_numpy())]
+
+
+
+def per_dataset(
+    df,
+    values,
+    dataset,
+    how="sum",
+    fill_value=0,
+):
+    # Folds a per-URL array into one value per dataset of `df`
+    return pd.Series(values).groupby(np.asarray(dataset)).agg(how).reindex(df.index, fill_value=fill_value)
+
+
+
+def set_status(
+    df,
+    mask,
+    status,
+):
+    df.loc[np.asarray(mask, dtype=bool), "Status"] = status
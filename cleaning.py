@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+
+# -----------------------
+# -------------------------------------------------
+# ------------------------------------------------------------------------------------------------
+# De profundiS : Parallel cleaning of checkpoints, logs and outputs
+# ------------------------------------------------------------------------------------------------
+# -------------------------------------------------
+# -----------------------
+
+
+
+# ---
+# Standard library imports
+# ---
+import os
+import logging
+import collections
+import concurrent.futures
+from time import time
+from dataclasses import dataclass
+
+
+
+# ---
+# Local imports
+# ---
+from walker import walk
+from walker import scan_trees
+from walker import WORKERS
+
+
+
+log = logging.getLogger("rich")
+UNLINK_BATCH = 256 # Files removed per task : one task per file costs more than the unlink itself
+
+
+
+@dataclass
+class RetentionPolicy:
+    keep_last: int = None # Entries kept in each run directory, most recent first
+    max_age: float = None # Days
+    max_size: float = None # GB per project
+
+    def is_empty(
+        self,
+    ):
+        return self.keep_last is None and self.max_age is None and self.max_size is None
+
+
+
+def list_runs(
+    project_dir,
+):
+    # {run directory: [entries]} : every subdirectory of a project is a run, and the
+    # entries directly below it (checkpoints, log files, ...) are what the policy keeps
+    # or deletes. Plain files lying in the project directory form a run of their own.
+    runs = collections.defaultdict(list)
+    with os.scandir(project_dir) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                with os.scandir(entry.path) as run:
+                    runs[entry.path] = [e.path for e in run]
+            else:
+                runs[project_dir].append(entry.path)
+    return runs
+
+
+
+def plan_cleaning(
+    project_dirs,
+    policy,
+    workers=WORKERS,
+):
+    # Returns the paths to delete below `project_dirs`. Without any policy, everything goes.
+    if policy.is_empty():
+        return sorted(os.path.join(d, name) for d in project_dirs for name in os.listdir(d))
+
+    runs = {project_dir: list_runs(project_dir) for project_dir in project_dirs}
+    entries = [path for project in runs.values() for run in project.values() for path in run]
+    stats = scan_trees(entries, workers)
+    for path, st in stats.items():
+        if st.n_files == 0: # An empty directory has no file mtime to report
+            st.mtime = os.lstat(path).st_mtime
+
+    victims = set()
+    now = time()
+    for project_dir, project in runs.items():
+        for run in project.values():
+            newest_first = sorted(run, key=lambda p: stats[p].mtime, reverse=True)
+            if policy.keep_last is not None:
+                victims.update(newest_first[policy.keep_last:])
+            if policy.max_age is not None:
+                victims.update(p for p in run if now - stats[p].mtime > policy.max_age * 86400)
+        if policy.max_size is not None:
+            total = 0
+            kept = sorted((p for run in project.values() for p in run if p not in victims), key=lambda p: stats[p].mtime, reverse=True)
+            for path in kept:
+                total += stats[path].size
+                if total > policy.max_size * 1024 ** 3:
+                    victims.add(path)
+        # A run whose every entry goes is removed with them
+        for run_dir, run in project.items():
+            if run_dir != project_dir and run and victims.issuperset(run):
+                victims.difference_update(run)
+                victims.add(run_dir)
+    return sorted(victims)
+
+
+
+def _unlink_batch(
+    paths,
+):
+    errors = 0
+    for path in paths:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            log.warning(f"Could not delete {path} : {e}")
+            errors += 1
+    return errors
+
+
+
+def _rmdir(
+    path,
+):
+    try:
+        os.rmdir(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        log.warning(f"Could not delete {path} : {e}")
+        return 1
+    return 0
+
+
+
+def remove_trees(
+    paths,
+    workers=WORKERS,
+    on_removed=None,
+):
+    # Deletes files and whole trees : a parallel scandir walk lists everything, a pool
+    # unlinks the files in batches, then the directories go deepest level first, each
+    # level in parallel. Returns (number of files, number of directories, errors).
+    files, dirs = [], []
+    trees = {p for p in paths if os.path.isdir(p) and not os.path.islink(p)}
+    for root, dirpath, listing, _ in walk(paths, workers):
+        files.extend(path for path, _ in listing)
+        if root in trees:
+            dirs.append(dirpath)
+
+    errors = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        batches = [files[i:i + UNLINK_BATCH] for i in range(0, len(files), UNLINK_BATCH)]
+        for batch, batch_errors in zip(batches, pool.map(_unlink_batch, batches)):
+            errors += batch_errors
+            if on_removed is not None:
+                on_removed(len(batch))
+
+        levels = collections.defaultdict(list)
+        for path in dirs:
+            levels[os.path.normpath(path).count(os.sep)].append(path)
+        for depth in sorted(levels, reverse=True):
+            errors += sum(pool.map(_rmdir, levels[depth]))
+    return len(files), len(dirs), errors
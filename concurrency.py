@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+
+# -----------------------
+# -------------------------------------------------
+# ------------------------------------------------------------------------------------------------
+# De profundiS : Adaptive per-host concurrency from the observed throughput
+# ------------------------------------------------------------------------------------------------
+# -------------------------------------------------
+# -----------------------
+
+
+
+# ---
+# Standard library imports
+# ---
+import asyncio
+import logging
+import threading
+import contextlib
+import urllib.parse
+from time import monotonic
+
+
+
+log = logging.getLogger("rich")
+INITIAL = 4 # Connections per host to start with
+MINIMUM = 1
+INTERVAL = 2.0 # Seconds between two decisions for a host
+MIN_GAIN = 0.05 # Relative throughput gain an added connection must bring
+DECREASE = 0.5 # Multiplicative decrease on 429/5xx and resets
+HOLD = 15 # Intervals before probing again once adding connections stopped helping
+BACKOFF_HOLD = 3 # Intervals before probing again after backing off
+CAP_RATIO = 0.95 # Share of the global cap above which more connections cannot help
+
+
+
+def host_of(
+    url,
+):
+    return urllib.parse.urlparse(url).hostname or url
+
+
+
+class _Host:
+    def __init__(
+        self,
+        limit,
+    ):
+        self.limit = limit
+        self.in_flight = 0
+        self.busiest = 0 # Most connections in flight since the last decision
+        self.bytes = 0
+        self.errors = 0
+        self.throughput = None # At the previous decision
+        self.previous = limit # Limit before the last increase
+        self.slow_start = True # Doubling until the first plateau or throttling
+        self.backed_off = False # At the previous decision : its errors may still be arriving
+        self.hold_until = 0.0
+        self.since = monotonic()
+
+
+
+class AdaptiveConcurrency:
+    # AIMD on the connections of each host : doubled per interval at first (slow start),
+    # then one more connection per interval, as long as the last increase raised the
+    # host's throughput by at least MIN_GAIN. Halved on throttling (429/5xx) and resets,
+    # back to the last useful count once the throughput plateaus, and never raised while
+    # the global cap `max_rate` (bytes/s) is what limits the throughput.
+    # `on_decision(host, old limit, new limit, throughput, reason)` reports each change.
+    def __init__(
+        self,
+        initial=INITIAL,
+        maximum=32,
+        max_rate=0,
+        interval=INTERVAL,
+        on_decision=None,
+    ):
+        self.initial = max(MINIMUM, min(initial, maximum))
+        self.maximum = maximum
+        self.max_rate = max_rate
+        self.interval = interval
+        self.on_decision = on_decision
+        self.hosts = {}
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+
+    def _host(
+        self,
+        host,
+    ):
+        if host not in self.hosts:
+            self.hosts[host] = _Host(self.initial)
+        return self.hosts[host]
+
+    def try_acquire(
+        self,
+        url,
+    ):
+        with self.lock:
+            state = self._host(host_of(url))
+            if state.in_flight >= state.limit:
+                return False
+            state.in_flight += 1
+            state.busiest = max(state.busiest, state.in_flight)
+            return True
+
+    def release(
+        self,
+        url,
+    ):
+        with self.lock:
+            self._host(host_of(url)).in_flight -= 1
+            self.condition.notify_all()
+        self._maybe_decide(host_of(url))
+
+    @contextlib.contextmanager
+    def slot(
+        self,
+        url,
+    ):
+        # One connection to the host of `url`, waiting for the host to be under its limit
+        with self.condition:
+            state = self._host(host_of(url))
+            while state.in_flight >= state.limit:
+                self.condition.wait(self.interval)
+            state.in_flight += 1
+            state.busiest = max(state.busiest, state.in_flight)
+        try:
+            yield
+        finally:
+            self.release(url)
+
+    @contextlib.asynccontextmanager
+    async def async_slot(
+        self,
+        url,
+    ):
+        # Same for the event loop, which must not block on the condition
+        while not self.try_acquire(url):
+            await asyncio.sleep(0.05)
+        try:
+            yield
+        finally:
+            self.release(url)
+
+    def observe(
+        self,
+        url,
+        n,
+    ):
+        with self.lock:
+            self._host(host_of(url)).bytes += n
+        self._maybe_decide(host_of(url))
+
+    def congestion(
+        self,
+        url,
+        n=1,
+    ):
+        # Throttling answers (429/503) or connections reset by the server
+        with self.lock:
+            self._host(host_of(url)).errors += n
+
+    def limits(
+        self,
+    ):
+        with self.lock:
+            return {host: state.limit for host, state in self.hosts.items()}
+
+    def _maybe_decide(
+        self,
+        host,
+    ):
+        now = monotonic()
+        with self.lock:
+            state = self.hosts[host]
+            elapsed = now - state.since
+            if elapsed < self.interval:
+                return
+            throughput = state.bytes / elapsed
+            total = sum(s.bytes / max(now - s.since, 1e-9) for s in self.hosts.values())
+            old, reason = state.limit, None
+            increased = state.limit > state.previous
+            if state.errors and state.backed_off:
+                reason = None # Requests sent before the last decrease : one decrease per interval
+            elif state.errors:
+                state.limit = max(MINIMUM, int(state.limit * DECREASE))
+                state.hold_until = now + BACKOFF_HOLD * self.interval
+                state.slow_start = False
+                reason = f"{state.errors} throttled or reset request(s) : backing off"
+            elif self.max_rate > 0 and total >= CAP_RATIO * self.max_rate:
+                reason = None # At the global cap : more connections would only share it
+            elif state.busiest < state.limit:
+                reason = None # Not enough work to fill the connections : nothing to learn
+            elif increased and state.throughput and throughput < state.throughput * (1 + MIN_GAIN):
+                # Out of slow start, the additive probing resumes from the last useful count
+                state.limit = state.previous
+                state.hold_until = 0.0 if state.slow_start else now + HOLD * self.interval
+                reason = "no gain from the last connection(s) : holding" if not state.slow_start else "no gain from doubling : probing one by one"
+                state.slow_start = False
+            elif now >= state.hold_until and state.limit < self.maximum:
+                state.limit = min(self.maximum, state.limit * 2 if state.slow_start else state.limit + 1)
+                reason = "throughput still rising : " + ("doubling the connections" if state.slow_start else "probing one more connection")
+            state.backed_off = state.limit < old and bool(state.errors)
+            state.previous = old
+            state.throughput = throughput
+            state.bytes, state.errors, state.busiest, state.since = 0, 0, state.in_flight, now
+            if state.limit != old:
+                self.condition.notify_all()
+        if state.limit != old and self.on_decision is not None:
+            self.on_decision(host, old, state.limit, throughput, reason)
@@ -1,10 +1,157 @@
+import queue
+from dataclasses import dataclass
+
+from rich.table import Table
+from rich.filesize import decimal
+
+from textual import events
+from textual.app import App
+from textual.reactive import Reactive
+from textual.widget import Widget
+from textual.widgets import Header, Footer, Placeholder
+
+
+
+FRAMES_PER_SECOND = 10
+MAX_EVENTS_PER_FRAME = 10_000 # A burst of events is spread over several frames instead of freezing one
+TABLE_CHROME = 4 # Lines taken by the title, the header and the borders of the table
+TRUTH = {True: "yes", False: "no"}
+
+
+
+@dataclass
+class DatasetEvent:
+    key: str # "Project/Task/Dataset name", the "Key" column of the dataset table
+    status: str = None
+    advance: int = 0 # Bytes downloaded since the previous event
+    total: int = None
+
+
+
+def publish(
+    events,
+    key,
+    status=None,
+    advance=0,
+    total=None,
+):
+    # Called from the workers : never blocks, the view drains the queue at its own pace
+    events.put_nowait(DatasetEvent(key, status, advance, total))
+
+
+
+class DatasetTable(Widget):
+    # Keeps the formatted cells of every dataset and patches them in place on each event.
+    # Only the rows that fit on screen are turned into a rich Table when rendering.
+    COLUMNS = ("Project", "Task", "Name", "Status", "Total size", "Progress", "Is manual", "# of URLs")
+    STYLES = ("green", "cyan", "blue bold", "magenta", "magenta", "magenta", "magenta", "magenta")
+    STATUS, TOTAL_SIZE, PROGRESS = 3, 4, 5
+
+    def __init__(
+        self,
+        df,
+        name=None,
+    ):
+        super().__init__(name)
+        self.rows, self.index, self.done, self.totals = [], {}, [], []
+        columns = ("Key", "Project", "Task", "Dataset name", "Status", "Total size", "is_manual", "# of URLs")
+        for key, project, task, name, status, total, is_manual, n_urls in zip(*(df[c].tolist() for c in columns)):
+            self.index[key] = len(self.rows)
+            self.rows.append([
+                str(project),
+                str(task),
+                str(name),
+                status,
+                decimal(total),
+                "",
+                TRUTH[is_manual],
+                str(n_urls),
+            ])
+            self.done.append(0)
+            self.totals.append(total)
+        self.offset = 0
+
+    def visible(
+        self,
+    ):
+        height = max(1, self.size.height - TABLE_CHROME)
+        return range(self.offset, min(len(self.rows), self.offset + height))
+
+    def apply(
+        self,
+        event,
+    ):
+        # Returns whether the patched row is on screen, i.e. whether a new frame is needed
+        i = self.index.get(event.key)
+        if i is None:
+            return False
+        row = self.rows[i]
+        if event.status is not None:
+            row[self.STATUS] = event.status
+        if event.total is not None:
+            self.totals[i] = event.total
+            row[self.TOTAL_SIZE] = decimal(event.total)
+        if event.advance:
+            self.done[i] += event.advance
+        if event.advance or event.total is not None:
+            percent = f" ({100 * self.done[i] / self.totals[i]:.0f}%)" if self.totals[i] > 0 else ""
+            row[self.PROGRESS] = decimal(self.done[i]) + percent
+        return i in self.visible()
+
+    def scroll(
+        self,
+        delta,
+    ):
+        height = len(self.visible())
+        self.offset = max(0, min(len(self.rows) - height, self.offset + delta))
+        self.refresh()
+
+    async def on_mouse_scroll_down(self, event: events.MouseScrollDown) -> None:
+        self.scroll(3)
+
+    async def on_mouse_scroll_up(self, event: events.MouseScrollUp) -> None:
+        self.scroll(-3)
+
+    def render(
+        self,
+    ) -> Table:
+        rows = self.visible()
+        table = Table(
+            title=f"Current state of the datasets ({rows.start + 1}-{rows.stop} of {len(self.rows)})",
+            expand=True,
+        )
+        for column, style in zip(self.COLUMNS, self.STYLES):
+            table.add_column(header=column, justify="left", style=style, no_wrap=True)
+        for i in rows:
+            table.add_row(*self.rows[i])
+        return table
+
+
+
 class MainView(App):
+    def __init__(
+        self,
+        *args,
+        df=None,
+        events=None,
+        **kwargs,
+    ):
+        # MainView.run(df=df, events=events) : `events` is the queue the workers publish into
+        super().__init__(*args, **kwargs)
+        self.df = df
+        self.events = events if events is not None else queue.SimpleQueue()
+        self.paused = False
+
     async def on_load(self, event: events.Load) -> None:
         await self.bind("b", "toggle_sidebar", "Toggle sidebar")
         await self.bind("p", "pause", "Pause")
         await self.bind("r", "reload", "Reload rspreadsheet")
         await self.bind("q", "quit", "Quit")
-    
+        await self.bind("down", "scroll(1)", show=False)
+        await self.bind("up", "scroll(-1)", show=False)
+        await self.bind("pagedown", "scroll(20)", show=False)
+        await self.bind("pageup", "scroll(-20)", show=False)
+
     show_bar = Reactive(False)
 
     def watch_show_bar(self, show_bar: bool) -> None:
@@ -13,85 +160,56 @@ class MainView(App):
     def action_toggle_sidebar(self) -> None:
         self.show_bar = not self.show_bar
 
+    def action_pause(self) -> None:
+        # Events keep queuing while paused and are applied at once on resume
+        self.paused = not self.paused
+
+    def action_scroll(self, delta: int) -> None:
+        self.body_table.scroll(delta)
+
     async def on_mount(self, event: events.Mount) -> None:
-        # A scrollview to contain the markdown file
         self.header = Header()
         self.footer = Footer()
         self.bar = Placeholder()
-        self.body_table = ScrollView(gutter=1)
-        self.body_console = ScrollView(gutter=1)
+        self.body_table = DatasetTable(self.df)
 
         # Header / footer / dock
         await self.view.dock(
-            self.header, 
+            self.header,
             edge="top",
         )
         await self.view.dock(
-            self.footer, 
+            self.footer,
             edge="bottom",
         )
         await self.view.dock(
             self.bar,
-            edge="left", 
+            edge="left",
             size=40,
             name="sidebar",
         )
 
         # Dock the body in the remaining space
         await self.view.dock(
-            self.body_table, 
-            self.body_console,
+            self.body_table,
             edge="top",
         )
 
-        # Table update callback
-        async def get_table() -> None:
-            await self.body_table.update(self.update_table())
+        # Updates are coalesced : whatever arrived since the last frame is drawn at once
+        self.set_interval(1 / FRAMES_PER_SECOND, self.update_table)
 
-        # Console update callback
-        async def get_console(console) -> None:
-            with Live(self.body_console, refresh_per_second=4) as live:  # update 4 times a second to feel fluid       
-                await self.body_console.update(update_console(self.body_console))
 
-        await self.call_later(get_table)
-        await self.call_later(get_console)
-
-
-    def update_table(
+    async def update_table(
         self,
-    ) -> Table:
-        table = Table(
-            title=f"Current state of the datasets",
-            show_lines=True,
-        )
-
-        table.add_column(header="Project", footer="Project", justify="left", style="green", no_wrap=True)
-        table.add_column(header="Task", footer="Task", justify="left", style="cyan")
-        table.add_column(header="Name", footer="Name", justify="left", style="blue bold")
-        table.add_column(header="Status", footer="Status", justify="left", style="magenta")
-        table.add_column(header="Total size", footer="Total size", justify="left", style="magenta")
-        table.add_column(header="Is manual", footer="Is manual", justify="left", style="magenta")
-        table.add_column(header="# of URLs", footer="# of URLs", justify="left", style="magenta")
-
-        for _, dataset in df.iterrows():
-            table.add_row(
-                dataset["Project"],
-                dataset["Task"],
-                dataset["Dataset name"],
-                dataset["Status"],
-                str(dataset["Total size"]),
-                TRUTH[dataset["is_manual"]],
-                str(len(dataset["URL(s)"])),
-            )
-
-        return table
-
-
-    def update_console(
-        self,
-        console,
-    ):
-        console.bell()
-        console.print(f"Working on row #{row}")
-
-        return console
+    ) -> None:
+        if self.paused:
+            return
+        changed = False
+        for _ in range(MAX_EVENTS_PER_FRAME):
+            try:
+                event = self.events.get_nowait()
+            except queue.Empty:
+                break
+            changed |= self.body_table.apply(event)
+        if changed:
+            self.body_table.refresh()
@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+
+# -----------------------
+# -------------------------------------------------
+# ------------------------------------------------------------------------------------------------
+# De profundiS : Archive extraction
+# ------------------------------------------------------------------------------------------------
+# -------------------------------------------------
+# -----------------------
+
+
+
+# ---
+# Standard library imports
+# ---
+import os
+import io
+import logging
+import shutil
+import tarfile
+import tempfile
+import zipfile
+import heapq
+import hashlib
+import concurrent.futures
+
+
+
+# ---
+# Local imports
+# ---
+from http_client import open_url
+from transfer import url_basename
+from transfer import TransferInterrupted
+from transfer import STOP
+from transfer import CHUNK_SIZE
+from walker import TreeStats
+from integrity import ChecksumMismatch
+
+
+
+log = logging.getLogger("rich")
+TAR_EXTENSIONS = (".tar", ".tar.gz", ".tgz", ".tar.xz", ".txz", ".tar.bz2", ".tbz2")
+ZIP_EXTENSIONS = (".zip",)
+SPOOL_SIZE = 512 * 1024 * 1024 # Zip archives are kept in memory up to this size, then spilled to disk
+ZIP_CHUNK_SIZE = 256 * 1024 * 1024 # A zip is only split across processes above this many bytes per worker
+
+
+
+def is_tar(
+    name,
+):
+    return name.lower().endswith(TAR_EXTENSIONS)
+
+
+
+def is_zip(
+    name,
+):
+    return name.lower().endswith(ZIP_EXTENSIONS)
+
+
+
+def is_archive(
+    name,
+):
+    return is_tar(name) or is_zip(name)
+
+
+
+def _extract_kwargs():
+    # Rejects absolute paths, links escaping the target and device files (Python >= 3.11.4)
+    return {"filter": "data"} if hasattr(tarfile, "data_filter") else {}
+
+
+
+class ThrottledReader(io.RawIOBase):
+    # File-like view over an HTTP response that charges the global limiter and
+    # reports progress for every block handed to the decompressor.
+    def __init__(
+        self,
+        raw,
+        limiter,
+        on_progress=None,
+        hasher=None,
+    ):
+        self.raw = raw
+        self.limiter = limiter
+        self.on_progress = on_progress
+        self.hasher = hasher
+
+    def readable(self):
+        return True
+
+    def readinto(
+        self,
+        buffer,
+    ):
+        if STOP.is_set():
+            raise TransferInterrupted("stream interrupted")
+        data = self.raw.read(min(len(buffer), CHUNK_SIZE))
+        n = len(data)
+        buffer[:n] = data
+        if n:
+            self.limiter.consume(n)
+            if self.hasher is not None:
+                self.hasher.update(data)
+            if self.on_progress is not None:
+                self.on_progress(n)
+        return n
+
+
+
+def _top_level(
+    target_dir,
+    name,
+):
+    # First real component : './', './d/' or '../d' must not make the target directory
+    # itself (or its parent) a top-level path of the dataset
+    parts = [part for part in name.replace(os.sep, "/").split("/") if part not in ("", ".", "..")]
+    return os.path.join(target_dir, parts[0]) if parts else None
+
+
+
+def stream_extract(
+    url,
+    target_dir,
+    limiter,
+    on_progress=None,
+    checksum=None,
+):
+    # Pipes the HTTP response straight into the extractor : tar archives are read
+    # sequentially and never touch the disk, zip archives (whose central directory
+    # sits at the end) go through a bounded spool first.
+    # Returns (top-level paths created, TreeStats of the extracted files).
+    os.makedirs(target_dir, exist_ok=True)
+    top_level, stats = set(), TreeStats()
+    hasher = hashlib.new(checksum[0]) if checksum else None
+    with open_url(url) as response:
+        response.raise_for_status()
+        response.raw.decode_content = True # Strip transport encodings, keep the archive's own compression
+        reader = io.BufferedReader(ThrottledReader(response.raw, limiter, on_progress, hasher), CHUNK_SIZE)
+
+        if is_tar(url_basename(url)):
+            with tarfile.open(fileobj=reader, mode="r|*") as tar:
+                for member in tar:
+                    tar.extract(member, target_dir, **_extract_kwargs())
+                    top_level.add(_top_level(target_dir, member.name))
+                    if member.isfile():
+                        stats.add(TreeStats(1, member.size, member.mtime))
+        else:
+            with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE, dir=target_dir) as spool:
+                shutil.copyfileobj(reader, spool, CHUNK_SIZE)
+                spool.seek(0)
+                with zipfile.ZipFile(spool) as archive:
+                    for info in archive.infolist():
+                        archive.extract(info, target_dir)
+                        top_level.add(_top_level(target_dir, info.filename))
+                        if not info.is_dir():
+                            stats.add(TreeStats(1, info.file_size, 0.0))
+        if hasher is not None:
+            for _ in iter(lambda: reader.read(CHUNK_SIZE), b""):
+                pass # The digest covers the trailing padding after the last tar member too
+            if hasher.hexdigest() != checksum[1]:
+                raise ChecksumMismatch(f"{url} : expected {checksum[1]}, got {hasher.hexdigest()}")
+    return sorted(top_level - {None}), stats
+
+
+
+def stream_extract_urls(
+    jobs,
+    workers,
+    limiter,
+    on_progress=None,
+    checksums=None,
+):
+    # `jobs` is a list of (url, target_dir) pairs. `checksums` optionally maps URLs to an
+    # expected (algorithm, digest) of the archive, checked on the compressed stream.
+    # Returns {url: (exception or None, top-level paths, TreeStats)}.
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {
+            pool.submit(stream_extract, url, target_dir, limiter, on_progress, (checksums or {}).get(url)): url
+            for url, target_dir in jobs
+        }
+        for future in concurrent.futures.as_completed(futures):
+            url = futures[future]
+            if future.exception() is not None:
+                if not isinstance(future.exception(), TransferInterrupted):
+                    log.error(f"Failed to stream-extract {url} : {future.exception()}")
+                results[url] = (future.exception(), [], TreeStats())
+            else:
+                results[url] = (None, *future.result())
+    return results
+
+
+
+def default_processes():
+    # Follow what SLURM granted us (--cpus-per-node / --cpus-per-task) rather than the node size
+    for variable in ("SLURM_CPUS_PER_TASK", "SLURM_CPUS_ON_NODE"):
+        if os.environ.get(variable, "").isdigit():
+            return int(os.environ[variable])
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+
+def _extract_zip_members(
+    path,
+    target_dir,
+    names,
+):
+    # Runs in a worker process : each worker opens its own handle on the archive
+    stats = TreeStats()
+    with zipfile.ZipFile(path) as archive:
+        for name in names:
+            info = archive.getinfo(name)
+            try:
+                archive.extract(info, target_dir)
+            except FileExistsError:
+                # Another worker created the same parent directory in the meantime
+                archive.extract(info, target_dir)
+            if not info.is_dir():
+                stats.add(TreeStats(1, info.file_size, 0.0))
+    return set(), stats
+
+
+
+def _extract_tar(
+    path,
+    target_dir,
+):
+    # Compressed tar streams cannot be split : one worker reads the whole archive sequentially
+    top_level, stats = set(), TreeStats()
+    with tarfile.open(path, mode="r|*") as tar:
+        for member in tar:
+            tar.extract(member, target_dir, **_extract_kwargs())
+            top_level.add(_top_level(target_dir, member.name))
+            if member.isfile():
+                stats.add(TreeStats(1, member.size, member.mtime))
+    return top_level, stats
+
+
+
+def split_members(
+    infos,
+    n_chunks,
+):
+    # Largest-first greedy bin packing of zip members on their uncompressed size
+    bins = [(0, i, []) for i in range(n_chunks)]
+    for info in sorted(infos, key=lambda info: info.file_size, reverse=True):
+        size, i, names = heapq.heappop(bins)
+        names.append(info.filename)
+        heapq.heappush(bins, (size + info.file_size, i, names))
+    return [names for _, _, names in bins if names]
+
+
+
+def plan_extraction(
+    archive,
+    target_dir,
+    processes,
+):
+    # Returns (top-level paths known upfront, list of (function, args) tasks)
+    if is_zip(archive):
+        with zipfile.ZipFile(archive) as z:
+            infos = z.infolist()
+        total = sum(info.file_size for info in infos)
+        n_chunks = max(1, min(processes, total // ZIP_CHUNK_SIZE, len(infos)))
+        top_level = {_top_level(target_dir, info.filename) for info in infos}
+        return top_level, [(_extract_zip_members, (archive, target_dir, names)) for names in split_members(infos, n_chunks)]
+    return set(), [(_extract_tar, (archive, target_dir))]
+
+
+
+def extract_archives(
+    jobs,
+    processes,
+    on_extracted=None,
+):
+    # `jobs` is a list of (archive path, target_dir) pairs. Several archives are
+    # extracted at once, and large zip archives are spread over several processes.
+    # Returns {archive: (exception or None, top-level paths, TreeStats)}.
+    results = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, processes)) as pool:
+        futures, remaining = {}, {}
+        for archive, target_dir in jobs:
+            try:
+                os.makedirs(target_dir, exist_ok=True)
+                top_level, tasks = plan_extraction(archive, target_dir, processes)
+            except (OSError, zipfile.BadZipFile, tarfile.TarError) as e:
+                log.error(f"Failed to read {archive} : {e}")
+                results[archive] = (e, set(), TreeStats())
+                continue
+            results[archive] = (None, top_level, TreeStats())
+            remaining[archive] = len(tasks)
+            for function, task_args in tasks:
+                futures[pool.submit(function, *task_args)] = archive
+
+        for future in concurrent.futures.as_completed(futures):
+            archive = futures[future]
+            remaining[archive] -= 1
+            exception, top_level, stats = results[archive]
+            error = TransferInterrupted(archive) if future.cancelled() else future.exception()
+            if error is not None:
+                if exception is None and not isinstance(error, TransferInterrupted):
+                    log.error(f"Failed to extract {archive} : {error}")
+                exception = exception or error
+            else:
+                task_top_level, task_stats = future.result()
+                top_level = top_level | task_top_level
+                stats.add(task_stats)
+            results[archive] = (exception, top_level, stats)
+            if remaining[archive] == 0 and on_extracted is not None:
+                on_extracted(archive, stats)
+            if STOP.is_set():
+                # Preempted : the tasks not started yet are dropped, the running ones finish
+                for f in futures:
+                    f.cancel()
+
+    return {archive: (e, sorted(top_level - {None}), stats) for archive, (e, top_level, stats) in results.items()}
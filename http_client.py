@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+
+# -----------------------
+# -------------------------------------------------
+# ------------------------------------------------------------------------------------------------
+# De profundiS : Shared pooled HTTP client
+# ------------------------------------------------------------------------------------------------
+# -------------------------------------------------
+# -----------------------
+
+
+
+# ---
+# Standard library imports
+# ---
+import re
+import random
+import logging
+import threading
+import urllib.parse
+
+
+
+log = logging.getLogger("rich")
+TIMEOUT = 60
+POOL_SIZE = 16 # Keep-alive connections kept open per host
+POOL_HOSTS = 32 # Number of per-host pools kept around
+RETRIES = 5
+BACKOFF = 0.5 # Seconds, doubled on every attempt
+BACKOFF_MAX = 60
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+DRIVE_HOSTS = ("drive.google.com", "docs.google.com", "drive.usercontent.google.com")
+DRIVE_ID_PATTERNS = (
+    re.compile(r"/file/d/([0-9A-Za-z_-]+)"),
+    re.compile(r"[?&]id=([0-9A-Za-z_-]+)"),
+)
+CONFIRM_PATTERN = re.compile(r"""confirm=([0-9A-Za-z_-]+)|name="confirm"\s+value="([0-9A-Za-z_-]+)\"""")
+UUID_PATTERN = re.compile(r"""name="uuid"\s+value="([0-9A-Za-z_-]+)\"""")
+PEEK_SIZE = 64 * 1024 # Bytes of an HTML answer searched for the confirmation form
+
+
+
+_session = None
+_lock = threading.Lock()
+
+
+
+def build_session(
+    pool_size=POOL_SIZE,
+    retries=RETRIES,
+    backoff=BACKOFF,
+):
+    # Network imports are deferred to the first session : requests and urllib3 take a
+    # good part of the startup time, which the status and help commands do not need
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    retry_kwargs = dict(
+        total=retries,
+        backoff_factor=backoff,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=frozenset({"HEAD", "GET"}),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    try:
+        retry = Retry(backoff_jitter=backoff, backoff_max=BACKOFF_MAX, **retry_kwargs)
+    except TypeError: # urllib3 < 2
+        retry = Retry(**retry_kwargs)
+
+    adapter = HTTPAdapter(
+        pool_connections=POOL_HOSTS,
+        pool_maxsize=pool_size,
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+
+def configure(
+    pool_size=POOL_SIZE,
+    retries=RETRIES,
+    backoff=BACKOFF,
+):
+    global _session
+    with _lock:
+        if _session is not None:
+            _session.close()
+        _session = build_session(pool_size, retries, backoff)
+    return _session
+
+
+
+def get_session():
+    # One session for the whole process : the spreadsheet fetch, the probes and every
+    # download reuse the same keep-alive connections instead of a handshake per file.
+    global _session
+    with _lock:
+        if _session is None:
+            _session = build_session()
+        return _session
+
+
+
+def backoff_delay(
+    attempt,
+    backoff=BACKOFF,
+):
+    # Exponential backoff with full jitter, for failures urllib3 cannot retry (mid-stream)
+    return random.uniform(0, min(BACKOFF_MAX, backoff * 2 ** attempt))
+
+
+
+def is_drive_url(
+    url,
+):
+    return urllib.parse.urlparse(url).hostname in DRIVE_HOSTS
+
+
+
+def drive_id(
+    url,
+):
+    for pattern in DRIVE_ID_PATTERNS:
+        match = pattern.search(url)
+        if match:
+            return match.group(1)
+    return None
+
+
+
+def normalize_url(
+    url,
+):
+    # Every shape of Drive file link (/file/d/<id>/view, open?id=, uc?id=) becomes a direct download
+    if is_drive_url(url) and "/spreadsheet" not in url and drive_id(url):
+        return f"https://drive.google.com/uc?export=download&id={drive_id(url)}"
+    return url
+
+
+
+def parse_confirm_page(
+    page,
+):
+    # (token, uuid) from the confirmation form of a Drive HTML page
+    match = CONFIRM_PATTERN.search(page)
+    if match:
+        uuid = UUID_PATTERN.search(page)
+        return match.group(1) or match.group(2), uuid.group(1) if uuid else None
+    return None, None
+
+
+
+def confirm_params(
+    url,
+    params,
+    token,
+    uuid,
+):
+    # Query parameters of the request re-issued after a Drive confirmation page
+    params = dict(params or {})
+    if token:
+        params["confirm"] = token
+    if token and drive_id(url):
+        params["id"] = drive_id(url)
+    if uuid:
+        params["uuid"] = uuid
+    return params
+
+
+
+def get_confirm_token(
+    response,
+):
+    # Large Drive files answer with a virus-scan warning : the token is either in a
+    # `download_warning` cookie or in the confirmation form of the HTML page.
+    for key, value in response.cookies.items():
+        if key.startswith('download_warning'):
+            return value, None
+
+    if "text/html" in response.headers.get("Content-Type", ""):
+        page = next(response.iter_content(PEEK_SIZE, decode_unicode=False), b"").decode("utf-8", "replace")
+        return parse_confirm_page(page)
+
+    return None, None
+
+
+
+def open_url(
+    url,
+    headers=None,
+    params=None,
+    method="GET",
+    timeout=TIMEOUT,
+):
+    # Returns a streamed response, with redirects followed and Drive confirmation
+    # pages resolved. The caller owns the response (use it as a context manager).
+    session = get_session()
+    url = normalize_url(url)
+    response = session.request(method, url, headers=headers, params=params, stream=True, timeout=timeout, allow_redirects=True)
+    if method == "GET" and is_drive_url(response.url):
+        peeked = "text/html" in response.headers.get("Content-Type", "")
+        token, uuid = get_confirm_token(response)
+        if token or peeked:
+            response.close()
+            params = confirm_params(url, params, token, uuid)
+            # Re-issued even without a token : the peek consumed the start of a genuine HTML file
+            response = session.request(method, url, headers=headers, params=params, stream=True, timeout=timeout, allow_redirects=True)
+    return response
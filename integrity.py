@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+
+# -----------------------
+# -------------------------------------------------
+# ------------------------------------------------------------------------------------------------
+# De profundiS : Integrity verification
+# ------------------------------------------------------------------------------------------------
+# -------------------------------------------------
+# -----------------------
+
+
+
+# ---
+# Standard library imports
+# ---
+import os
+import mmap
+import hashlib
+import threading
+import concurrent.futures
+
+
+
+HASH_BLOCK_SIZE = 8 * 1024 * 1024
+DIGEST_LENGTHS = {32: "md5", 40: "sha1", 64: "sha256", 128: "sha512"}
+DEFAULT_ALGORITHM = "sha256"
+WORKERS = 8
+
+
+
+class ChecksumMismatch(Exception):
+    pass
+
+
+
+def parse_checksum(
+    value,
+):
+    # "sha256:<hex>", "md5:<hex>", or a bare hex digest whose length gives the algorithm.
+    # Returns (algorithm, digest), or None for an empty cell.
+    value = str(value).strip().lower()
+    if not value or value in ("nan", "none", "-"):
+        return None
+    if ":" in value:
+        algorithm, digest = value.split(":", 1)
+        return algorithm, digest
+    return DIGEST_LENGTHS.get(len(value), DEFAULT_ALGORITHM), value
+
+
+
+class StreamHasher:
+    # Hashes a file while it is being written. Chunks arriving at the current cursor are
+    # hashed inline. Out-of-order chunks (parallel Range segments) are left on disk, and
+    # `catch_up` reads them back once everything before them has landed. For single-stream
+    # transfers that never happens, so the digest is free.
+    def __init__(
+        self,
+        algorithm,
+    ):
+        self.algorithm = algorithm
+        self.hash = hashlib.new(algorithm)
+        self.cursor = 0
+        self.lock = threading.Lock()
+
+    def feed(
+        self,
+        offset,
+        chunk,
+    ):
+        with self.lock:
+            if offset == self.cursor:
+                self.hash.update(chunk)
+                self.cursor += len(chunk)
+
+    def catch_up(
+        self,
+        path,
+    ):
+        with self.lock, open(path, "rb") as f:
+            f.seek(self.cursor)
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+                self.hash.update(block)
+                self.cursor += len(block)
+
+    def hexdigest(
+        self,
+    ):
+        return self.hash.hexdigest()
+
+
+
+def hash_file(
+    path,
+    algorithm=DEFAULT_ALGORITHM,
+):
+    # Memory-mapped read : the page cache is hashed in place, without copies into Python buffers
+    digest = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return digest.hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            if hasattr(m, "madvise"):
+                m.madvise(mmap.MADV_SEQUENTIAL)
+            view = memoryview(m)
+            try:
+                for start in range(0, size, HASH_BLOCK_SIZE):
+                    digest.update(view[start:start + HASH_BLOCK_SIZE])
+            finally:
+                view.release()
+    return digest.hexdigest()
+
+
+
+def hash_files(
+    jobs,
+    workers=WORKERS,
+):
+    # `jobs` is a list of (path, algorithm) pairs. hashlib releases the GIL on large
+    # buffers, so threads hash in parallel. Returns {path: digest or exception}.
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {pool.submit(hash_file, path, algorithm): path for path, algorithm in jobs}
+        for future in concurrent.futures.as_completed(futures):
+            path = futures[future]
+            results[path] = future.exception() or future.result()
+    return results
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+
+# -----------------------
+# -------------------------------------------------
+# ------------------------------------------------------------------------------------------------
+# De profundiS : Disk usage inventory of scratch
+# ------------------------------------------------------------------------------------------------
+# -------------------------------------------------
+# -----------------------
+
+
+
+# ---
+# Standard library imports
+# ---
+import os
+import glob
+import json
+import socket
+import logging
+import datetime
+import collections
+from time import time
+
+
+
+# ---
+# Local imports
+# ---
+from walker import walk
+from walker import TreeStats
+from walker import WORKERS
+
+
+
+log = logging.getLogger("rich")
+CATEGORIES = {
+    # Category folder : name of the level below each project
+    "datasets": "tasks",
+    "checkpoints": "runs",
+    "logs": "runs",
+    "outputs": "runs",
+}
+
+
+
+def usage(
+    stats,
+):
+    return {"n_files": stats.n_files, "size": stats.size}
+
+
+
+def inventory(
+    scratch_dir,
+    cached=None,
+    workers=WORKERS,
+):
+    # Disk usage and file counts per category, project and task (or run), from one parallel
+    # scandir walk of every project folder. `cached` maps paths to TreeStats already known
+    # (the entries of the status index) : those subtrees are counted without being walked.
+    scratch_dir = os.path.normpath(scratch_dir)
+    cached = {os.path.normpath(path): stats for path, stats in (cached or {}).items()}
+    roots = []
+    for category in CATEGORIES:
+        category_dir = os.path.join(scratch_dir, category)
+        if os.path.isdir(category_dir):
+            with os.scandir(category_dir) as it:
+                roots.extend(e.path for e in it if e.is_dir(follow_symlinks=False) and not e.name.startswith("."))
+
+    totals = collections.defaultdict(TreeStats)
+    def account(
+        path,
+        stats,
+    ):
+        # <category>/<project>/<task or run>/... : files lying directly in a project folder
+        # only count towards the project
+        parts = os.path.relpath(path, scratch_dir).split(os.sep)
+        keys = [tuple(parts[:1]), tuple(parts[:2])] + ([tuple(parts[:3])] if len(parts) > 3 else [])
+        for key in keys:
+            totals[key].add(stats)
+
+    for _, _, files, _ in walk(roots, workers, skip=cached.keys()):
+        for path, st in files:
+            account(path, TreeStats(1, st.st_size, st.st_mtime))
+    for path, stats in cached.items():
+        if path.startswith(scratch_dir + os.sep) and os.path.relpath(path, scratch_dir).split(os.sep)[0] in CATEGORIES:
+            account(path, stats)
+
+    total = TreeStats()
+    for category in CATEGORIES:
+        total.add(totals[(category,)])
+    report = {
+        "time": time(),
+        "host": socket.gethostname(),
+        "scratch_dir": scratch_dir,
+        "total": usage(total),
+        "categories": {},
+    }
+    for category in CATEGORIES:
+        report["categories"][category] = dict(usage(totals[(category,)]), projects={})
+    for key, stats in sorted(totals.items(), key=lambda item: (len(item[0]), item[0])):
+        if len(key) == 2:
+            report["categories"][key[0]]["projects"][key[1]] = dict(usage(stats), **{CATEGORIES[key[0]]: {}})
+        elif len(key) == 3:
+            report["categories"][key[0]]["projects"][key[1]][CATEGORIES[key[0]]][key[2]] = usage(stats)
+    return report
+
+
+
+def latest_inventory(
+    inventory_dir,
+):
+    paths = sorted(glob.glob(os.path.join(inventory_dir, "inventory-*.json")))
+    if not paths:
+        return None
+    with open(paths[-1], "r") as f:
+        return json.load(f)
+
+
+
+def write_inventory(
+    inventory_dir,
+    report,
+):
+    # One timestamped file per run, so that the growth of scratch can be followed over time
+    os.makedirs(inventory_dir, exist_ok=True)
+    stamp = datetime.datetime.fromtimestamp(report["time"]).strftime("%Y%m%d-%H%M%S")
+    path = os.path.join(inventory_dir, f"inventory-{stamp}.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(report, f, indent=2)
+    os.replace(path + ".tmp", path)
+    return path
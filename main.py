@@ -17,42 +17,95 @@
 # Standard library imports
 # ---
 import os
+import sys
+import signal
 import logging
 import datetime
 import uuid
 import argparse
 import concurrent.futures
-import requests
-import glob
+import collections
+import threading
 import shutil
+import contextlib
 from time import time
 from time import sleep
 
 
 
-# ---
-# Scientific imports
-# ---
-import pandas as pd
-
-
-
 # ---
 # Pretty-printing with Rich
 # ---
 from rich import print
-from rich import pretty
-from rich import inspect
 from rich.console import Console
 from rich.theme import Theme
-from rich.traceback import install
 from rich.progress import Progress
-from rich.logging import RichHandler
 from rich.table import Table
 from rich.prompt import Confirm
 from rich.tree import Tree
-pretty.install() # Pretty printing and highlighting of data structures (REPL)
-# inspect(my_list, methods=True)
+from rich.panel import Panel
+from rich.text import Text
+from rich.filesize import decimal
+
+
+
+# ---
+# Local imports
+# ---
+from http_client import configure as configure_http
+from http_client import POOL_SIZE
+from http_client import RETRIES
+from transfer import TokenBucket
+from transfer import TransferInterrupted
+from transfer import STOP
+from transfer import request_stop
+from transfer import download_urls
+from transfer import probe_urls
+from transfer import SEGMENT_SIZE
+from transfer import MAX_SEGMENTS
+from concurrency import AdaptiveConcurrency
+from concurrency import INITIAL as ADAPTIVE_INITIAL
+from extract import stream_extract_urls
+from extract import is_archive
+from extract import extract_archives
+from extract import default_processes
+from spreadsheet import SpreadsheetCache
+from spreadsheet import SPREADSHEET_URL
+from async_transfer import download_urls_async
+from async_transfer import PER_HOST
+from async_transfer import PER_DATASET
+from sharding import shard_identity
+from sharding import assign_keys
+from sharding import share_sizes
+from sharding import sizes_path
+from sharding import UrlLocks
+from sharding import write_shard_report
+from sharding import merge_reports
+from sharding import run_id
+from metrics import Metrics
+from metrics import PROFILERS
+from integrity import hash_files
+from integrity import DEFAULT_ALGORITHM
+from walker import walk
+from inventory import inventory
+from inventory import latest_inventory
+from inventory import write_inventory
+from cleaning import RetentionPolicy
+from cleaning import plan_cleaning
+from cleaning import remove_trees
+from admission import headroom
+from admission import admit
+from admission import Reservations
+from admission import RESERVATIONS_FILENAME
+from admission import EXPANSION_FACTOR
+from admission import RESERVE
+from status_index import StatusIndex
+from status_index import INDEX_FILENAME
+from shared_cache import SharedCache
+from shared_cache import METHODS as MATERIALIZE_METHODS
+
+
+
 custom_theme = Theme({
     "quote": "underline italic magenta",
     "title": "underline italic bold",
@@ -63,13 +116,9 @@ custom_theme = Theme({
 console = Console(
     theme=custom_theme,
 )
-install(show_locals=False)
 FORMAT = "%(message)s"
-logging.basicConfig(
-    level="NOTSET", format=FORMAT, datefmt="[%X]", handlers=[RichHandler()]
-)
 log = logging.getLogger("rich")
-logging.disable(level=logging.DEBUG)
+as_bool = lambda v: str(v).lower() in ("true", "1", "yes", "y")
 trim = lambda s, max_len: s if len(s) <= max_len else s[:max_len-3] + '...'
 STATUSES = {
     'downloaded': '✅',
@@ -93,8 +142,6 @@ DELETE_ZIP = True
 UNZIP = True
 
 HOME_DIR = os.path.expanduser('~')
-PROJECTS = list(map(os.path.basename, (glob.glob(os.path.join(HOME_DIR, "*")))))
-PROJECTS.remove("scratch")
 ROOT_DIR = os.path.join(HOME_DIR, "scratch/")
 
 DO_RESET_SCRATCH = False
@@ -107,54 +154,248 @@ DO_DELETE_ZIP = False
 CLEAN_CHECKPOINTS = None
 CLEAN_LOGS = None
 CLEAN_OUTPUTS = None
+KEEP_LAST = None
+MAX_AGE = None
+MAX_SIZE = None
 
 SPREADSHEET_ID = "10ftkEU-FQsGCrrUW4lSuip0g5joUWD_04EJtUeywrLM"
 SPREADSHEET_FILENAME = "datasets_index.csv"
+CACHE_DIR = os.path.join(HOME_DIR, ".cache/de-profundis/")
+OFFLINE = False
 
 VERBOSE = False
 VISUAL_GUI = False
 
 MULTIPROCESSING = False
-BANDWIDTH_LIMIT = 10_000
+BANDWIDTH_LIMIT = 0 # KB/s, unlimited
+MAX_RATE = None
+ADAPTIVE = False
+WORKERS = 8
+BACKEND = "threads"
+PROCESSES = default_processes()
+
+RESCAN = False
+VERIFY = False
+STREAM_EXTRACT = False
+MIRROR = None
+SYNC_BLOCK_SIZE = 128 * 1024
+SHARED_CACHE = None
+SHARED_CACHE_SIZE = None
+MATERIALIZE = "hardlink"
+PACK = False
+PACK_SHARD_SIZE = 1.0
+DELETE_PACKED = False
+PACK_SUFFIX = ".pack"
+EXTRACTED_STAGES = ("extracted", "packed")
+
+SHARD, NUM_SHARDS = shard_identity()
+
+PROFILE = None
+PROFILE_STAGES = []
+
+EXIT_PREEMPTED = 3 # submit.sh requeues the job when main.py exits with this code
+STATUS = False
+LIST = False
+EXTRACT_GLOB = []
+
+
+
+def setup_logging():
+    # Rich tracebacks and the logging handler are only installed once the arguments are
+    # parsed : importing them is a good part of the startup time of --help and --status
+    from rich import pretty
+    from rich.traceback import install
+    from rich.logging import RichHandler
+    pretty.install() # Pretty printing and highlighting of data structures (REPL)
+    install(show_locals=False)
+    logging.basicConfig(
+        level="NOTSET", format=FORMAT, datefmt="[%X]", handlers=[RichHandler()]
+    )
+    logging.disable(level=logging.DEBUG)
 
 
 
-def download_file_from_google_drive(
-    id,
-    destination,
+def list_projects(
+    home_dir,
 ):
-    def get_confirm_token(
-        response,
-    ):
-        for key, value in response.cookies.items():
-            if key.startswith('download_warning'):
-                return value
+    # Every folder of the home directory except scratch/ itself. Computed when a stage
+    # needs it rather than at import, and empty instead of failing when scratch/ is missing.
+    with os.scandir(home_dir) as it:
+        return sorted(e.name for e in it if e.is_dir() and not e.name.startswith(".") and e.name != "scratch")
 
-        return None
 
-    def save_response_content(
-        response, 
-        destination,
-    ):
-        CHUNK_SIZE = 32768
 
-        with open(destination, "wb") as f:
-            for chunk in response.iter_content(CHUNK_SIZE):
-                if chunk: # filter out keep-alive new chunks
-                    f.write(chunk)
+def print_status(
+    args,
+):
+    # Fast path for job prologues and shell prompts : only reads the status index, without
+    # loading the spreadsheet, touching the network or importing pandas
+    if not os.path.exists(args.index_path):
+        sys.stdout.write(f"No status index at {args.index_path}\n")
+        return 1
+    with StatusIndex(args.index_path) as index:
+        datasets = index.datasets()
+        counts = dict.fromkeys(STATUSES, 0)
+        for dataset, stage, n_files, total_size, updated_at in datasets:
+            status = index.resolve(dataset)
+            counts[status] += 1
+            updated = datetime.datetime.fromtimestamp(updated_at).strftime("%Y-%m-%d %H:%M")
+            sys.stdout.write(f"{STATUSES[status]} {dataset}\t{stage}\t{n_files} files\t{decimal(total_size)}\t{updated}\n")
+    sys.stdout.write(", ".join(f"{n} {status}" for status, n in counts.items() if n) or "No indexed dataset")
+    sys.stdout.write("\n")
+    return 0
+
+
+
+def list_members(
+    args,
+):
+    # Fast path like --status : the members of the archives kept on scratch, from their
+    # member index (built on first touch), filtered by --extract_glob
+    if not os.path.exists(args.index_path):
+        sys.stdout.write(f"No status index at {args.index_path}\n")
+        return 1
+    from members import ArchiveIndex
+    with StatusIndex(args.index_path) as index:
+        for dataset, *_ in index.datasets():
+            for path, is_dir, *_ in index.entries(dataset):
+                if is_dir or not is_archive(path) or not os.path.exists(path):
+                    continue
+                members = ArchiveIndex.load(path)
+                positions = members.match(args.extract_glob) if args.extract_glob else range(len(members))
+                for i in positions:
+                    sys.stdout.write(f"{dataset}\t{path}\t{members.name(i)}\t{decimal(int(members.sizes[i]))}\n")
+    return 0
+
+
+
+@contextlib.contextmanager
+def scratch_lock(
+    args,
+    path,
+):
+    # Lock file on scratch around a file several shards and jobs write : neither SQLite's
+    # own locking nor flock are reliable on parallel filesystems
+    with UrlLocks(args.lock_dir) as locks:
+        while not locks.acquire(path):
+            sleep(1)
+        yield
+
+
+
+def index_lock(
+    args,
+):
+    return scratch_lock(args, args.shared_index_path)
+
+
+
+def fork_index(
+    args,
+):
+    # With several shards, each one works on its own copy of the status index instead of
+    # every node writing the same SQLite file, and folds its changes back with merge_index
+    args.shared_index_path, args.index_path = args.index_path, f"{args.index_path}.shard-{args.shard}"
+    with index_lock(args), StatusIndex(args.shared_index_path) as index:
+        if os.path.exists(args.index_path):
+            index.merge(args.index_path) # Left by a shard killed before it could merge
+            os.remove(args.index_path)
+        index.fork(args.index_path)
+
+
+
+def merge_index(
+    args,
+):
+    if args.shared_index_path is None:
+        return
+    with index_lock(args), StatusIndex(args.shared_index_path) as index:
+        index.merge(args.index_path)
+    os.remove(args.index_path)
+    args.index_path, args.shared_index_path = args.shared_index_path, None
+
+
+
+def exit_if_stopped(
+    args,
+):
+    # Checked between stages : a SIGUSR1 that arrived outside the transfers (probing,
+    # extraction, packing) ends the run there too, to be requeued by submit.sh
+    if not STOP.is_set():
+        return
+    console.log("[logging.level.warning]Interrupted : the next run resumes where this one stopped.[/logging.level.warning]")
+    merge_index(args)
+    args.metrics.close()
+    sys.exit(EXIT_PREEMPTED)
+
+
+
+def handle_preemption(
+    signum,
+    frame,
+):
+    console.log("[logging.level.warning]Received SIGUSR1 : saving the transfer journals and exiting ...[/logging.level.warning]")
+    request_stop()
+
+
+
+def run_view(
+    df,
+    events,
+):
+    # multiprocessing gives the child /dev/null as stdin : the keys come from the terminal
+    from view import MainView
+    sys.stdin = open("/dev/tty")
+    MainView.run(title="De profundiS : Datasets Sycnhronizer utility", df=df, events=events)
+
+
+
+def start_view(
+    df,
+    args,
+):
+    # The dataset view (de-profundis/view.py) takes over the terminal from its own process,
+    # as textual installs signal handlers, which only a main thread may do. The stages feed
+    # it through `args.events`, and the pipeline logs to a file while it is open.
+    import multiprocessing
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "de-profundis"))
+    context = multiprocessing.get_context("fork")
+    args.events = context.Queue()
+    view = context.Process(
+        target=run_view,
+        args=(df, args.events),
+        daemon=True,
+    )
+    view.start()
+    path = os.path.join(args.logs_dir, "de-profundis", "pipeline.log")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    console.log(f"[table.caption]Logging to[/table.caption] {path} [table.caption]while the view is open ...[/table.caption]")
+    sys.stdout = sys.stderr = open(path, "a", buffering=1)
+    return view
+
 
-    URL = f"https://docs.google.com/spreadsheet/ccc?key={id}&output=csv"
 
-    session = requests.Session()
+def notify(
+    args,
+    key,
+    status=None,
+    advance=0,
+    total=None,
+):
+    # Publishes a dataset event to the view, when there is one
+    if args.events is not None:
+        from view import publish
+        publish(args.events, key, status, advance, total)
 
-    response = session.get(URL, stream = True)
-    token = get_confirm_token(response)
 
-    if token:
-        params = { 'id' : id, 'confirm' : token }
-        response = session.get(URL, params = params, stream = True)
 
-    save_response_content(response, destination)   
+def notify_statuses(
+    df,
+    mask,
+    args,
+):
+    for key, status in zip(df["Key"][mask], df["Status"][mask]):
+        notify(args, key, status=status)
 
 
 
@@ -162,35 +403,91 @@ def process_df(
     df,
     args,
 ): 
-    df["is_manual"] = df["URL(s)"].apply(lambda x: (x == "manual"))
-    df["URL(s)"] = df["URL(s)"].apply(lambda x: (x.split(";") if x != "manual" else []))
-    df["Status"] = STATUSES['unknown']
-    df["Total size"] = 1
+    # Returns the dataset table and the URL table (see catalog.normalize)
+    from catalog import normalize # Deferred with numpy and pandas
+    return normalize(
+        df,
+        statuses=list(STATUSES.values()),
+        status=STATUSES['unknown'],
+    )
 
 
 
-def filter_df(
+def get_checksums(
+    urls,
+):
+    # {url: (algorithm, digest)} for the rows of the URL table that carry a checksum
+    urls = urls[urls["Algorithm"].notna().to_numpy()]
+    return dict(zip(urls["URL"], zip(urls["Algorithm"].astype(str), urls["Digest"])))
+
+
+
+def get_archives(
+    urls,
+):
+    # The rows of the URL table whose archive is on disk
+    return urls[urls["is_archive"].to_numpy() & urls["Destination"].map(os.path.exists).to_numpy(bool)]
+
+
+
+def get_checked(
+    urls,
+):
+    # The rows of the URL table whose file is on disk and has an expected checksum
+    return urls[urls["Algorithm"].notna().to_numpy() & urls["Destination"].map(os.path.exists).to_numpy(bool)]
+
+
+
+def verify_datasets(
     df,
-    criterion="in",
-    key="Project",
-    values=["nlp-emergent-languages",],
+    args,
+    index,
 ):
-    for v in values:
-        if criterion == "in":
-            df = df[df[key] == v]
+    # Rehashes, in parallel and through mmap, the archives that have an expected checksum
+    # and every file below the dataset's indexed entries. Files whose size and mtime did not
+    # change are compared with their cached digest, which catches silent corruption.
+    from catalog import urls_of
+    from catalog import lookup
+    checked = get_checked(urls_of(df, args.urls))
+    expected = dict(zip(checked["Destination"], zip(checked["Algorithm"].astype(str), checked["Digest"])))
+    owners = dict(zip(checked["Destination"], lookup(df, checked, "Key")))
+    for key in df["Key"]:
+        roots = [path for path, *_ in index.entries(key)]
+        for _, _, files, _ in walk(roots, args.workers):
+            for path, _ in files:
+                if path not in expected:
+                    digest = index.verified_digest(path, DEFAULT_ALGORITHM)
+                    expected[path], owners[path] = (DEFAULT_ALGORITHM, digest), key
+
+    console.log(f"[table.caption]Verifying[/table.caption] {len(expected)} [table.caption]file(s) ...[/table.caption]")
+    digests = hash_files([(path, algorithm) for path, (algorithm, _) in expected.items()], args.workers)
+    failed = set()
+    for path, digest in digests.items():
+        algorithm, reference = expected[path]
+        if isinstance(digest, Exception) or (reference is not None and digest != reference):
+            console.log(f"[logging.level.error]Checksum mismatch for[/logging.level.error] {path}")
+            failed.add(owners[path])
         else:
-            df = df[df[key] != v]
-    return df
+            index.record_verified(path, algorithm, digest)
+    return failed
 
 
 
-def get_compressed_files(
-    row,
+def get_unverified(
+    df,
     args,
+    index,
 ):
-    compressed_basenames = list(map(os.path.basename, (row["URL(s)"])))
-    compressed_files = list(map(lambda x: args.datasets_dir + row["project"] + "/" + row["task"] + "/"))
-    return compressed_files
+    # Boolean array over `df` : only uses the verified-content cache, a file is trusted
+    # without rehashing as long as it keeps the size and mtime it had when its digest matched
+    from catalog import urls_of
+    from catalog import per_dataset
+    checked = get_checked(urls_of(df, args.urls))
+    mismatched = [
+        index.verified_digest(path, algorithm) != digest
+        for path, algorithm, digest in zip(checked["Destination"], checked["Algorithm"].astype(str), checked["Digest"])
+    ]
+    return per_dataset(df, mismatched, checked["dataset"], how="any", fill_value=False).to_numpy(bool)
 
 
 
@@ -198,22 +495,61 @@ def unzip_handler(
     df_selected,
     args,
 ):
-    for row in df_selected.rows:
-        compressed_files = get_compressed_files(row, args)
-        for zip_file in compressed_files :
-            os.remove(os.path(zip_file))
-            console.log(f"|[red]{row["Project"]}[/red]| |[yellow]{row["Task"]}[/yellow]| [table.caption]Unzipped file[/table.caption] {zip_file} [table.caption]![/table.caption]")
+    from catalog import urls_of
+    from catalog import lookup
+    archives = get_archives(urls_of(df_selected, args.urls))
+    jobs = [(path, os.path.dirname(path)) for path in archives["Destination"]]
+    keys = dict(zip(archives["Destination"], lookup(df_selected, archives, "Key")))
+
+    if args.extract_glob:
+        console.log(f"[table.caption]Extracting the members matching[/table.caption] {' '.join(args.extract_glob)} [table.caption]from[/table.caption] {len(jobs)} [table.caption]archive(s) ...[/table.caption]")
+    else:
+        console.log(f"[table.caption]Extracting[/table.caption] {len(jobs)} [table.caption]archive(s) with[/table.caption] {args.processes} [table.caption]process(es) ...[/table.caption]")
+    with Progress(console=console) as progress:
+        task = progress.add_task("Extracting", total=len(jobs))
+        def on_extracted(
+            archive,
+            stats,
+        ):
+            progress.update(task, advance=1)
+            args.metrics.add("extracted_bytes_total", stats.size)
+            notify(args, keys[archive], status="extracted")
+        if args.extract_glob:
+            # Only the selected members, reached through the member index : the archives stay
+            from members import extract_members
+            results = extract_members(
+                jobs,
+                args.extract_glob,
+                args.workers,
+                on_extracted=on_extracted,
+            )
+        else:
+            results = extract_archives(
+                jobs,
+                args.processes,
+                on_extracted=on_extracted,
+            )
+
+    for project, task_name, zip_file in zip(lookup(df_selected, archives, "Project"), lookup(df_selected, archives, "Task"), archives["Destination"]):
+        if results[zip_file][0] is None:
+            console.log(f"|[red]{project}[/red]| |[yellow]{task_name}[/yellow]| [table.caption]Unzipped file[/table.caption] {zip_file} [table.caption]![/table.caption]")
+    return results
+
 
 
 def zip_delete_handler(
     df_selected,
     args,
 ):
-    for row in df_selected.rows:
-        compressed_files = get_compressed_files(row, args)
-        for zip_file in compressed_files :
-            os.remove(os.path(zip_file))
-            console.log(f"|[red]{row["Project"]}[/red]| |[yellow]{row["Task"]}[/yellow]| [table.caption]Deleted file[/table.caption] {zip_file} [table.caption]![/table.caption]")
+    from catalog import urls_of
+    from catalog import lookup
+    archives = get_archives(urls_of(df_selected, args.urls))
+    from members import index_path
+    for project, task_name, zip_file in zip(lookup(df_selected, archives, "Project"), lookup(df_selected, archives, "Task"), archives["Destination"]):
+        os.remove(zip_file)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(index_path(zip_file)) # Member index of an earlier partial extraction
+        console.log(f"|[red]{project}[/red]| |[yellow]{task_name}[/yellow]| [table.caption]Deleted file[/table.caption] {zip_file} [table.caption]![/table.caption]")
 
 
 
@@ -236,12 +572,27 @@ def process_actions(
         console.log(f"|[red]{row["Project"]}[/red]| |[yellow]{row["Task"]}[/yellow]| [table.caption]Created directory[/table.caption] {str(path)} [table.caption]![/table.caption]")
 
     def clean_dir(
-        path,
-    )
-        files = glob.glob(path)
-        for f in files:
-            console.log(f"[table.caption]Deleting[/table.caption] {str(f)} [table.caption]...[/table.caption]")
-            os.remove(f)
+        parent_dir,
+        projects,
+    ):
+        # An empty list of projects means every project
+        project_dirs = [os.path.join(parent_dir, p) for p in (projects or args.projects)]
+        project_dirs = [d for d in project_dirs if os.path.isdir(d)]
+        policy = RetentionPolicy(
+            keep_last=args.keep_last,
+            max_age=args.max_age,
+            max_size=args.max_size,
+        )
+        victims = plan_cleaning(project_dirs, policy, args.workers)
+        console.log(f"[table.caption]Deleting[/table.caption] {len(victims)} [table.caption]entries of[/table.caption] {len(project_dirs)} [table.caption]project(s) in[/table.caption] {parent_dir} [table.caption]...[/table.caption]")
+        with Progress(console=console) as progress:
+            task = progress.add_task("Deleting", total=None)
+            n_files, n_dirs, errors = remove_trees(
+                victims,
+                args.workers,
+                on_removed=lambda n: progress.update(task, advance=n),
+            )
+        console.log(f"[table.caption]Deleted[/table.caption] {n_files} [table.caption]file(s) and[/table.caption] {n_dirs} [table.caption]folder(s),[/table.caption] {errors} [table.caption]error(s)[/table.caption]")
 
     if args.do_reset_scratch:
         args.do_erase_scratch = True
@@ -275,31 +626,31 @@ def process_actions(
 
     if args.do_unzip:
         console.log("[logging.level.info]Unzipping intermediate ZIP files ...[/logging.level.info]")
-        unzip_handler(df_selected)
+        unzip_handler(df, args)
 
     if args.do_delete_zip:
         if Confirm.ask("[logging.keyword]Are you sure you want to delete intermediate ZIP files ?[/logging.keyword]"):
             console.log("[logging.level.debug]Deleting intermediate ZIP files ...[/logging.level.debug]")
-            zip_delete_handler(df_selected)
+            zip_delete_handler(df, args)
         else:
             console.log("[logging.level.error]Did not delete intermediate ZIP files ![/logging.level.error]")
 
-    if args.clean_checkpoints:
+    if args.clean_checkpoints is not None:
         if Confirm.ask("[logging.keyword]Are you sure you want to clean the checkpoints folder ?[/logging.keyword]"):
             console.log("[logging.level.debug]Cleaning checkpoints ...[/logging.level.debug]")
-            clean_dir(args.checkpoints_dir)
+            clean_dir(args.checkpoints_dir, args.clean_checkpoints)
         else:
             console.log("[logging.level.error]Did not delete clean the checkpoints directory ![/logging.level.error]")
-    if args.clean_logs:
+    if args.clean_logs is not None:
         if Confirm.ask("[logging.keyword]Are you sure you want to clean the logs folder ?[/logging.keyword]"):
             console.log("[logging.level.debug]Cleaning logs ...[/logging.level.debug]")
-            clean_dir(args.logs_dir)
+            clean_dir(args.logs_dir, args.clean_logs)
         else:
             console.log("[logging.level.error]Did not delete clean the logs directory ![/logging.level.error]")
-    if args.clean_outputs:
+    if args.clean_outputs is not None:
         if Confirm.ask("[logging.keyword]Are you sure you want to clean the outputs folder ?[/logging.keyword]"):
             console.log("[logging.level.debug]Cleaning outputs ...[/logging.level.debug]")
-            clean_dir(args.outputs_dir)
+            clean_dir(args.outputs_dir, args.clean_outputs)
         else:
             console.log("[logging.level.error]Did not delete clean the outputs directory ![/logging.level.error]")
 
@@ -309,49 +660,138 @@ def select_datasets(
     df,
     args,
 ):
-    if args.include != []:
-        df = filter_df(
-            df,
-            criterion="in",
-            key="Dataset name",
-            values=args.include,
-        )
-    if args.exclude != []:
-        df = filter_df(
-            df,
-            criterion="out",
-            key="Dataset name",
-            values=args.exclude,
-        )
-    if args.include_projects != []:
-        df = filter_df(
-            df,
-            criterion="in",
-            key="project_key",
-            values=args.include_projects,
-        )
-    if args.exclude_projects != []:
-        df = filter_df(
-            df,
-            criterion="out",
-            key="project_key",
-            values=args.exclude_projects,
-        )
-    if args.include_tasks != []:
-        df = filter_df(
-            df,
-            criterion="in",
-            key="task_key",
-            values=args.include_tasks,
-        )
-    if args.exclude_tasks != []:
-        df = filter_df(
-            df,
-            criterion="out",
-            key="task_key",
-            values=args.exclude_tasks,
-        )
+    from selection import select # Deferred with numpy and pandas
+    return select(
+        df,
+        rules=[
+            ("Dataset name", args.include, args.exclude),
+            ("Project", args.include_projects, args.exclude_projects),
+            ("Task", args.include_tasks, args.exclude_tasks),
+        ],
+    )
+
+
 
+def probe_sizes(
+    df,
+    args,
+):
+    # Fills the "Size" of the URLs and the "Total size" of the datasets from concurrent
+    # HEAD / Range 0-0 probes, cached in the status index
+    import numpy as np
+    import pandas as pd
+    from catalog import urls_of
+    from catalog import per_dataset
+    df = df.copy()
+    urls = urls_of(df, args.urls)
+    unique = sorted(urls["URL"].unique())
+    with StatusIndex(args.index_path) as index:
+        args.probes = index.cached_probes(unique)
+        missing = [url for url in unique if url not in args.probes]
+        if missing and not args.offline:
+            console.log(f"[table.caption]Probing the size of[/table.caption] {len(missing)} [table.caption]file(s) ...[/table.caption]")
+            with Progress(console=console) as progress:
+                task = progress.add_task("Probing", total=len(missing))
+                probes = probe_urls(
+                    missing,
+                    args.workers,
+                    on_probed=lambda url, probe: progress.update(task, advance=1),
+                )
+            index.record_probes(probes)
+            args.probes.update(probes)
+
+    sizes = pd.Series({url: size for url, (size, _) in args.probes.items()}, dtype="int64")
+    size = urls["URL"].map(sizes).fillna(-1).to_numpy(np.int64)
+    args.urls.loc[urls.index, "Size"] = size
+    df["Total size"] = per_dataset(df, np.maximum(size, 0), urls["dataset"]).to_numpy(np.int64)
+    return df
+
+
+
+def get_footprints(
+    df,
+    args,
+    index,
+):
+    # Peak number of bytes each dataset still needs on scratch : the files left to download,
+    # plus the extracted content of the archives that are not extracted yet
+    import numpy as np
+    from catalog import urls_of
+    from catalog import lookup
+    from catalog import per_dataset
+    urls = urls_of(df, args.urls)
+    stages = {dataset: stage for dataset, stage, *_ in index.datasets()}
+    extracted = np.array([stages.get(key) in EXTRACTED_STAGES for key in lookup(df, urls, "Key")], dtype=bool)
+    size = np.maximum(urls["Size"].to_numpy(), 0)
+    archive = urls["is_archive"].to_numpy()
+    streamed = archive & bool(args.stream_extract)
+    present = urls["Destination"].map(os.path.exists).to_numpy(bool)
+    footprint = np.where(~streamed & ~present, size, 0)
+    footprint += np.where(archive & ~extracted & (streamed | as_bool(args.unzip)), (size * args.expansion_factor).astype(np.int64), 0)
+    return per_dataset(df, footprint, urls["dataset"]).to_numpy(np.int64)
+
+
+
+def admit_datasets(
+    df,
+    args,
+):
+    # Splits `df` into the datasets that fit in the space left on scratch and those held back.
+    # The space already promised to datasets not extracted yet, by the other shards and jobs
+    # on this scratch and by our own earlier waves, is not available : the budget is taken
+    # and reserved under one lock.
+    with StatusIndex(args.index_path) as index:
+        footprints = get_footprints(df, args, index).tolist()
+    with scratch_lock(args, args.reservations.path):
+        reserved = args.reservations.total()
+        budget = max(0, headroom(args.datasets_dir, args.reserve) - reserved)
+        order = sorted(range(len(df)), key=lambda i: -footprints[i])
+        admitted = sorted(order[i] for i in admit([footprints[i] for i in order], budget))
+        args.reservations.reserve({df["Key"].iloc[i]: footprints[i] for i in admitted})
+
+    df_admitted = df.iloc[admitted]
+    df_held = df.drop(df_admitted.index)
+    console.log(f"[table.caption]Admitted[/table.caption] {len(df_admitted)} [table.caption]dataset(s) needing[/table.caption] {sum(footprints[i] for i in admitted) / 1024 ** 3:.1f} [table.caption]GB out of[/table.caption] {budget / 1024 ** 3:.1f} [table.caption]GB available[/table.caption] [table.caption]([/table.caption]{reserved / 1024 ** 3:.1f} [table.caption]GB reserved for datasets not extracted yet)[/table.caption]")
+    if len(df_held):
+        console.log(f"[table.caption]Holding back[/table.caption] {len(df_held)} [table.caption]dataset(s) until space is reclaimed[/table.caption]")
+    return df_admitted, df_held
+
+
+
+def release_datasets(
+    df,
+    args,
+):
+    # Once a wave is through, what its datasets wrote shows in the free space : only the
+    # archives still waiting for extraction keep their space reserved
+    with StatusIndex(args.index_path) as index:
+        footprints = get_footprints(df, args, index).tolist()
+    failed = df["Status"].eq(STATUSES['error']).to_numpy()
+    with scratch_lock(args, args.reservations.path):
+        args.reservations.reserve({key: 0 if error else footprint for key, footprint, error in zip(df["Key"], footprints, failed)})
+
+
+
+def shard_datasets(
+    df,
+    args,
+):
+    if args.num_shards <= 1:
+        return df
+    sizes = share_sizes(
+        sizes_path(args.report_dir),
+        args.shard,
+        dict(zip(df["Key"].tolist(), df["Total size"].tolist())),
+    )
+    if sizes is None:
+        console.log("[logging.level.warning]No sizes from shard 0 : sharding on the hash of the dataset keys[/logging.level.warning]")
+    shards = assign_keys(
+        sizes,
+        df["Key"].tolist(),
+        args.num_shards,
+    )
+    df = df[[shard == args.shard for shard in shards]]
+    console.log(f"[table.caption]Shard[/table.caption] {args.shard}/{args.num_shards} [table.caption]handles[/table.caption] {len(df)} [table.caption]dataset(s)[/table.caption]")
     return df
 
 
@@ -360,6 +800,184 @@ def update_statuses(
     df,
     args,
 ):
+    import numpy as np
+    df = df.copy()
+    manual = df["is_manual"].to_numpy()
+    with StatusIndex(args.index_path) as index:
+        if args.rescan:
+            console.log("[logging.level.info]Rescanning the indexed datasets ...[/logging.level.info]")
+            changed = index.rescan(args.workers)
+            console.log(f"[table.caption]Rescan done,[/table.caption] {len(changed)} [table.caption]dataset(s) changed on disk[/table.caption]")
+        failed = verify_datasets(df, args, index) if args.verify else set()
+        statuses = np.array([index.resolve(key) for key in df["Key"]], dtype=object)
+        unverified = get_unverified(df, args, index)
+    statuses[(statuses == "downloaded") & unverified] = "warning"
+    statuses[df["Key"].isin(failed).to_numpy()] = "error"
+    df.loc[~manual, "Status"] = [STATUSES[status] for status in statuses[~manual]]
+    return df
+
+
+
+def sync_datasets(
+    df,
+    args,
+):
+    # Fills the datasets that are not downloaded yet from a mirror tree (the datasets/ folder
+    # of a colleague's scratch or of a group share), only transferring the blocks that differ.
+    # A dataset recorded in the mirror's status index is synced with every entry it has there,
+    # extracted trees included, any other one with the files of its URLs.
+    if args.mirror is None:
+        return df
+    import numpy as np
+    from catalog import urls_of
+    from catalog import lookup
+    from catalog import set_status
+    from catalog import SYNCED
+    from mirror import sync_trees
+    todo = ~df["is_manual"].to_numpy() & df["Status"].ne(STATUSES['downloaded']).to_numpy()
+    pairs, sources, stages = {}, {}, {}
+    mirror_index = os.path.join(args.mirror, INDEX_FILENAME)
+    if os.path.exists(mirror_index):
+        with StatusIndex(mirror_index, read_only=True) as index:
+            for key, project, task in zip(df["Key"][todo], df["Project"][todo], df["Task"][todo]):
+                record = index.get(key)
+                if record is None:
+                    continue
+                # Entries hold the absolute paths of the mirror's own machine : only what
+                # follows <project>/<task>/ is kept
+                marker = os.sep + os.path.join(str(project), str(task), "")
+                for path, *_ in index.entries(key):
+                    cut = path.find(marker)
+                    if cut >= 0:
+                        relpath = path[cut + 1:]
+                        pairs[os.path.join(args.mirror, relpath)] = os.path.join(args.datasets_dir, relpath)
+                        sources.setdefault(key, []).append(os.path.join(args.mirror, relpath))
+                stages[key] = record["stage"]
+
+    urls = urls_of(df[todo], args.urls)
+    keys = lookup(df, urls, "Key")
+    incomplete = set()
+    for key, destination in zip(keys, urls["Destination"]):
+        if key in stages:
+            continue
+        source = os.path.join(args.mirror, os.path.relpath(destination, args.datasets_dir))
+        if not os.path.lexists(source):
+            incomplete.add(key)
+            continue
+        pairs[source] = destination
+        sources.setdefault(key, []).append(source)
+    checksums = get_checksums(urls)
+    targets = set(pairs.values())
+    expected = {destination: checksums[url] for url, destination in zip(urls["URL"], urls["Destination"]) if url in checksums and destination in targets}
+
+    console.log(f"[table.caption]Syncing[/table.caption] {len(sources)} [table.caption]dataset(s) from the mirror[/table.caption] {args.mirror} [table.caption]...[/table.caption]")
+    with Progress(console=console) as progress:
+        task = progress.add_task("Syncing", total=None)
+        stats, errors = sync_trees(
+            list(pairs.items()),
+            args.workers,
+            block_size=args.block_size,
+            on_synced=lambda path, stats: progress.update(task, advance=1),
+        )
+    args.metrics.add("sync_matched_bytes_total", stats.matched)
+    args.metrics.add("sync_literal_bytes_total", stats.literal)
+    console.log(f"[table.caption]Synced[/table.caption] {stats.n_files} [table.caption]file(s) :[/table.caption] {stats.n_skipped} [table.caption]unchanged,[/table.caption] {stats.n_patched} [table.caption]patched,[/table.caption] {stats.n_copied} [table.caption]copied ;[/table.caption] {decimal(stats.matched)} [table.caption]reused and[/table.caption] {decimal(stats.literal)} [table.caption]transferred[/table.caption]")
+
+    # A synced archive that does not match its checksum is removed and downloaded again
+    digests = hash_files([(path, algorithm) for path, (algorithm, _) in expected.items() if os.path.exists(path)], args.workers)
+    for source, destination in pairs.items():
+        if destination in digests and digests[destination] != expected[destination][1]:
+            console.log(f"[logging.level.error]Checksum mismatch for the mirrored file[/logging.level.error] {source}")
+            errors[source] = ValueError("checksum mismatch")
+            os.remove(destination)
+
+    df = df.copy()
+    synced = {key for key, paths in sources.items() if key not in incomplete and not errors.keys() & set(paths)}
+    with StatusIndex(args.index_path) as index:
+        for path, digest in digests.items():
+            if path in expected and digest == expected[path][1]:
+                index.record_verified(path, *expected[path])
+        for key in synced:
+            index.record(
+                key,
+                [pairs[source] for source in sources[key]],
+                stage=stages.get(key, "downloaded"),
+            )
+    set_status(df, df["Key"].isin(synced).to_numpy(), STATUSES['downloaded'])
+    done = np.isin(keys, list(synced))
+    args.urls.loc[urls.index[done], "State"] = SYNCED
+    return df
+
+
+
+def fetch_cached(
+    urls,
+    cache,
+    checksums,
+):
+    # Places the URLs the shared cache already holds at their destination. Returns
+    # {destination: sha256}. A payload that does not match the expected sha256 is a miss.
+    hits = {}
+    for url, destination in zip(urls["URL"], urls["Destination"]):
+        obj = cache.lookup(url)
+        if obj is None:
+            continue
+        digest = os.path.basename(obj)
+        algorithm, expected = checksums.get(url, (DEFAULT_ALGORITHM, digest))
+        if algorithm == DEFAULT_ALGORITHM and expected != digest:
+            continue
+        try:
+            cache.materialize(obj, destination)
+        except OSError as e:
+            console.log(f"[logging.level.error]Failed to materialize[/logging.level.error] {url} [logging.level.error]from the shared cache :[/logging.level.error] {e}")
+            continue
+        hits[destination] = digest
+    return hits
+
+
+
+def cache_downloads(
+    jobs,
+    followers,
+    errors,
+    verified,
+    cache,
+    workers,
+):
+    # Stores the files downloaded without error in the shared cache, keyed by their sha256
+    # (taken from the checksum verification when it was one), then places them at the
+    # other destinations of their URL. Returns (bytes stored, {destination: exception} of
+    # the destinations that could not be placed).
+    known = {destination: digest for _, destination, algorithm, digest in verified if algorithm == DEFAULT_ALGORITHM}
+    done = [(url, destination) for url, destination in jobs if errors.get(url) is None and os.path.isfile(destination)]
+    digests = hash_files([(destination, DEFAULT_ALGORITHM) for _, destination in done if destination not in known], workers)
+    digests.update(known)
+    stored, sources = 0, {}
+    for url, destination in done:
+        if not isinstance(digests.get(destination), str):
+            continue
+        try:
+            cache.ingest(url, destination, digests[destination])
+        except OSError as e:
+            console.log(f"[logging.level.error]Failed to store[/logging.level.error] {url} [logging.level.error]in the shared cache :[/logging.level.error] {e}")
+            continue
+        sources[url] = destination
+        stored += os.path.getsize(destination)
+    missing, fetched = {}, dict(done)
+    for url, destination in followers:
+        if errors.get(url) is not None:
+            continue # Failed with its URL
+        try:
+            if url in sources:
+                cache.materialize(cache.lookup(url) or sources[url], destination)
+            elif url in fetched:
+                shutil.copyfile(fetched[url], destination) # Downloaded but not stored
+            else:
+                raise FileNotFoundError(f"{url} was not downloaded")
+        except OSError as e:
+            console.log(f"[logging.level.error]Failed to place[/logging.level.error] {url} [logging.level.error]at[/logging.level.error] {destination} : {e}")
+            missing[destination] = e
+    return stored, missing
 
 
 
@@ -367,6 +985,180 @@ def download_datasets(
     df,
     args,
 ):
+    import numpy as np
+    from catalog import urls_of
+    from catalog import lookup
+    from catalog import per_dataset
+    from catalog import set_status
+    from catalog import DOWNLOADED
+    from catalog import STREAMED
+    from catalog import FAILED
+    from catalog import INTERRUPTED
+    from catalog import SKIPPED
+    from catalog import CACHED
+    todo = ~df["is_manual"].to_numpy() & df["Status"].ne(STATUSES['downloaded']).to_numpy()
+    # Largest first, for the backends that do not split files into segments themselves
+    urls = urls_of(df[todo], args.urls).sort_values("Size", ascending=False, kind="stable")
+    checksums = get_checksums(urls)
+    datasets = dict(zip(urls["URL"], lookup(df, urls, "Key")))
+    streamable = urls["is_archive"].to_numpy() & bool(args.stream_extract)
+
+    # URLs already fetched by any project come from the shared cache, without any transfer
+    cache, hits, verified, missing = None, {}, [], {}
+    if args.shared_cache is not None:
+        cache = SharedCache(
+            args.shared_cache,
+            max_size=None if args.shared_cache_size is None else int(args.shared_cache_size * 1e9),
+            method=args.materialize,
+        )
+        hits = fetch_cached(urls, cache, checksums)
+        verified.extend((url, destination, DEFAULT_ALGORITHM, hits[destination]) for url, destination in zip(urls["URL"], urls["Destination"]) if destination in hits)
+        args.metrics.add("cache_hits_total", len(hits))
+        args.metrics.add("cache_bytes_total", sum(os.path.getsize(destination) for destination in hits))
+        console.log(f"[table.caption]Found[/table.caption] {len(hits)} [table.caption]file(s) in the shared cache[/table.caption] {args.shared_cache}")
+
+    # When several nodes share the work, a lock file per URL makes sure only one of them fetches it
+    locks = UrlLocks(args.lock_dir) if args.num_shards > 1 else contextlib.nullcontext()
+    with locks, Progress(console=console) as progress:
+        jobs, stream_jobs, skipped, followers, leaders = [], [], set(), [], set()
+        for url, destination, stream in zip(urls["URL"], urls["Destination"], streamable):
+            if destination in hits:
+                continue
+            # With the shared cache, a URL listed by several datasets is only fetched once
+            if cache is not None and url in leaders:
+                followers.append((url, destination))
+            elif args.num_shards > 1 and not locks.acquire(url):
+                skipped.add(url)
+            # In streaming mode, archives are extracted on the fly and never written to disk
+            elif stream:
+                stream_jobs.append((url, os.path.dirname(destination)))
+            else:
+                jobs.append((url, destination))
+                leaders.add(url)
+
+        limiter = TokenBucket(args.max_rate * 1e6 if args.max_rate is not None else args.BANDWIDTH_LIMIT * 1024)
+        # With --adaptive, --workers (threads) or --per_host (asyncio) are only the ceiling
+        workers = args.workers if args.multiprocessing or args.adaptive else 1
+        console.log(f"[table.caption]Downloading[/table.caption] {len(jobs) + len(stream_jobs)} [table.caption]file(s) with[/table.caption] {workers} [table.caption]worker(s) ...[/table.caption]")
+        if skipped:
+            console.log(f"[table.caption]Skipping[/table.caption] {len(skipped)} [table.caption]file(s) locked by another node[/table.caption]")
+
+        done, done_lock = collections.Counter(), threading.Lock()
+        def on_fetched(
+            url,
+            size,
+            *timings,
+        ):
+            with done_lock:
+                done[url] += size
+            args.metrics.observe_fetch(url, size, *timings)
+            notify(args, datasets[url], advance=size)
+
+        task = progress.add_task("Downloading", total=None)
+        controller = None
+        if args.adaptive:
+            def on_decision(
+                host,
+                old,
+                new,
+                throughput,
+                reason,
+            ):
+                console.log(f"|[red]{host}[/red]| [table.caption]Connections[/table.caption] {old} → {new} [table.caption]at[/table.caption] {decimal(int(throughput))}/s [table.caption]:[/table.caption] {reason}")
+                progress.update(task, description="Downloading (" + ", ".join(f"{h} ×{n}" for h, n in controller.limits().items()) + ")")
+                args.metrics.event("concurrency", host=host, old=old, new=new, throughput=throughput, reason=reason)
+            controller = AdaptiveConcurrency(
+                initial=min(ADAPTIVE_INITIAL, workers),
+                maximum=args.per_host if args.backend == "asyncio" else workers,
+                max_rate=limiter.rate,
+                on_decision=on_decision,
+            )
+        streamed = stream_extract_urls(
+            stream_jobs,
+            workers,
+            limiter,
+            on_progress=lambda n: progress.update(task, advance=n),
+            checksums=checksums,
+        )
+        if args.backend == "asyncio":
+            errors = download_urls_async(
+                [(url, destination, datasets[url]) for url, destination in jobs],
+                limiter,
+                per_host=args.per_host,
+                per_dataset=args.per_dataset,
+                on_progress=lambda n: progress.update(task, advance=n),
+                checksums=checksums,
+                on_verified=lambda *v: verified.append(v),
+                on_fetched=on_fetched,
+                controller=controller,
+            )
+        else:
+            errors = download_urls(
+                jobs,
+                workers,
+                limiter,
+                segment_size=args.segment_size,
+                max_segments=args.max_segments,
+                on_planned=lambda total: progress.update(task, total=total or None),
+                on_progress=lambda n: progress.update(task, advance=n),
+                checksums=checksums,
+                on_verified=lambda *v: verified.append(v),
+                probes=args.probes,
+                on_fetched=on_fetched,
+                controller=controller,
+            )
+    errors.update({url: result[0] for url, result in streamed.items()})
+    if cache is not None:
+        stored, missing = cache_downloads(jobs, followers, errors, verified, cache, args.workers)
+        n_evicted, freed = cache.evict()
+        n_objects, size = cache.usage()
+        console.log(f"[table.caption]Stored[/table.caption] {decimal(stored)} [table.caption]in the shared cache, evicted[/table.caption] {n_evicted} [table.caption]payload(s) ([/table.caption]{decimal(freed)}[table.caption]) : it holds[/table.caption] {n_objects} [table.caption]payload(s),[/table.caption] {decimal(size)}")
+
+    # Per-URL states, then folded into one status per dataset
+    failed = {url for url, e in errors.items() if e is not None}
+    interrupted = {url for url, e in errors.items() if isinstance(e, TransferInterrupted)}
+    state = np.select(
+        [urls["Destination"].isin(hits.keys()), urls["URL"].isin(skipped), urls["URL"].isin(interrupted), urls["URL"].isin(failed) | urls["Destination"].isin(missing.keys()), urls["URL"].isin(streamed.keys())],
+        [CACHED, SKIPPED, INTERRUPTED, FAILED, STREAMED],
+        DOWNLOADED,
+    ).astype(np.int8)
+    args.urls.loc[urls.index, "State"] = state
+    args.urls.loc[urls.index, "Done"] = urls["URL"].map(done).fillna(0).to_numpy(np.int64)
+
+    df = df.copy()
+    n_errors = per_dataset(df, (state == FAILED) | (state == INTERRUPTED), urls["dataset"]).to_numpy()
+    n_interrupted = per_dataset(df, state == INTERRUPTED, urls["dataset"]).to_numpy()
+    any_skipped = per_dataset(df, state == SKIPPED, urls["dataset"], how="any", fill_value=False).to_numpy(bool)
+    all_streamed = per_dataset(df, state == STREAMED, urls["dataset"], how="all", fill_value=True).to_numpy(bool)
+    warning = df["Status"].ne(STATUSES['downloaded']).to_numpy() & (df["is_manual"].to_numpy() | any_skipped | ((n_errors > 0) & (n_errors == n_interrupted)))
+    error = todo & ~warning & (n_errors > 0)
+    downloaded = todo & ~warning & ~error
+    set_status(df, warning, STATUSES['warning'])
+    set_status(df, error, STATUSES['error'])
+    set_status(df, downloaded, STATUSES['downloaded'])
+    notify_statuses(df, todo, args)
+
+    groups = urls.groupby("dataset").indices
+    with StatusIndex(args.index_path) as index:
+        for url, destination, algorithm, digest in verified:
+            index.record_verified(destination, algorithm, digest)
+        for dataset, key, extracted in zip(df.index[downloaded], df["Key"][downloaded], all_streamed[downloaded]):
+            paths = []
+            for i in groups.get(dataset, []):
+                url, destination = urls["URL"].iat[i], urls["Destination"].iat[i]
+                paths.extend(streamed[url][1] if url in streamed else [destination])
+            absent = [path for path in paths if not os.path.lexists(path)]
+            if absent:
+                console.log(f"[logging.level.error]Missing payload for[/logging.level.error] {key} : {', '.join(absent)}")
+                set_status(df, df.index == dataset, STATUSES['error'])
+                notify(args, key, status=STATUSES['error'])
+                continue
+            index.record(
+                key, 
+                paths, 
+                stage="extracted" if extracted else "downloaded",
+            )
+    return df
 
 
 
@@ -374,6 +1166,102 @@ def extract_datasets(
     df,
     args,
 ):
+    import numpy as np
+    from catalog import urls_of
+    from catalog import set_status
+    df = df.copy()
+    if not as_bool(args.unzip) and not args.extract_glob:
+        return df
+
+    with StatusIndex(args.index_path) as index:
+        stages = {dataset: stage for dataset, stage, *_ in index.datasets()}
+        candidates = df["Status"].eq(STATUSES['downloaded']).to_numpy() & ~df["Key"].map(stages).isin(EXTRACTED_STAGES).to_numpy()
+        archives = get_archives(urls_of(df[candidates], args.urls))
+        pending = df.loc[np.unique(archives["dataset"])]
+        results = unzip_handler(pending, args)
+
+        groups = archives.groupby("dataset").indices
+        failed = np.zeros(len(df), dtype=bool)
+        for position, (dataset, key) in enumerate(zip(pending.index, pending["Key"])):
+            paths_of = [archives["Destination"].iat[i] for i in groups[dataset]]
+            if any(results[a][0] is not None for a in paths_of):
+                failed[df.index.get_loc(dataset)] = True
+                continue
+            if as_bool(args.delete_zip) and not args.extract_glob:
+                zip_delete_handler(pending.iloc[[position]], args)
+            paths = [path for path, *_ in index.entries(key) if os.path.lexists(path)]
+            for a in paths_of:
+                paths.extend(results[a][1])
+            # A partial extraction is done again with the globs of the next runs
+            index.record(key, sorted(set(paths)), stage="partial" if args.extract_glob else "extracted")
+    set_status(df, failed, STATUSES['error'])
+    notify_statuses(df, failed, args)
+    return df
+
+
+
+def pack_datasets(
+    df,
+    args,
+):
+    # Rewrites each extracted dataset into a few large shard files with an offset index
+    # (<Project>/<Task>/<Dataset name>.pack/, read with packing.PackReader), so that data
+    # loaders open a handful of files instead of millions
+    if not args.pack:
+        return df
+    import numpy as np
+    from catalog import set_status
+    from packing import pack_tree
+    from packing import is_packed
+    df = df.copy()
+    with StatusIndex(args.index_path) as index:
+        stages = {dataset: stage for dataset, stage, *_ in index.datasets()}
+        candidates = df["Status"].eq(STATUSES['downloaded']).to_numpy() & df["Key"].map(stages).eq("extracted").to_numpy()
+        pending = df[candidates]
+        console.log(f"[table.caption]Packing[/table.caption] {len(pending)} [table.caption]dataset(s) into shards of[/table.caption] {decimal(int(args.pack_shard_size * 1e9))} [table.caption]...[/table.caption]")
+        failed = np.zeros(len(df), dtype=bool)
+        with Progress(console=console) as progress:
+            task = progress.add_task("Packing", total=None)
+            for dataset, key, project, task_name, name in zip(pending.index, pending["Key"], pending["Project"], pending["Task"], pending["Dataset name"]):
+                if STOP.is_set():
+                    break # Preempted : the datasets left are packed by the next run
+                base = os.path.join(args.datasets_dir, str(project), str(task_name))
+                pack_dir = os.path.join(base, f"{name}{PACK_SUFFIX}")
+                # The extracted trees only : archives kept next to them are left as they are
+                entries = [path for path, *_ in index.entries(key) if os.path.lexists(path) and path != pack_dir]
+                archives = [path for path in entries if os.path.isfile(path) and is_archive(path)]
+                roots = [path for path in entries if path not in archives]
+                # Only paths strictly below the task directory are packed, let alone deleted
+                real_base = os.path.realpath(base)
+                outside = [path for path in roots if os.path.realpath(path) == real_base or os.path.commonpath([os.path.realpath(path), real_base]) != real_base]
+                if outside:
+                    console.log(f"[logging.level.error]Refusing to pack[/logging.level.error] {key} : {', '.join(outside)} [logging.level.error]not strictly inside[/logging.level.error] {base}")
+                    failed[df.index.get_loc(dataset)] = True
+                    continue
+                try:
+                    if not is_packed(pack_dir):
+                        stats = pack_tree(
+                            roots,
+                            base,
+                            pack_dir,
+                            shard_size=int(args.pack_shard_size * 1e9),
+                            workers=args.workers,
+                            on_packed=lambda n: progress.update(task, advance=n),
+                        )
+                        args.metrics.add("packed_files_total", stats.n_files)
+                        args.metrics.add("packed_bytes_total", stats.size)
+                except OSError as e:
+                    console.log(f"[logging.level.error]Failed to pack[/logging.level.error] {key} : {e}")
+                    failed[df.index.get_loc(dataset)] = True
+                    continue
+                if args.delete_packed:
+                    remove_trees(roots, args.workers)
+                    roots = []
+                index.record(key, sorted(archives + roots + [pack_dir]), stage="packed")
+                notify(args, key, status="packed")
+    set_status(df, failed, STATUSES['error'])
+    notify_statuses(df, failed, args)
+    return df
 
 
 
@@ -381,6 +1269,42 @@ def summary(
     df,
     args,
 ):
+    counts = df["Status"].value_counts()
+    console.log("[table.caption]Datasets :[/table.caption] " + ", ".join(f"{status} {counts.get(status, 0)}" for status in STATUSES.values()))
+    if args.shard != 0:
+        return # Every shard would walk the same scratch
+
+    # Per-project disk usage of scratch, compared with the inventory of the previous run
+    with StatusIndex(args.index_path) as index:
+        cached = index.entry_stats(args.workers)
+    previous = latest_inventory(args.inventory_dir) or {"categories": {}}
+    console.log(f"[table.caption]Taking the inventory of[/table.caption] {args.scratch_dir} [table.caption]...[/table.caption]")
+    report = inventory(
+        args.scratch_dir,
+        cached,
+        args.workers,
+    )
+    path = write_inventory(
+        args.inventory_dir,
+        report,
+    )
+
+    table = Table(title=f"Usage of {args.scratch_dir} : {decimal(report['total']['size'])} in {report['total']['n_files']:,} file(s)")
+    for column in ("Category", "Project", "Files", "Size", "Growth"):
+        table.add_column(column, justify="left" if column in ("Category", "Project") else "right")
+    for category, usage in report["categories"].items():
+        before = previous["categories"].get(category, {}).get("projects", {})
+        for project, project_usage in usage["projects"].items():
+            growth = project_usage["size"] - before.get(project, {}).get("size", 0)
+            table.add_row(
+                category,
+                project,
+                f"{project_usage['n_files']:,}",
+                decimal(project_usage["size"]),
+                ("+" if growth >= 0 else "-") + decimal(abs(growth)),
+            )
+    console.print(table)
+    console.log(f"[table.caption]Wrote the inventory to[/table.caption] {path}")
 
 
 
@@ -393,38 +1317,38 @@ if __name__ == "__main__":
     group_parser = parser.add_argument_group("Download-related options")
     group_parser.add_argument(
         "--include", 
-        help="Specific datasets to exclude (only those given in argument will be downloaded)",
-        type=list,
+        help="Specific datasets to include (only those given in argument will be downloaded). Accepts glob patterns and 're:<regex>'",
+        nargs="*",
         default=INCLUDE,
     )
     group_parser.add_argument(
         "--exclude", 
-        help="Specific datasets to exclude (all other datasets will be downloaded)",
-        type=list,
+        help="Specific datasets to exclude (all other datasets will be downloaded). Accepts glob patterns and 're:<regex>'",
+        nargs="*",
         default=EXCLUDE,
     )
     group_parser.add_argument(
         "--include_tasks", 
-        help="Specific tasks to include (only those given in argument will be downloaded)",
-        type=list,
+        help="Specific tasks to include (only those given in argument will be downloaded). Accepts glob patterns and 're:<regex>'",
+        nargs="*",
         default=INCLUDE_TASKS,
     )
     group_parser.add_argument(
         "--exclude_tasks", 
-        help="Specific tasks to exclude (all other tasks' datasets will be downloaded)",
-        type=list,
+        help="Specific tasks to exclude (all other tasks' datasets will be downloaded). Accepts glob patterns and 're:<regex>'",
+        nargs="*",
         default=EXCLUDE_TASKS,
     )
     group_parser.add_argument(
         "--include_projects", 
-        help="Specific project to include (only those given in argument will be downloaded)",
-        type=list,
+        help="Specific project to include (only those given in argument will be downloaded). Accepts glob patterns and 're:<regex>'",
+        nargs="*",
         default=INCLUDE_PROJECTS,
     )
     group_parser.add_argument(
         "--exclude_projects", 
-        help="Specific project to exclude (all other projects' datasets will be downloaded)",
-        type=list,
+        help="Specific project to exclude (all other projects' datasets will be downloaded). Accepts glob patterns and 're:<regex>'",
+        nargs="*",
         default=EXCLUDE_PROJECTS,
     )
     group_parser.add_argument(
@@ -439,6 +1363,78 @@ if __name__ == "__main__":
         type=str,
         default=UNZIP,
     )
+    group_parser.add_argument(
+        "--extract_glob", "--extract-glob", 
+        help="Only extract the archive members matching these glob patterns (e.g. 'images/train/*'), through a member index persisted beside each archive, and keep the archives",
+        nargs="*",
+        default=EXTRACT_GLOB,
+    )
+    group_parser.add_argument(
+        "--expansion_factor", 
+        help="Estimated ratio between the extracted size and the archive size, used to admit datasets on scratch",
+        type=float,
+        default=EXPANSION_FACTOR,
+    )
+    group_parser.add_argument(
+        "--reserve", 
+        help="Space (in GB) always left free on scratch : datasets are held back once downloading them would cross it",
+        type=float,
+        default=RESERVE,
+    )
+    group_parser.add_argument(
+        "--stream_extract", 
+        help="Extract tar archives while they download (zip archives go through a bounded spool), without keeping the archive on disk",
+        action="store_true",
+        default=STREAM_EXTRACT,
+    )
+    group_parser.add_argument(
+        "--mirror", 
+        help="Sync the datasets from this mirror tree first (the 'datasets/' folder of another scratch or a group share), transferring only the blocks that differ",
+        type=str,
+        default=MIRROR,
+    )
+    group_parser.add_argument(
+        "--block_size", 
+        help="Block size (in bytes) of the delta sync from the mirror",
+        type=int,
+        default=SYNC_BLOCK_SIZE,
+    )
+    group_parser.add_argument(
+        "--shared_cache", 
+        help="Content-addressed cache shared by every project (e.g. a group path) : each URL is downloaded once and placed in the project/task folders from there",
+        type=str,
+        default=SHARED_CACHE,
+    )
+    group_parser.add_argument(
+        "--shared_cache_size", 
+        help="Size cap (in GB) of the shared cache : the least recently used payloads that no project holds any more are evicted past it",
+        type=float,
+        default=SHARED_CACHE_SIZE,
+    )
+    group_parser.add_argument(
+        "--materialize", 
+        help="How payloads of the shared cache are placed in the project/task folders (falling back to the next method when the filesystem refuses)",
+        choices=MATERIALIZE_METHODS,
+        default=MATERIALIZE,
+    )
+    group_parser.add_argument(
+        "--pack", 
+        help="Pack each extracted dataset into large shard files with an offset index ('<Dataset name>.pack/'), read through mmap with packing.PackReader",
+        action="store_true",
+        default=PACK,
+    )
+    group_parser.add_argument(
+        "--pack_shard_size", 
+        help="Size (in GB) of the shard files of the packed datasets",
+        type=float,
+        default=PACK_SHARD_SIZE,
+    )
+    group_parser.add_argument(
+        "--delete_packed", 
+        help="Delete the extracted files of a dataset once they are packed",
+        action="store_true",
+        default=DELETE_PACKED,
+    )
 
 
     group_parser = parser.add_argument_group("Actions")
@@ -484,21 +1480,39 @@ if __name__ == "__main__":
     group_parser.add_argument(
         "--clean_checkpoints", 
         help="Cleans the 'checkpoints/' subfolder. If no value is provided, cleans checkpoints for all projects. Otherwise, only cleans checkpoints for the selected projects.",
-        type=list,
+        nargs="*",
         default=CLEAN_CHECKPOINTS,
     )
     group_parser.add_argument(
         "--clean_logs", 
         help="Cleans the 'logs/' subfolder. If no value is provided, cleans logs for all projects. Otherwise, only cleans logs for the selected projects.",
-        type=list,
+        nargs="*",
         default=CLEAN_LOGS,
     )
     group_parser.add_argument(
         "--clean_outputs", 
         help="Cleans the 'outputs/' subfolder. If no value is provided, cleans outputs for all projects. Otherwise, only cleans outputs for the selected projects.",
-        type=list,
+        nargs="*",
         default=CLEAN_OUTPUTS,
     )
+    group_parser.add_argument(
+        "--keep_last", 
+        help="Retention policy : only keep the N most recent entries (checkpoints, log files, ...) of each run",
+        type=int,
+        default=KEEP_LAST,
+    )
+    group_parser.add_argument(
+        "--max_age", 
+        help="Retention policy : delete the entries older than this number of days",
+        type=float,
+        default=MAX_AGE,
+    )
+    group_parser.add_argument(
+        "--max_size", 
+        help="Retention policy : delete the oldest entries once a project exceeds this size (in GB)",
+        type=float,
+        default=MAX_SIZE,
+    )
 
 
     group_parser = parser.add_argument_group("Path-related options")
@@ -510,6 +1524,32 @@ if __name__ == "__main__":
     )
 
 
+    group_parser.add_argument(
+        "--rescan", 
+        help="Validate the persistent status index against the filesystem with a parallel walk",
+        action="store_true",
+        default=RESCAN,
+    )
+    group_parser.add_argument(
+        "--status", 
+        help="Print the indexed status of every dataset and exit, without loading the spreadsheet (fast, for job prologues and shell prompts)",
+        action="store_true",
+        default=STATUS,
+    )
+    group_parser.add_argument(
+        "--list", 
+        help="List the members of the archives kept on scratch (filtered by --extract_glob) and exit, without loading the spreadsheet",
+        action="store_true",
+        default=LIST,
+    )
+    group_parser.add_argument(
+        "--verify", 
+        help="Rehash the downloaded archives and extracted trees of the selected datasets in parallel",
+        action="store_true",
+        default=VERIFY,
+    )
+
+
     group_parser = parser.add_argument_group("Spreadsheet-related options")
     group_parser.add_argument(
         "--spreadsheet_id", 
@@ -523,6 +1563,24 @@ if __name__ == "__main__":
         type=str,
         default=SPREADSHEET_FILENAME,
     )
+    group_parser.add_argument(
+        "--spreadsheet_url", 
+        help="URL template of the CSV export, '{id}' being replaced by the spreadsheet ID (e.g. a local mirror for benchmarks)",
+        type=str,
+        default=SPREADSHEET_URL,
+    )
+    group_parser.add_argument(
+        "--cache_dir", 
+        help="Directory holding the validators of the spreadsheet and the processed snapshot of the index",
+        type=str,
+        default=CACHE_DIR,
+    )
+    group_parser.add_argument(
+        "--offline", 
+        help="Use the cached spreadsheet without contacting Google Drive",
+        action="store_true",
+        default=OFFLINE,
+    )
 
 
     group_parser = parser.add_argument_group("Visual options")
@@ -540,40 +1598,120 @@ if __name__ == "__main__":
     )
 
 
+    group_parser = parser.add_argument_group("Multi-node options")
+    group_parser.add_argument(
+        "--shard", 
+        help="Index of this node's shard (defaults to SLURM_ARRAY_TASK_ID or SLURM_PROCID)",
+        type=int,
+        default=SHARD,
+    )
+    group_parser.add_argument(
+        "--num_shards", 
+        help="Number of shards the selected datasets are split into (defaults to the SLURM array size or number of tasks)",
+        type=int,
+        default=NUM_SHARDS,
+    )
+
+
     group_parser = parser.add_argument_group("CPU-related options")
     group_parser.add_argument(
         "--multiprocessing", 
         help="Whether to use multiprocessing to accelerate the download process",
-        type=bool,
+        action=argparse.BooleanOptionalAction,
         default=MULTIPROCESSING,
     )
+    group_parser.add_argument(
+        "--backend", 
+        help="Download backend : 'threads' (segmented, resumable, best for large files) or 'asyncio' (one event loop, best for thousands of small files, requires aiohttp)",
+        type=str,
+        choices=["threads", "asyncio"],
+        default=BACKEND,
+    )
+    group_parser.add_argument(
+        "--per_host", 
+        help="Maximum number of concurrent connections per host with the asyncio backend",
+        type=int,
+        default=PER_HOST,
+    )
+    group_parser.add_argument(
+        "--per_dataset", 
+        help="Maximum number of concurrent transfers per dataset with the asyncio backend",
+        type=int,
+        default=PER_DATASET,
+    )
+    group_parser.add_argument(
+        "--workers", 
+        help="Number of concurrent connections used when --multiprocessing is set",
+        type=int,
+        default=WORKERS,
+    )
+    group_parser.add_argument(
+        "--processes", 
+        help="Number of processes used to extract archives (defaults to the CPUs allocated by SLURM)",
+        type=int,
+        default=PROCESSES,
+    )
     group_parser.add_argument(
         "--BANDWIDTH_LIMIT", 
-        help="Bandwidth limit per worker",
+        help="Global bandwidth limit shared by all workers, in KB/s (0 to disable)",
         type=int,
         default=BANDWIDTH_LIMIT,
     )
+    group_parser.add_argument(
+        "--max_rate", 
+        help="Global bandwidth cap in MB/s (0 to disable), overrides --BANDWIDTH_LIMIT",
+        type=float,
+        default=MAX_RATE,
+    )
+    group_parser.add_argument(
+        "--adaptive", 
+        help="Tune the connections per host at runtime from the observed throughput and throttling (AIMD), up to --workers (threads) or --per_host (asyncio), and show the decisions",
+        action="store_true",
+        default=ADAPTIVE,
+    )
+    group_parser.add_argument(
+        "--pool_size", 
+        help="Maximum number of keep-alive connections kept open per host",
+        type=int,
+        default=POOL_SIZE,
+    )
+    group_parser.add_argument(
+        "--retries", 
+        help="Number of retries, with exponential backoff and jitter, on connection errors and 429/5xx responses",
+        type=int,
+        default=RETRIES,
+    )
+    group_parser.add_argument(
+        "--segment_size", 
+        help="Files larger than this size (in bytes) are split into parallel HTTP Range segments",
+        type=int,
+        default=SEGMENT_SIZE,
+    )
+    group_parser.add_argument(
+        "--max_segments", 
+        help="Maximum number of parallel HTTP Range segments per file",
+        type=int,
+        default=MAX_SEGMENTS,
+    )
 
 
-    args, _ = parser.parse_known_args()
-
-    console.log(args)
+    group_parser = parser.add_argument_group("Instrumentation options")
+    group_parser.add_argument(
+        "--profile", 
+        help="Profile the stages with cProfile (.prof) or pyinstrument (.html), written to logs/de-profundis/profiles/",
+        type=str,
+        choices=PROFILERS,
+        default=PROFILE,
+    )
+    group_parser.add_argument(
+        "--profile_stages", 
+        help="Only profile these stages (spreadsheet, select, actions, update, sync, download, extract, pack, summary). All of them if empty.",
+        nargs="*",
+        default=PROFILE_STAGES,
+    )
 
 
-    # 1. Download the datasets_index spreadsheet
-    print(Panel(Text("1. Downloading the spreadsheet", justify="center")))
-    try:
-        download_file_from_google_drive(
-            args.spreadsheet_id, 
-            args.spreadsheet_filename,
-        )
-        df = pd.read_csv(
-            args.spreadsheet_filename, 
-            header=0,
-        )
-        console.log(f"Successfully downloaded the datasets spradsheet from Google Docs : ID={args.spreadsheet_id} -> {args.spreadsheet_filename}")
-    except:
-        raise Exception("SpreadsheetUnavailable")
+    args, _ = parser.parse_known_args()
 
     args.home_dir = os.path.join(HOME_DIR)
     args.root_dir = os.path.join(args.root)
@@ -597,12 +1735,82 @@ if __name__ == "__main__":
         args.scratch_dir, 
         "logs/",
     )
-    args.projects = PROJECTS
+    args.index_path = os.path.join(
+        args.datasets_dir, 
+        INDEX_FILENAME,
+    )
+    args.lock_dir = os.path.join(
+        args.scratch_dir, 
+        ".de-profundis/locks/",
+    )
+    args.report_dir = os.path.join(
+        args.logs_dir, 
+        "de-profundis/reports/",
+    )
+    args.inventory_dir = os.path.join(
+        args.logs_dir, 
+        "de-profundis/inventory/",
+    )
 
-    process_df(
-        df, 
-        args,
+    if args.status:
+        sys.exit(print_status(args))
+    if args.list:
+        sys.exit(list_members(args))
+
+    import pandas as pd # Deferred : only the pipeline below needs it
+    from catalog import locate
+    from catalog import set_status
+    setup_logging()
+    signal.signal(signal.SIGUSR1, handle_preemption)
+    configure_http(
+        pool_size=max(args.pool_size, args.workers),
+        retries=args.retries,
+    )
+
+    console.log(args)
+
+    args.projects = list_projects(args.home_dir)
+    args.metrics = Metrics(
+        os.path.join(args.logs_dir, "de-profundis/"),
+        run_id(),
+        args.shard,
+        profiler=args.profile,
+        profile_stages=args.profile_stages,
+    )
+    args.events = None # Dataset events for the view, see start_view
+    args.shared_index_path = None
+    if args.num_shards > 1:
+        fork_index(args)
+    # One owner per shard of a job, kept across requeues : a requeued shard starts by
+    # dropping what its preempted attempt had reserved
+    args.reservations = Reservations(
+        os.path.join(args.datasets_dir, RESERVATIONS_FILENAME),
+        f"{run_id()}-{args.shard}" if run_id() != "local" else f"local-{os.uname().nodename}-{os.getpid()}",
     )
+    with scratch_lock(args, args.reservations.path):
+        args.reservations.clear()
+
+
+    # 1. Download the datasets_index spreadsheet
+    print(Panel(Text("1. Downloading the spreadsheet", justify="center")))
+    cache = SpreadsheetCache(
+        args.cache_dir,
+        args.spreadsheet_id,
+        url=args.spreadsheet_url,
+    )
+    with args.metrics.stage("spreadsheet"):
+        df, args.urls = cache.load(
+            args.spreadsheet_filename,
+            process=lambda df: process_df(df, args),
+            offline=args.offline,
+        )
+        locate(
+            df,
+            args.urls,
+            args.datasets_dir,
+        )
+    console.log(f"Successfully loaded the datasets spradsheet from Google Docs : ID={args.spreadsheet_id} -> {args.spreadsheet_filename}")
+
 
     # 2. Scan the local datasets to update the status of each dataset
     # MainView.run(title="[bold] [italic] De profundiS [/italic] [/bold] : Datasets Sycnhronizer utility", log="textual.log")
@@ -610,7 +1818,7 @@ if __name__ == "__main__":
     console.log(df)
     tree = Tree("Directory")
     hd = tree.add(f"[markdown.strong]home_dir[/markdown.strong] = [markdown.emph]{args.home_dir}[/markdown.emph]")
-    tree.add("[markdown.strong]projects[/markdown.strong] : " + ', '.join(PROJECTS))
+    tree.add("[markdown.strong]projects[/markdown.strong] : " + ', '.join(args.projects))
     sc = hd.add(f"[markdown.strong]scratch_dir[/markdown.strong] = [markdown.emph]{args.scratch_dir}[/markdown.emph]")
     hd.add(f"[markdown.strong]root_dir[/markdown.strong] = [markdown.emph]{args.root_dir}[/markdown.emph]")
     sc.add(f"[markdown.strong]datasets_dir[/markdown.strong] = [markdown.emph]{args.datasets_dir}[/markdown.emph]")
@@ -621,42 +1829,110 @@ if __name__ == "__main__":
     
     # 2. Select the relevant datasets
     print(Panel(Text("2. Select relevant datasets", justify="center")))
-    df_selected = select_datasets(
-        df,
-        args,
-    )
+    with args.metrics.stage("select"):
+        df_selected = select_datasets(
+            df,
+            args,
+        )
+        df_selected = probe_sizes(
+            df_selected,
+            args,
+        )
+        df_selected = shard_datasets(
+            df_selected,
+            args,
+        )
+    exit_if_stopped(args)
+    view = start_view(df_selected, args) if as_bool(args.visual_gui) else None
     
     # 3. If actions are specified, execute the actions
     print(Panel(Text("3. Executing actions", justify="center")))
-    process_actions(
-        df_selected, 
-        args,
-    )
+    with args.metrics.stage("actions"):
+        process_actions(
+            df_selected, 
+            args,
+        )
+    exit_if_stopped(args)
 
     # 4. Update the statuses of the datasets in the database
     print(Panel(Text("4. Update the database", justify="center")))
-    df_updated = update_statuses(
-        df_selected,
-        args,
-    )
-
-    # 5. Download datasets
-    print(Panel(Text("5. Download datasets", justify="center")))
-    df_downloaded = download_datasets(
-        df_updated,
-        args,
-    )
+    with args.metrics.stage("update"):
+        df_updated = update_statuses(
+            df_selected,
+            args,
+        )
+    exit_if_stopped(args)
+
+    # 5-6. Download and extract the datasets in waves that fit on scratch : each wave frees
+    # the space of its archives once they are extracted, which lets the next datasets in
+    df_pending, waves = df_updated, []
+    while len(df_pending):
+        df_admitted, df_pending = admit_datasets(
+            df_pending,
+            args,
+        )
+        if not len(df_admitted):
+            console.log(f"[logging.level.error]Not enough space left on scratch for[/logging.level.error] {len(df_pending)} [logging.level.error]dataset(s) ![/logging.level.error]")
+            df_pending = df_pending.copy()
+            set_status(df_pending, [True] * len(df_pending), STATUSES['warning'])
+            break
+
+        # 5. Sync from the mirror, then download what is left
+        print(Panel(Text("5. Download datasets", justify="center")))
+        with args.metrics.stage("sync"):
+            df_admitted = sync_datasets(
+                df_admitted,
+                args,
+            )
+        exit_if_stopped(args)
+        with args.metrics.stage("download"):
+            df_downloaded = download_datasets(
+                df_admitted,
+                args,
+            )
+        exit_if_stopped(args)
+
+        # 6. Extract datasets
+        print(Panel(Text("6. Extract datasets", justify="center")))
+        with args.metrics.stage("extract"):
+            df_unpacked = extract_datasets(
+                df_downloaded,
+                args,
+            )
+        exit_if_stopped(args)
+        with args.metrics.stage("pack"):
+            waves.append(pack_datasets(
+                df_unpacked,
+                args,
+            ))
+        release_datasets(
+            waves[-1],
+            args,
+        )
+        exit_if_stopped(args)
+    with scratch_lock(args, args.reservations.path):
+        args.reservations.clear()
+    df_extracted = pd.concat(waves + [df_pending]).loc[df_updated.index]
+    if args.num_shards > 1:
+        merge_index(args)
+        write_shard_report(
+            args.report_dir,
+            args.shard,
+            args.num_shards,
+            df_extracted,
+        )
+        report_path, report = merge_reports(args.report_dir)
+        console.log(f"[table.caption]Merged the reports of shard(s)[/table.caption] {report['shards_reported']} [table.caption]into[/table.caption] {report_path}")
 
-    # 6. Extract datasets
-    print(Panel(Text("6. Extract datasets", justify="center")))
-    df_extracted = extract_datasets(
-        df_downloaded,
-        args,
-    )
 
     # 7. Summary of the operations
     print(Panel(Text("7. Summary", justify="center")))
-    summary(
-        df_extracted,
-        args,
-    )
\ No newline at end of file
+    with args.metrics.stage("summary"):
+        summary(
+            df_extracted,
+            args,
+        )
+    args.metrics.close()
+    console.log(f"[table.caption]Wrote the event log to[/table.caption] {args.metrics.events_path} [table.caption]and the metrics to[/table.caption] {args.metrics.metrics_path}")
+    if view is not None:
+        view.join() # Until the view is quit
\ No newline at end of file
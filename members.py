@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+
+# -----------------------
+# -------------------------------------------------
+# ------------------------------------------------------------------------------------------------
+# De profundiS : Member index of the archives, for access without full extraction
+# ------------------------------------------------------------------------------------------------
+# -------------------------------------------------
+# -----------------------
+
+
+
+# ---
+# Standard library imports
+# ---
+import os
+import io
+import bz2
+import zlib
+import time
+import uuid
+import shutil
+import struct
+import fnmatch
+import logging
+import tarfile
+import zipfile
+import concurrent.futures
+
+
+
+# ---
+# Scientific imports
+# ---
+import numpy as np
+
+
+
+# ---
+# Local imports
+# ---
+from extract import is_zip
+from extract import _top_level
+from extract import _extract_kwargs
+from transfer import STOP
+from transfer import TransferInterrupted
+from walker import TreeStats
+from walker import WORKERS
+from packing import encode_keys
+
+
+
+log = logging.getLogger("rich")
+INDEX_VERSION = 1
+READ_SIZE = 1024 * 1024
+LOCAL_HEADER = struct.Struct("<4s5H3L2H") # Zip local file header, followed by the name and the extra field
+
+# Kinds of members
+FILE = 0
+DIRECTORY = 1
+LINK = 2
+OTHER = 3
+
+
+
+def index_path(
+    archive,
+):
+    # The member index is persisted beside the archive, as a hidden file
+    return os.path.join(os.path.dirname(archive), f".{os.path.basename(archive)}.members.npz")
+
+
+
+class _Slice(io.RawIOBase):
+    # `length` bytes of a file from `offset` on, read with pread (no shared file position)
+    def __init__(
+        self,
+        fd,
+        offset,
+        length,
+    ):
+        self.fd = fd
+        self.position = offset
+        self.end = offset + length
+
+    def readable(self):
+        return True
+
+    def readinto(
+        self,
+        buffer,
+    ):
+        data = os.pread(self.fd, min(len(buffer), self.end - self.position), self.position)
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            os.close(self.fd)
+        super().close()
+
+
+
+class _TarMember(io.BufferedReader):
+    # Member of a tar archive : closing it closes the archive (and its decompressor) too
+    def __init__(
+        self,
+        tar,
+        member,
+    ):
+        super().__init__(tar.extractfile(member), buffer_size=READ_SIZE)
+        self.tar = tar
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self.tar.close()
+
+
+
+class _Decompressed(io.RawIOBase):
+    # Decompressing view over a _Slice
+    def __init__(
+        self,
+        raw,
+        decompressor,
+    ):
+        self.raw = raw
+        self.decompressor = decompressor
+        self.pending = b""
+
+    def readable(self):
+        return True
+
+    def readinto(
+        self,
+        buffer,
+    ):
+        while not self.pending:
+            data = self.raw.read(READ_SIZE)
+            if not data:
+                return 0
+            self.pending = self.decompressor.decompress(data)
+        n = min(len(buffer), len(self.pending))
+        buffer[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+    def close(self):
+        self.raw.close()
+        super().close()
+
+
+
+def _zip_members(
+    archive,
+):
+    with zipfile.ZipFile(archive) as z:
+        for info in z.infolist():
+            kind = DIRECTORY if info.is_dir() else FILE # Links are extracted as files holding their target, as zipfile does
+            yield info.filename, kind, info.file_size, info.header_offset, info.compress_size, info.compress_type, info.flag_bits, time.mktime(info.date_time + (0, 0, -1))
+
+
+
+def _tar_members(
+    archive,
+):
+    # Compressed tar streams are read through once, here : afterwards members are reached
+    # by seeking to their header
+    with tarfile.open(archive, mode="r:*") as tar:
+        while (member := tar.next()) is not None:
+            kind = DIRECTORY if member.isdir() else FILE if member.isfile() else LINK if member.issym() or member.islnk() else OTHER
+            yield member.name, kind, member.size, member.offset, member.size, 0, 0, member.mtime
+            tar.members = [] # Nothing is looked up by name : keep the memory flat
+
+
+
+class ArchiveIndex:
+    # Members of a zip or tar archive with their offsets, built on first touch and then
+    # loaded from index_path(archive) as long as the archive keeps its size and mtime.
+    #   members = ArchiveIndex.load(archive)
+    #   with members.open("dataset/part-000/item-000001.txt") as f:
+    #       ...
+    #   members.extract(members.match(["*/part-001/*"]), target_dir)
+    def __init__(
+        self,
+        archive,
+        arrays,
+    ):
+        self.archive = archive
+        self.is_zip = bool(arrays["is_zip"])
+        self.name_data = arrays["names"].tobytes()
+        self.name_offsets = arrays["name_offsets"]
+        self.kinds = arrays["kinds"]
+        self.sizes = arrays["sizes"]
+        self.offsets = arrays["offsets"]
+        self.compressed = arrays["compressed"]
+        self.methods = arrays["methods"]
+        self.flags = arrays["flags"]
+        self.mtimes = arrays["mtimes"]
+        self.positions = None
+
+    @classmethod
+    def load(
+        cls,
+        archive,
+    ):
+        st = os.stat(archive)
+        path = index_path(archive)
+        try:
+            with np.load(path) as arrays:
+                if (int(arrays["version"]), int(arrays["archive_size"]), int(arrays["archive_mtime"])) == (INDEX_VERSION, st.st_size, st.st_mtime_ns):
+                    return cls(archive, dict(arrays))
+        except (OSError, ValueError, KeyError):
+            pass
+        return cls(archive, cls.build(archive, st, path))
+
+    @staticmethod
+    def build(
+        archive,
+        st,
+        path,
+    ):
+        members = list(_zip_members(archive) if is_zip(archive) else _tar_members(archive))
+        names, name_offsets = encode_keys([member[0] for member in members])
+        columns = list(zip(*members)) if members else [()] * 8
+        arrays = {
+            "version": np.int64(INDEX_VERSION),
+            "archive_size": np.int64(st.st_size),
+            "archive_mtime": np.int64(st.st_mtime_ns),
+            "is_zip": np.bool_(is_zip(archive)),
+            "names": names,
+            "name_offsets": name_offsets,
+            "kinds": np.array(columns[1], dtype=np.int8),
+            "sizes": np.array(columns[2], dtype=np.int64),
+            "offsets": np.array(columns[3], dtype=np.int64),
+            "compressed": np.array(columns[4], dtype=np.int64),
+            "methods": np.array(columns[5], dtype=np.int16),
+            "flags": np.array(columns[6], dtype=np.int32),
+            "mtimes": np.array(columns[7], dtype=np.float64),
+        }
+        # Written beside and renamed : readers on other nodes never see half an index
+        partial = f"{path}.{uuid.uuid4().hex}"
+        try:
+            with open(partial, "wb") as f:
+                np.savez(f, **arrays)
+            os.replace(partial, path)
+        except OSError as e:
+            log.warning(f"Could not persist the member index of {archive} : {e}")
+            if os.path.exists(partial):
+                os.remove(partial)
+        return arrays
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def name(
+        self,
+        i,
+    ):
+        return self.name_data[self.name_offsets[i]:self.name_offsets[i + 1]].decode()
+
+    def names(
+        self,
+    ):
+        return [self.name(i) for i in range(len(self))]
+
+    def index(
+        self,
+        name,
+    ):
+        if self.positions is None:
+            self.positions = {name: i for i, name in enumerate(self.names())}
+        return self.positions[name]
+
+    def match(
+        self,
+        patterns,
+    ):
+        # Positions of the members whose name matches any of the glob patterns ('*' also
+        # matches '/', so 'data/train/*' selects a whole subtree)
+        return [i for i, name in enumerate(self.names()) if any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns)]
+
+    def open(
+        self,
+        member,
+    ):
+        # Binary file object over one member, reached by seeking to its offset : only the
+        # bytes of the member are read (and, in a compressed tar, the stream before it)
+        i = self.index(member) if isinstance(member, str) else int(member)
+        if self.kinds[i] != FILE:
+            raise IsADirectoryError(f"{self.name(i)} is not a regular file")
+        if not self.is_zip:
+            tar = tarfile.open(self.archive, mode="r:*")
+            try:
+                tar.fileobj.seek(int(self.offsets[i]))
+                return _TarMember(tar, tarfile.TarInfo.fromtarfile(tar))
+            except BaseException:
+                tar.close()
+                raise
+
+        fd = os.open(self.archive, os.O_RDONLY)
+        header = LOCAL_HEADER.unpack(os.pread(fd, LOCAL_HEADER.size, int(self.offsets[i])))
+        if header[0] != b"PK\x03\x04":
+            os.close(fd)
+            raise zipfile.BadZipFile(f"Bad local header for {self.name(i)} in {self.archive}")
+        start = int(self.offsets[i]) + LOCAL_HEADER.size + header[-2] + header[-1]
+        raw = _Slice(fd, start, int(self.compressed[i]))
+        method = int(self.methods[i])
+        if self.flags[i] & 0x1 or method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED, zipfile.ZIP_BZIP2):
+            # Encrypted or rarer methods : zipfile reads the central directory again
+            raw.close()
+            archive = zipfile.ZipFile(self.archive)
+            return archive.open(self.name(i))
+        if method == zipfile.ZIP_DEFLATED:
+            raw = _Decompressed(raw, zlib.decompressobj(-zlib.MAX_WBITS))
+        elif method == zipfile.ZIP_BZIP2:
+            raw = _Decompressed(raw, bz2.BZ2Decompressor())
+        return io.BufferedReader(raw, buffer_size=READ_SIZE)
+
+    def read(
+        self,
+        member,
+    ):
+        with self.open(member) as f:
+            return f.read()
+
+    def extract(
+        self,
+        positions,
+        target_dir,
+    ):
+        # Extracts the members at `positions` below `target_dir`, in archive order, and
+        # returns (top-level paths, TreeStats). Members already extracted with the same size
+        # are left as they are, so growing a selection only costs the new members.
+        top_level, stats = set(), TreeStats()
+        positions = sorted(positions, key=lambda i: self.offsets[i])
+        if not positions:
+            return top_level, stats
+        tar = None if self.is_zip else tarfile.open(self.archive, mode="r:*")
+        try:
+            for i in positions:
+                name = self.name(i)
+                parts = [part for part in name.split("/") if part not in ("", ".", "..")]
+                if not parts:
+                    continue
+                destination = os.path.join(target_dir, *parts)
+                top_level.add(_top_level(target_dir, parts[0]))
+                if self.kinds[i] == FILE:
+                    stats.add(TreeStats(1, int(self.sizes[i]), float(self.mtimes[i])))
+                if os.path.lexists(destination) and (self.kinds[i] != FILE or os.path.getsize(destination) == self.sizes[i]):
+                    continue
+                if tar is not None:
+                    tar.fileobj.seek(int(self.offsets[i]))
+                    tar.extract(tarfile.TarInfo.fromtarfile(tar), target_dir, **_extract_kwargs())
+                elif self.kinds[i] == DIRECTORY:
+                    os.makedirs(destination, exist_ok=True)
+                elif self.kinds[i] == FILE:
+                    os.makedirs(os.path.dirname(destination), exist_ok=True)
+                    with self.open(i) as src, open(destination, "wb") as dst:
+                        shutil.copyfileobj(src, dst, READ_SIZE)
+                    os.utime(destination, (self.mtimes[i], self.mtimes[i]))
+        finally:
+            if tar is not None:
+                tar.close()
+        return top_level, stats
+
+
+
+def extract_members(
+    jobs,
+    patterns,
+    workers=WORKERS,
+    on_extracted=None,
+):
+    # Partial counterpart of extract.extract_archives : only the members matching the glob
+    # `patterns` are extracted, and the archives are kept. Several archives at once.
+    # Returns {archive: (exception or None, top-level paths, TreeStats)}.
+    def extract_one(
+        archive,
+        target_dir,
+    ):
+        if STOP.is_set():
+            return TransferInterrupted(archive), [], TreeStats() # Preempted : not started
+        try:
+            members = ArchiveIndex.load(archive)
+            top_level, stats = members.extract(members.match(patterns), target_dir)
+        except (OSError, EOFError, zipfile.BadZipFile, tarfile.TarError, zlib.error) as e:
+            log.error(f"Failed to extract from {archive} : {e}")
+            return e, [], TreeStats()
+        if on_extracted is not None:
+            on_extracted(archive, stats)
+        return None, sorted(top_level), stats
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {archive: pool.submit(extract_one, archive, target_dir) for archive, target_dir in jobs}
+    return {archive: future.result() for archive, future in futures.items()}
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+
+# -----------------------
+# -------------------------------------------------
+# ------------------------------------------------------------------------------------------------
+# De profundiS : Stage timings, transfer metrics and structured event log
+# ------------------------------------------------------------------------------------------------
+# -------------------------------------------------
+# -----------------------
+
+
+
+# ---
+# Standard library imports
+# ---
+import os
+import json
+import socket
+import logging
+import resource
+import threading
+import contextlib
+import collections
+import urllib.parse
+from time import time
+from time import perf_counter
+from time import process_time
+
+
+
+log = logging.getLogger("rich")
+PREFIX = "deprofundis"
+PROFILERS = ("cprofile", "pyinstrument")
+RATES = {"bytes_total": "transfer_seconds_total", "worker_bytes_total": "worker_seconds_total"}
+
+
+
+class Metrics:
+    # Thread-safe counters, written at the end of the run as a Prometheus text file (for the
+    # node_exporter textfile collector), plus a JSON-lines log of every stage and transfer.
+    def __init__(
+        self,
+        log_dir,
+        run_id,
+        shard=0,
+        profiler=None,
+        profile_stages=None,
+    ):
+        self.log_dir = log_dir
+        self.name = f"{run_id}-{shard}"
+        self.labels = {"run_id": run_id, "shard": str(shard), "node": socket.gethostname()}
+        self.profiler = profiler
+        self.profile_stages = profile_stages
+        self.counters = collections.defaultdict(float)
+        self.lock = threading.Lock()
+        os.makedirs(log_dir, exist_ok=True)
+        self.events_path = os.path.join(log_dir, f"events-{self.name}.jsonl")
+        self.metrics_path = os.path.join(log_dir, f"metrics-{self.name}.prom")
+        self.events = open(self.events_path, "a")
+
+    def add(
+        self,
+        name,
+        value=1,
+        **labels,
+    ):
+        with self.lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def event(
+        self,
+        kind,
+        **fields,
+    ):
+        line = json.dumps(dict(time=time(), event=kind, **self.labels, **fields))
+        with self.lock:
+            if not self.events.closed:
+                self.events.write(line + "\n")
+
+    @contextlib.contextmanager
+    def stage(
+        self,
+        name,
+    ):
+        # Wall and CPU time of a stage. The CPU time covers every thread of this process
+        # plus the worker processes that finished during the stage (e.g. extraction).
+        self.event("stage_start", stage=name)
+        wall, cpu = perf_counter(), process_time() + _children_cpu()
+        with self.profile(name):
+            try:
+                yield
+            finally:
+                wall, cpu = perf_counter() - wall, process_time() + _children_cpu() - cpu
+                self.add("stage_wall_seconds", wall, stage=name)
+                self.add("stage_cpu_seconds", cpu, stage=name)
+                self.event("stage_end", stage=name, wall=wall, cpu=cpu)
+
+    @contextlib.contextmanager
+    def profile(
+        self,
+        name,
+    ):
+        # cProfile only sees the main thread, pyinstrument samples it : both show where
+        # the orchestration spends its time, not what the worker threads do
+        if self.profiler is None or (self.profile_stages and name not in self.profile_stages):
+            yield
+            return
+        path = os.path.join(self.log_dir, "profiles", f"{self.name}-{name}")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if self.profiler == "pyinstrument":
+            try:
+                from pyinstrument import Profiler
+            except ImportError:
+                log.warning("pyinstrument is not installed : pip install pyinstrument")
+                yield
+                return
+            profiler = Profiler()
+            profiler.start()
+            try:
+                yield
+            finally:
+                profiler.stop()
+                with open(path + ".html", "w") as f:
+                    f.write(profiler.output_html())
+        else:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+                profiler.dump_stats(path + ".prof")
+
+    def observe_fetch(
+        self,
+        url,
+        size,
+        seconds,
+        ttfb,
+        retries,
+    ):
+        # One HTTP transfer (or Range segment), as reported by the download backends
+        host = urllib.parse.urlparse(url).hostname or ""
+        worker = threading.current_thread().name
+        self.add("bytes_total", size, host=host)
+        self.add("transfer_seconds_total", seconds, host=host)
+        self.add("worker_bytes_total", size, worker=worker)
+        self.add("worker_seconds_total", seconds, worker=worker)
+        self.add("retries_total", retries, host=host)
+        self.add("transfers_total", 1, host=host)
+        if ttfb is not None:
+            self.add("ttfb_seconds_sum", ttfb, host=host)
+            self.add("ttfb_seconds_count", 1, host=host)
+        self.event("fetch", url=url, host=host, worker=worker, bytes=size, seconds=seconds, ttfb=ttfb, retries=retries)
+
+    def rates(
+        self,
+    ):
+        # Throughputs derived from the counters : bytes/s per host and per worker, and the
+        # extraction rate over the time spent in the extract stage
+        with self.lock:
+            counters = dict(self.counters)
+        rates = {}
+        for (name, labels), value in counters.items():
+            if name in RATES:
+                seconds = counters.get((RATES[name], labels), 0)
+                if seconds > 0:
+                    rates[("throughput_bytes_per_second", labels)] = value / seconds
+        extract_seconds = counters.get(("stage_wall_seconds", (("stage", "extract"),)), 0)
+        if extract_seconds > 0:
+            rates[("extraction_bytes_per_second", ())] = counters.get(("extracted_bytes_total", ()), 0) / extract_seconds
+        return rates
+
+    def write_prometheus(
+        self,
+    ):
+        with self.lock:
+            counters = dict(self.counters)
+        samples = collections.defaultdict(list)
+        for (name, labels), value in list(counters.items()) + list(self.rates().items()):
+            samples[name].append((dict(self.labels, **dict(labels)), value))
+
+        lines = []
+        for name in sorted(samples):
+            kind = "gauge" if name.endswith("_per_second") else "counter"
+            lines.append(f"# TYPE {PREFIX}_{name} {kind}")
+            for labels, value in samples[name]:
+                formatted = ",".join(f'{k}="{_escape(v)}"' for k, v in sorted(labels.items()))
+                lines.append(f"{PREFIX}_{name}{{{formatted}}} {float(value)!r}")
+        with open(self.metrics_path + ".tmp", "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(self.metrics_path + ".tmp", self.metrics_path)
+        return self.metrics_path
+
+    def close(
+        self,
+    ):
+        if self.events.closed:
+            return
+        self.event("rates", rates=[
+            dict(labels, metric=name, value=value) for (name, labels), value in self.rates().items()
+        ])
+        self.write_prometheus()
+        with self.lock:
+            self.events.close()
+
+
+
+def _children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+
+def _escape(
+    value,
+):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+
+# -----------------------
+# -------------------------------------------------
+# ------------------------------------------------------------------------------------------------
+# De profundiS : Block-level delta sync from a mirror tree
+# ------------------------------------------------------------------------------------------------
+# -------------------------------------------------
+# -----------------------
+
+
+
+# ---
+# Standard library imports
+# ---
+import os
+import stat
+import mmap
+import errno
+import hashlib
+import logging
+import threading
+import concurrent.futures
+from dataclasses import dataclass
+from dataclasses import fields
+
+
+
+# ---
+# Scientific imports
+# ---
+import numpy as np
+
+
+
+# ---
+# Local imports
+# ---
+from walker import walk
+from walker import WORKERS
+
+
+
+log = logging.getLogger("rich")
+BLOCK_SIZE = 128 * 1024
+WINDOW = 1024 * 1024 # Bytes of the source given to the rolling checksum at once
+READ_SIZE = 8 * 1024 * 1024
+COPY_CHUNK = 64 * 1024 * 1024
+SUFFIX = ".de-profundis-sync"
+FALLBACK_ERRORS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF)
+
+_zero_copy = {"copy_file_range": hasattr(os, "copy_file_range"), "sendfile": hasattr(os, "sendfile")}
+
+
+
+@dataclass
+class SyncStats:
+    n_files: int = 0
+    n_skipped: int = 0 # Same size and mtime on both sides
+    n_copied: int = 0 # No usable basis : copied whole
+    n_patched: int = 0 # Rebuilt from the blocks of the previous version and the changed bytes
+    matched: int = 0 # Bytes reused from the previous version
+    literal: int = 0 # Bytes copied from the mirror
+
+    def add(
+        self,
+        other,
+    ):
+        for field in fields(self):
+            setattr(self, field.name, getattr(self, field.name) + getattr(other, field.name))
+
+
+
+def _combine(
+    a,
+    b,
+):
+    # rsync's weak checksum : two 16-bit running sums packed into one integer
+    return (a & 0xFFFF) | ((b & 0xFFFF) << 16)
+
+
+
+def _strong(
+    data,
+):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+
+def _rolling(
+    data,
+    block_size,
+):
+    # Weak checksum of the block starting at every offset of `data`, all at once : with
+    # S and T the prefix sums of x[i] and i * x[i], the block at k has
+    # a = S[k+B] - S[k] and b = sum((k+B-i) * x[i]) = (k+B) * a - (T[k+B] - T[k]).
+    # Only the low 16 bits are kept, so wrapping uint32 arithmetic is exact.
+    x = np.frombuffer(data, dtype=np.uint8).astype(np.uint32)
+    s = np.concatenate((np.zeros(1, np.uint32), np.cumsum(x, dtype=np.uint32)))
+    t = np.concatenate((np.zeros(1, np.uint32), np.cumsum(x * np.arange(len(x), dtype=np.uint32), dtype=np.uint32)))
+    a = s[block_size:] - s[:-block_size]
+    b = np.arange(block_size, len(x) + 1, dtype=np.uint32) * a - (t[block_size:] - t[:-block_size])
+    return _combine(a, b)
+
+
+
+def _bitmap(
+    keys,
+):
+    # Hashed presence filter of the weak checksums, about 64 bits per key : a gather in
+    # it rejects most offsets without sorting the window
+    bits = 1 << min(24, max(16, (64 * len(keys)).bit_length()))
+    bitmap = np.zeros(bits, dtype=bool)
+    bitmap[keys & (bits - 1)] = True
+    return bitmap
+
+
+
+def block_signatures(
+    path,
+    block_size=BLOCK_SIZE,
+):
+    # Signatures of every full block of `path` : the array of their weak checksums, and
+    # {strong digest: offset}
+    weights = np.arange(block_size, 0, -1, dtype=np.int64)
+    per_read = max(1, READ_SIZE // block_size) * block_size
+    weaks, digests, offset = [], {}, 0
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(per_read)
+            n = len(data) // block_size
+            if n:
+                blocks = np.frombuffer(data, dtype=np.uint8, count=n * block_size).reshape(n, block_size)
+                weaks.append(_combine(blocks.sum(axis=1, dtype=np.int64), blocks.astype(np.int64) @ weights))
+                for i in range(n):
+                    digests.setdefault(_strong(data[i * block_size:(i + 1) * block_size]), offset + i * block_size)
+            offset += len(data)
+            if len(data) < per_read:
+                return np.unique(np.concatenate(weaks)) if weaks else np.empty(0, dtype=np.int64), digests
+
+
+
+def _emit(
+    ops,
+    kind,
+    offset,
+    length,
+):
+    # Merges contiguous instructions of the same kind
+    if length <= 0:
+        return
+    if ops and ops[-1][0] == kind and ops[-1][1] + ops[-1][2] == offset:
+        ops[-1] = (kind, ops[-1][1], ops[-1][2] + length)
+    else:
+        ops.append((kind, offset, length))
+
+
+
+def plan_delta(
+    source,
+    signatures,
+    block_size=BLOCK_SIZE,
+):
+    # Instructions rebuilding `source` : ("basis", offset, length) reuses bytes of the
+    # previous version, ("source", offset, length) copies bytes of the source. Blocks are
+    # matched at any offset, so insertions and deletions only cost the bytes around them.
+    ops = []
+    keys, digests = signatures
+    size = os.path.getsize(source)
+    if size < block_size or not digests:
+        _emit(ops, "source", 0, size)
+        return ops
+
+    bitmap = _bitmap(keys)
+    with open(source, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        pos, literal_start = 0, 0
+        window_start, window_end, candidates = 0, 0, np.empty(0, dtype=np.int64)
+        while pos + block_size <= size:
+            # Unchanged stretches match block after block : one strong digest per block
+            match = digests.get(_strong(data[pos:pos + block_size]))
+            if match is None:
+                # Otherwise slide, byte per byte but vectorized, to the next block of the basis
+                pos += 1
+                while pos + block_size <= size:
+                    if not window_start <= pos < window_end:
+                        window_start, window_end = pos, min(pos + WINDOW, size - block_size + 1)
+                        weak = _rolling(data[window_start:window_end + block_size - 1], block_size).astype(np.int64)
+                        hits = np.flatnonzero(bitmap[weak & (len(bitmap) - 1)])
+                        candidates = window_start + hits[np.isin(weak[hits], keys)]
+                    j = np.searchsorted(candidates, pos)
+                    if j == len(candidates):
+                        pos = window_end
+                        continue
+                    pos = int(candidates[j])
+                    match = digests.get(_strong(data[pos:pos + block_size]))
+                    if match is not None:
+                        break
+                    pos += 1
+                if match is None:
+                    break
+            _emit(ops, "source", literal_start, pos - literal_start)
+            _emit(ops, "basis", match, block_size)
+            pos = literal_start = pos + block_size
+        _emit(ops, "source", literal_start, size - literal_start)
+    return ops
+
+
+
+def copy_range(
+    src_fd,
+    dst_fd,
+    offset,
+    length,
+    dst_offset,
+):
+    # Kernel-side copies when possible : copy_file_range (which shares extents on XFS and
+    # Btrfs, and copies server-side on NFS 4.2), then sendfile, then pread / pwrite
+    done = 0
+    while done < length:
+        count = min(COPY_CHUNK, length - done)
+        n = None
+        if _zero_copy["copy_file_range"]:
+            try:
+                n = os.copy_file_range(src_fd, dst_fd, count, offset + done, dst_offset + done)
+            except OSError as e:
+                if e.errno not in FALLBACK_ERRORS:
+                    raise
+                if e.errno == errno.ENOSYS:
+                    _zero_copy["copy_file_range"] = False
+        if n is None and _zero_copy["sendfile"]:
+            try:
+                os.lseek(dst_fd, dst_offset + done, os.SEEK_SET)
+                n = os.sendfile(dst_fd, src_fd, offset + done, count)
+            except OSError as e:
+                if e.errno not in FALLBACK_ERRORS:
+                    raise
+                if e.errno == errno.ENOSYS:
+                    _zero_copy["sendfile"] = False
+        if n is None:
+            n = os.pwrite(dst_fd, os.pread(src_fd, count, offset + done), dst_offset + done)
+        if n == 0:
+            raise OSError(errno.EIO, f"Unexpected end of file after {offset + done} bytes")
+        done += n
+
+
+
+def sync_file(
+    source,
+    target,
+    block_size=BLOCK_SIZE,
+):
+    # Brings `target` to the content of `source`, reading the blocks it already has from
+    # its previous version. The new version is written beside it and renamed over it.
+    stats = SyncStats(n_files=1)
+    st = os.lstat(source)
+    try:
+        basis = os.lstat(target)
+    except FileNotFoundError:
+        basis = None
+    if basis is not None and basis.st_size == st.st_size and basis.st_mtime_ns == st.st_mtime_ns:
+        stats.n_skipped = 1
+        return stats
+
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    if stat.S_ISLNK(st.st_mode):
+        if basis is not None:
+            os.remove(target)
+        os.symlink(os.readlink(source), target)
+        os.utime(target, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=False)
+        stats.n_copied = 1
+        return stats
+
+    patch = basis is not None and stat.S_ISREG(basis.st_mode) and basis.st_size >= block_size
+    if patch:
+        ops = plan_delta(source, block_signatures(target, block_size), block_size)
+    else:
+        ops = [("source", 0, st.st_size)] if st.st_size else []
+    partial = target + SUFFIX
+    with open(source, "rb") as src, open(target if patch else source, "rb") as previous, open(partial, "wb") as out:
+        position = 0
+        for kind, offset, length in ops:
+            copy_range((previous if kind == "basis" else src).fileno(), out.fileno(), offset, length, position)
+            position += length
+    os.chmod(partial, stat.S_IMODE(st.st_mode))
+    os.utime(partial, ns=(st.st_atime_ns, st.st_mtime_ns))
+    os.replace(partial, target)
+
+    stats.matched = sum(length for kind, _, length in ops if kind == "basis")
+    stats.literal = sum(length for kind, _, length in ops if kind == "source")
+    stats.n_patched, stats.n_copied = int(patch), int(not patch)
+    return stats
+
+
+
+def sync_trees(
+    pairs,
+    workers=WORKERS,
+    block_size=BLOCK_SIZE,
+    on_synced=None,
+):
+    # `pairs` is a list of (source, target) files or trees. Files are compared by size and
+    # mtime and only the changed ones are synced, several at once. Nothing is deleted from
+    # the targets. Returns (SyncStats, {source root: exception}).
+    targets = dict(pairs)
+    total, errors, lock = SyncStats(), {}, threading.Lock()
+    def sync_one(
+        root,
+        path,
+    ):
+        target = os.path.join(targets[root], os.path.relpath(path, root)) if path != root else targets[root]
+        try:
+            stats = sync_file(path, target, block_size)
+        except OSError as e:
+            log.error(f"Failed to sync {path} : {e}")
+            with lock:
+                errors[root] = e
+            return
+        with lock:
+            total.add(stats)
+        if on_synced is not None:
+            on_synced(path, stats)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = []
+        for root, _, files, _ in walk(list(targets), workers):
+            for path, st in files:
+                if stat.S_ISREG(st.st_mode) or stat.S_ISLNK(st.st_mode):
+                    futures.append(pool.submit(sync_one, root, path))
+        concurrent.futures.wait(futures)
+    for root in targets:
+        if not os.path.lexists(root):
+            errors[root] = FileNotFoundError(errno.ENOENT, "Not found in the mirror", root)
+    return total, errors
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+
+# -----------------------
+# -------------------------------------------------
+# ------------------------------------------------------------------------------------------------
+# De profundiS : Packing of extracted datasets into indexed shard files
+# ------------------------------------------------------------------------------------------------
+# -------------------------------------------------
+# -----------------------
+
+
+
+# ---
+# Standard library imports
+# ---
+import os
+import stat
+import mmap
+import shutil
+import logging
+import concurrent.futures
+from dataclasses import dataclass
+
+
+
+# ---
+# Scientific imports
+# ---
+import numpy as np
+
+
+
+# ---
+# Local imports
+# ---
+from walker import walk
+from walker import WORKERS
+from mirror import copy_range
+
+
+
+log = logging.getLogger("rich")
+SHARD_SIZE = 1024 ** 3
+READ_LIMIT = 1024 * 1024 # Files up to this size are read by the pool, larger ones copied by the kernel
+BATCH = 1024 # Files read ahead of the writer
+PREFETCH = 256 # Samples paged in ahead of a sequential reader
+INDEX_FILENAME = "index.npz"
+SHARD_PATTERN = "shard-{:05d}.bin"
+PARTIAL_SUFFIX = ".partial"
+
+
+
+@dataclass
+class PackStats:
+    n_files: int = 0
+    size: int = 0
+    n_shards: int = 0
+
+
+
+def is_packed(
+    pack_dir,
+):
+    # The index is written last : a pack without it was interrupted
+    return os.path.exists(os.path.join(pack_dir, INDEX_FILENAME))
+
+
+
+def encode_keys(
+    keys,
+):
+    # Keys as one UTF-8 blob (uint8 array) with the offset of each key in it
+    encoded = [key.encode() for key in keys]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(key) for key in encoded], out=offsets[1:])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+
+def _read_small(
+    path,
+    size,
+):
+    if size > READ_LIMIT:
+        return None
+    with open(path, "rb") as f:
+        return f.read()
+
+
+
+def pack_tree(
+    roots,
+    base,
+    pack_dir,
+    shard_size=SHARD_SIZE,
+    workers=WORKERS,
+    on_packed=None,
+):
+    # Concatenates every regular file below `roots` into shard files of about `shard_size`
+    # bytes, in the order of their keys (their path relative to `base`), and writes the
+    # offset index. Opening millions of small files is what the walk and the read pool pay
+    # for here, once, instead of every epoch of every training job. Returns PackStats.
+    files = []
+    for _, _, listing, _ in walk(roots, workers):
+        files.extend((os.path.relpath(path, base), path, st.st_size) for path, st in listing if stat.S_ISREG(st.st_mode))
+    files.sort()
+
+    partial = pack_dir + PARTIAL_SUFFIX
+    shutil.rmtree(partial, ignore_errors=True)
+    os.makedirs(partial)
+    n = len(files)
+    shards = np.zeros(n, dtype=np.uint32)
+    offsets = np.zeros(n, dtype=np.int64)
+    lengths = np.zeros(n, dtype=np.int64)
+    stats, out, position = PackStats(n_files=n), None, 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        for start in range(0, n, BATCH):
+            batch = files[start:start + BATCH]
+            contents = pool.map(_read_small, [path for _, path, _ in batch], [size for _, _, size in batch])
+            for i, (_, path, size), data in zip(range(start, start + len(batch)), batch, contents):
+                if out is None or (position and position + size > shard_size):
+                    if out is not None:
+                        out.close()
+                    out = open(os.path.join(partial, SHARD_PATTERN.format(stats.n_shards)), "wb")
+                    stats.n_shards += 1
+                    position = 0
+                if data is None:
+                    with open(path, "rb") as src:
+                        out.flush()
+                        copy_range(src.fileno(), out.fileno(), 0, size, position)
+                        out.seek(position + size)
+                else:
+                    out.write(data)
+                    size = len(data)
+                shards[i], offsets[i], lengths[i] = stats.n_shards - 1, position, size
+                position += size
+                stats.size += size
+            if on_packed is not None:
+                on_packed(len(batch))
+    if out is not None:
+        out.close()
+
+    keys, key_offsets = encode_keys([key for key, _, _ in files])
+    with open(os.path.join(partial, INDEX_FILENAME), "wb") as f:
+        np.savez(
+            f,
+            keys=keys,
+            key_offsets=key_offsets,
+            shards=shards,
+            offsets=offsets,
+            lengths=lengths,
+        )
+    shutil.rmtree(pack_dir, ignore_errors=True)
+    os.replace(partial, pack_dir)
+    return stats
+
+
+
+class PackReader:
+    # Samples of a pack by index or by key, as memoryviews of the memory-mapped shards :
+    # no copy and no system call per sample. Shards are mapped on first use. Views stay
+    # valid as long as the reader is open.
+    #   with PackReader(path) as pack:
+    #       for key, sample in pack.iterate():
+    #           ...
+    def __init__(
+        self,
+        pack_dir,
+    ):
+        self.pack_dir = pack_dir
+        with np.load(os.path.join(pack_dir, INDEX_FILENAME)) as index:
+            self.key_data = index["keys"].tobytes()
+            self.key_offsets = index["key_offsets"]
+            self.shards = index["shards"]
+            self.offsets = index["offsets"]
+            self.lengths = index["lengths"]
+        self.maps = {}
+        self.positions = None
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def key(
+        self,
+        i,
+    ):
+        return self.key_data[self.key_offsets[i]:self.key_offsets[i + 1]].decode()
+
+    def keys(
+        self,
+    ):
+        return [self.key(i) for i in range(len(self))]
+
+    def index(
+        self,
+        key,
+    ):
+        # Position of `key`, through a dict built on the first lookup by key
+        if self.positions is None:
+            self.positions = {key: i for i, key in enumerate(self.keys())}
+        return self.positions[key]
+
+    def shard(
+        self,
+        shard,
+    ):
+        if shard not in self.maps:
+            path = os.path.join(self.pack_dir, SHARD_PATTERN.format(shard))
+            with open(path, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                self.maps[shard] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        return self.maps[shard]
+
+    def __getitem__(
+        self,
+        item,
+    ):
+        i = self.index(item) if isinstance(item, str) else int(item)
+        offset, length = self.offsets[i], self.lengths[i]
+        return memoryview(self.shard(int(self.shards[i])))[offset:offset + length]
+
+    def prefetch(
+        self,
+        start,
+        stop,
+    ):
+        # Asks the kernel to page in samples [start, stop) in the background
+        stop = min(stop, len(self))
+        if start >= stop or not hasattr(mmap, "MADV_WILLNEED"):
+            return
+        for shard in np.unique(self.shards[start:stop]):
+            in_shard = np.flatnonzero(self.shards[start:stop] == shard) + start
+            first, last = in_shard[0], in_shard[-1]
+            begin = int(self.offsets[first]) // mmap.PAGESIZE * mmap.PAGESIZE
+            end = int(self.offsets[last] + self.lengths[last])
+            data = self.shard(int(shard))
+            if end > begin and isinstance(data, mmap.mmap):
+                data.madvise(mmap.MADV_WILLNEED, begin, end - begin)
+
+    def iterate(
+        self,
+        start=0,
+        stop=None,
+        prefetch=PREFETCH,
+    ):
+        # Yields (key, sample) in pack order, paging in the next `prefetch` samples while
+        # the current ones are consumed
+        stop = len(self) if stop is None else min(stop, len(self))
+        ahead = start
+        for i in range(start, stop):
+            if prefetch and i >= ahead - prefetch // 2:
+                self.prefetch(ahead, ahead + prefetch)
+                ahead = max(ahead, i) + prefetch
+            yield self.key(i), self[i]
+
+    def close(
+        self,
+    ):
+        for data in self.maps.values():
+            try:
+                if isinstance(data, mmap.mmap):
+                    data.close()
+            except BufferError:
+                pass # Views still held by the caller : unmapped once they are released
+        self.maps = {}
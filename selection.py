@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+
+# -----------------------
+# -------------------------------------------------
+# ------------------------------------------------------------------------------------------------
+# De profundiS : Dataset selection engine
+# ------------------------------------------------------------------------------------------------
+# -------------------------------------------------
+# -----------------------
+
+
+
+# ---
+# Standard library imports
+# ---
+import re
+import fnmatch
+
+
+
+# ---
+# Scientific imports
+# ---
+import numpy as np
+import pandas as pd
+
+
+
+GLOB_CHARS = set("*?[")
+REGEX_PREFIX = "re:"
+CATEGORICAL_COLUMNS = ["Project", "Task"]
+
+
+
+def compile_values(
+    values,
+):
+    # Splits CLI values into exact names and a single compiled pattern :
+    # "re:<regex>" is a regular expression, anything with *, ? or [ is a glob.
+    exact, patterns = [], []
+    for v in values:
+        if v.startswith(REGEX_PREFIX):
+            patterns.append(v[len(REGEX_PREFIX):])
+        elif GLOB_CHARS & set(v):
+            patterns.append(fnmatch.translate(v))
+        else:
+            exact.append(v)
+    regex = re.compile("|".join(f"(?:{p})" for p in patterns)) if patterns else None
+    return exact, regex
+
+
+
+def match(
+    column,
+    values,
+):
+    exact, regex = compile_values(values)
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        # Evaluate the rule once per category, then broadcast through the integer codes
+        categories = column.cat.categories
+        hits = np.array(categories.isin(exact), dtype=bool)
+        if regex is not None:
+            hits |= np.fromiter((regex.fullmatch(str(c)) is not None for c in categories), bool, len(categories))
+        return np.append(hits, False)[column.cat.codes.to_numpy()] # Code -1 (missing) never matches
+
+    mask = np.array(column.isin(exact), dtype=bool)
+    if regex is not None:
+        mask |= column.astype(str).str.fullmatch(regex).fillna(False).to_numpy(bool)
+    return mask
+
+
+
+def categorize(
+    df,
+):
+    # Precomputed categorical index on the low-cardinality columns used for selection
+    for key in CATEGORICAL_COLUMNS:
+        if key in df.columns:
+            df[key] = df[key].astype("category")
+
+
+
+def select(
+    df,
+    rules,
+):
+    # `rules` is a list of (column, included values, excluded values). Every rule is
+    # folded into one boolean mask, and the DataFrame is sliced (copied) only once.
+    mask = np.ones(len(df), dtype=bool)
+    for key, include, exclude in rules:
+        if include:
+            mask &= match(df[key], include)
+        if exclude:
+            mask &= ~match(df[key], exclude)
+    return df[mask]
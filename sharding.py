@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+
+# -----------------------
+# -------------------------------------------------
+# ------------------------------------------------------------------------------------------------
+# De profundiS : Multi-node sharded synchronization
+# ------------------------------------------------------------------------------------------------
+# -------------------------------------------------
+# -----------------------
+
+
+
+# ---
+# Standard library imports
+# ---
+import os
+import glob
+import json
+import heapq
+import socket
+import hashlib
+import logging
+import threading
+from time import time
+from time import sleep
+
+
+
+log = logging.getLogger("rich")
+LOCK_TTL = 15 * 60 # A lock whose heartbeat is older than this (in seconds) belonged to a dead node
+SIZES_TIMEOUT = 10 * 60 # Seconds a shard waits for the sizes of shard 0 before sharding on key hashes
+SIZES_POLL = 2.0
+
+
+
+def shard_identity():
+    # (shard, number of shards) from the SLURM environment : job arrays first, then the
+    # tasks of a multi-node step (`srun --ntasks-per-node=1`), else a single shard.
+    if os.environ.get("SLURM_ARRAY_TASK_COUNT"):
+        offset = int(os.environ.get("SLURM_ARRAY_TASK_MIN", 0))
+        return int(os.environ["SLURM_ARRAY_TASK_ID"]) - offset, int(os.environ["SLURM_ARRAY_TASK_COUNT"])
+    if os.environ.get("SLURM_NTASKS"):
+        return int(os.environ.get("SLURM_PROCID", 0)), int(os.environ["SLURM_NTASKS"])
+    return 0, 1
+
+
+
+def run_id():
+    return os.environ.get("SLURM_ARRAY_JOB_ID") or os.environ.get("SLURM_JOB_ID") or "local"
+
+
+
+def assign_shards(
+    sizes,
+    keys,
+    num_shards,
+):
+    # Longest-processing-time-first bin packing : the largest dataset goes to the least
+    # loaded shard. Ties are broken on the dataset key so that every node, computing
+    # this independently, ends up with the exact same assignment.
+    shards = [0] * len(sizes)
+    bins = [(0, shard) for shard in range(num_shards)]
+    for i in sorted(range(len(sizes)), key=lambda i: (-sizes[i], keys[i])):
+        load, shard = heapq.heappop(bins)
+        shards[i] = shard
+        heapq.heappush(bins, (load + sizes[i], shard))
+    return shards
+
+
+
+def hash_shard(
+    key,
+    num_shards,
+):
+    # Stable across nodes, runs and Python processes (unlike hash())
+    return int(hashlib.sha1(key.encode()).hexdigest(), 16) % num_shards
+
+
+
+def sizes_path(
+    report_dir,
+):
+    # One file per attempt of the job : a requeued job must not read the sizes of the last one
+    return os.path.join(report_dir, f"sizes-{run_id()}-{os.environ.get('SLURM_RESTART_COUNT', '0')}.json")
+
+
+
+def share_sizes(
+    path,
+    shard,
+    sizes,
+    timeout=SIZES_TIMEOUT,
+):
+    # Barrier on the shared filesystem : shard 0 publishes its {dataset key: size}, and the
+    # other shards wait for it, so that every node shards the same inputs rather than its
+    # own probes (which may time out differently). Returns the shared sizes, or None once
+    # `timeout` is over.
+    if shard == 0:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            json.dump(sizes, f)
+        os.replace(path + ".tmp", path)
+        return sizes
+    deadline = time() + timeout
+    while time() < deadline:
+        try:
+            with open(path, "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            sleep(SIZES_POLL)
+    return None
+
+
+
+def assign_keys(
+    sizes,
+    keys,
+    num_shards,
+):
+    # Shard of each of `keys` : LPT over the shared `sizes` ({key: size}, or None), and
+    # the stable hash for the keys they do not cover
+    known = sorted(sizes or {})
+    shards = dict(zip(known, assign_shards([sizes[key] for key in known], known, num_shards)))
+    return [shards[key] if key in shards else hash_shard(key, num_shards) for key in keys]
+
+
+
+class UrlLocks:
+    # Lock files on the shared scratch filesystem : O_CREAT | O_EXCL is atomic on
+    # Lustre/GPFS/NFSv3+, and a heartbeat thread keeps the mtime of held locks fresh.
+    def __init__(
+        self,
+        lock_dir,
+        ttl=LOCK_TTL,
+    ):
+        self.lock_dir = lock_dir
+        self.ttl = ttl
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.held = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        os.makedirs(lock_dir, exist_ok=True)
+        self.heartbeat = threading.Thread(target=self._heartbeat, daemon=True)
+        self.heartbeat.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release_all()
+
+    def path(
+        self,
+        url,
+    ):
+        return os.path.join(self.lock_dir, hashlib.sha1(url.encode()).hexdigest() + ".lock")
+
+    def acquire(
+        self,
+        url,
+    ):
+        path = self.path(url)
+        with self.lock:
+            if path in self.held:
+                return True # The same URL listed by several of our own rows
+        for _ in range(2):
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                try:
+                    if time() - os.stat(path).st_mtime < self.ttl:
+                        return False
+                    log.warning(f"Breaking the stale lock of {url}")
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                continue
+            with os.fdopen(fd, "w") as f:
+                json.dump({"owner": self.owner, "url": url, "time": time()}, f)
+            with self.lock:
+                self.held.add(path)
+            return True
+        return False
+
+    def release(
+        self,
+        url,
+    ):
+        path = self.path(url)
+        with self.lock:
+            self.held.discard(path)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def release_all(
+        self,
+    ):
+        self.stopped.set()
+        with self.lock:
+            held, self.held = self.held, set()
+        for path in held:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _heartbeat(
+        self,
+    ):
+        while not self.stopped.wait(self.ttl / 3):
+            with self.lock:
+                held = list(self.held)
+            for path in held:
+                try:
+                    os.utime(path)
+                except FileNotFoundError:
+                    pass
+
+
+
+def write_shard_report(
+    report_dir,
+    shard,
+    num_shards,
+    df,
+):
+    os.makedirs(report_dir, exist_ok=True)
+    report = {
+        "run_id": run_id(),
+        "shard": shard,
+        "num_shards": num_shards,
+        "host": socket.gethostname(),
+        "time": time(),
+        "datasets": df[["Project", "Task", "Dataset name", "Status"]].astype(str).to_dict("records"),
+    }
+    path = os.path.join(report_dir, f"shard-{run_id()}-{shard}.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(report, f, indent=2)
+    os.replace(path + ".tmp", path)
+    return path
+
+
+
+def merge_reports(
+    report_dir,
+):
+    # Combines the reports of every shard of this run into `status-<run id>.json`. Each
+    # shard merges after writing its own report, so the last one to finish sees them all.
+    reports = []
+    for path in sorted(glob.glob(os.path.join(report_dir, f"shard-{run_id()}-*.json"))):
+        with open(path, "r") as f:
+            reports.append(json.load(f))
+    merged = {
+        "run_id": run_id(),
+        "num_shards": max([r["num_shards"] for r in reports], default=0),
+        "shards_reported": sorted(r["shard"] for r in reports),
+        "datasets": sorted(
+            (dict(d, shard=r["shard"], host=r["host"]) for r in reports for d in r["datasets"]),
+            key=lambda d: (d["Project"], d["Task"], d["Dataset name"]),
+        ),
+    }
+    path = os.path.join(report_dir, f"status-{run_id()}.json")
+    tmp_path = f"{path}.{socket.gethostname()}-{os.getpid()}.tmp" # Several shards may merge at once
+    with open(tmp_path, "w") as f:
+        json.dump(merged, f, indent=2)
+    os.replace(tmp_path, path)
+    return path, merged
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+
+# -----------------------
+# -------------------------------------------------
+# ------------------------------------------------------------------------------------------------
+# De profundiS : Content-addressed dataset cache shared between projects
+# ------------------------------------------------------------------------------------------------
+# -------------------------------------------------
+# -----------------------
+
+
+
+# ---
+# Standard library imports
+# ---
+import os
+import uuid
+import fcntl
+import errno
+import shutil
+import hashlib
+import logging
+import contextlib
+
+
+
+# ---
+# Local imports
+# ---
+from integrity import hash_file
+
+
+
+log = logging.getLogger("rich")
+METHODS = ("hardlink", "reflink", "copy")
+FICLONE = 0x40049409 # ioctl sharing the extents of a file (Btrfs, XFS, bcachefs)
+LINK_ERRORS = (errno.EXDEV, errno.EPERM, errno.EACCES, errno.EMLINK, errno.ENOTSUP, errno.EOPNOTSUPP, errno.EINVAL, errno.ENOTTY, errno.EBADF)
+
+
+
+def _name(
+    value,
+):
+    return hashlib.sha256(value.encode()).hexdigest()
+
+
+
+def _fanout(
+    root,
+    name,
+):
+    # <root>/<2 first characters>/<name> : keeps directories small on parallel filesystems
+    return os.path.join(root, name[:2], name)
+
+
+
+def _atomic_symlink(
+    target,
+    path,
+):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    partial = f"{path}.{uuid.uuid4().hex}"
+    os.symlink(target, partial)
+    os.replace(partial, path)
+
+
+
+def _reflink(
+    source,
+    destination,
+):
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+
+class SharedCache:
+    # Layout (every write is a rename or a link, so several users and nodes can share it) :
+    #   objects/<aa>/<sha256>       the payloads, read-only, one per distinct content
+    #   urls/<aa>/<sha256 of url>   symlink to the object of the URL
+    #   refs/<sha256>/<sha256 of path> one file per materialized copy : its path, then the
+    #                               inode, size and mtime it had when it was placed
+    #   used/<aa>/<sha256>          touched on every hit : the mtime gives the LRU order
+    def __init__(
+        self,
+        root,
+        max_size=None,
+        method="hardlink",
+    ):
+        self.root = root
+        self.max_size = max_size # Bytes, None for no cap
+        self.methods = METHODS[METHODS.index(method):] # Falls back to the next methods
+        for folder in ("objects", "urls", "refs", "used", "tmp"):
+            os.makedirs(os.path.join(root, folder), exist_ok=True)
+
+    def object_path(
+        self,
+        digest,
+    ):
+        return _fanout(os.path.join(self.root, "objects"), digest)
+
+    def lookup(
+        self,
+        url,
+    ):
+        # Object path of the URL, or None. Dangling links (evicted objects) are misses.
+        link = _fanout(os.path.join(self.root, "urls"), _name(url))
+        try:
+            path = os.path.normpath(os.path.join(os.path.dirname(link), os.readlink(link)))
+        except OSError:
+            return None
+        if not os.path.exists(path):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(link)
+            return None
+        self.touch(os.path.basename(path))
+        return path
+
+    def touch(
+        self,
+        digest,
+    ):
+        used = _fanout(os.path.join(self.root, "used"), digest)
+        os.makedirs(os.path.dirname(used), exist_ok=True)
+        with open(used, "a"):
+            os.utime(used)
+
+    def add_ref(
+        self,
+        digest,
+        path,
+    ):
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        ref = os.path.join(self.root, "refs", digest, _name(path))
+        os.makedirs(os.path.dirname(ref), exist_ok=True)
+        with open(ref, "w") as f:
+            f.write(f"{path}\n{st.st_dev} {st.st_ino} {st.st_size} {st.st_mtime_ns}")
+
+    def materialize(
+        self,
+        obj,
+        destination,
+    ):
+        # Places the object at `destination` with the first method the filesystem allows.
+        # Returns the method used.
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        partial = f"{destination}.{uuid.uuid4().hex}"
+        for method in self.methods:
+            try:
+                if method == "hardlink":
+                    os.link(obj, partial)
+                elif method == "reflink":
+                    _reflink(obj, partial)
+                else:
+                    shutil.copyfile(obj, partial) # copy_file_range / sendfile under the hood
+                break
+            except OSError as e:
+                if os.path.lexists(partial):
+                    os.remove(partial)
+                if method == "copy" or e.errno not in LINK_ERRORS:
+                    raise
+        os.replace(partial, destination)
+        self.add_ref(os.path.basename(obj), destination)
+        return method
+
+    def ingest(
+        self,
+        url,
+        path,
+        digest,
+    ):
+        # Stores the downloaded file `path` (whose sha256 is `digest`)
+        # as an object, linked rather than copied when both are on the same filesystem.
+        # A payload already stored by another URL or another node is reused as is.
+        obj = self.object_path(digest)
+        if not os.path.exists(obj):
+            os.makedirs(os.path.dirname(obj), exist_ok=True)
+            partial = os.path.join(self.root, "tmp", uuid.uuid4().hex)
+            try:
+                os.link(path, partial)
+            except OSError as e:
+                if e.errno not in LINK_ERRORS:
+                    raise
+                shutil.copyfile(path, partial)
+            os.chmod(partial, 0o444) # Shared by every materialized hardlink : never written in place
+            try:
+                os.link(partial, obj)
+            except FileExistsError:
+                pass
+            os.remove(partial)
+        elif not os.path.samefile(obj, path):
+            self.materialize(obj, path) # Same content stored by someone else : share it
+        link = _fanout(os.path.join(self.root, "urls"), _name(url))
+        _atomic_symlink(os.path.relpath(obj, os.path.dirname(link)), link)
+        self.add_ref(digest, path)
+        self.touch(digest)
+        return obj
+
+    def live_refs(
+        self,
+        digest,
+    ):
+        # Number of materialized copies still in place. Refs whose path was deleted or
+        # replaced by other content are dropped. Hardlinks are the object itself ; reflinks
+        # and copies are live while they keep the inode, size and mtime recorded with the
+        # ref, and are hashed otherwise (or for refs without a record).
+        obj = self.object_path(digest)
+        ref_dir = os.path.join(self.root, "refs", digest)
+        live = 0
+        for name in (os.listdir(ref_dir) if os.path.isdir(ref_dir) else []):
+            ref = os.path.join(ref_dir, name)
+            try:
+                with open(ref, "r") as f:
+                    path, _, record = f.read().partition("\n")
+                st, obj_st = os.stat(path), os.stat(obj)
+                if (st.st_dev, st.st_ino) == (obj_st.st_dev, obj_st.st_ino):
+                    alive = True
+                elif record == f"{st.st_dev} {st.st_ino} {st.st_size} {st.st_mtime_ns}":
+                    alive = True
+                else:
+                    alive = st.st_size == obj_st.st_size and hash_file(path) == digest
+                    if alive:
+                        self.add_ref(digest, path) # Touched but same content : not hashed again
+            except OSError:
+                alive = False
+            if alive:
+                live += 1
+            else:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(ref)
+        return live
+
+    def objects(
+        self,
+    ):
+        # [(digest, size, last used)] of every object
+        objects = []
+        objects_dir = os.path.join(self.root, "objects")
+        for prefix in os.listdir(objects_dir):
+            for digest in os.listdir(os.path.join(objects_dir, prefix)):
+                st = os.stat(os.path.join(objects_dir, prefix, digest))
+                try:
+                    used = os.stat(_fanout(os.path.join(self.root, "used"), digest)).st_mtime
+                except OSError:
+                    used = st.st_mtime
+                objects.append((digest, st.st_size, used))
+        return objects
+
+    def evict(
+        self,
+        max_size=None,
+    ):
+        # Least recently used objects first, among those no materialized copy refers to,
+        # until the cache fits in `max_size`. Returns (number of objects, bytes freed).
+        max_size = self.max_size if max_size is None else max_size
+        if max_size is None:
+            return 0, 0
+        objects = sorted(self.objects(), key=lambda o: o[2])
+        size = sum(o[1] for o in objects)
+        evicted, freed = 0, 0
+        for digest, object_size, _ in objects:
+            if size <= max_size:
+                break
+            if self.live_refs(digest):
+                continue
+            for path in (self.object_path(digest), _fanout(os.path.join(self.root, "used"), digest)):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+            shutil.rmtree(os.path.join(self.root, "refs", digest), ignore_errors=True)
+            size -= object_size
+            freed += object_size
+            evicted += 1
+        return evicted, freed
+
+    def usage(
+        self,
+    ):
+        objects = self.objects()
+        return len(objects), sum(o[1] for o in objects)
+
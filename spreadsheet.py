@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+
+# -----------------------
+# -------------------------------------------------
+# ------------------------------------------------------------------------------------------------
+# De profundiS : Cached datasets index spreadsheet
+# ------------------------------------------------------------------------------------------------
+# -------------------------------------------------
+# -----------------------
+
+
+
+# ---
+# Standard library imports
+# ---
+import os
+import json
+import hashlib
+import logging
+
+
+
+# ---
+# Local imports
+# ---
+from http_client import open_url
+
+
+log = logging.getLogger("rich")
+TIMEOUT = 30
+SPREADSHEET_URL = "https://docs.google.com/spreadsheet/ccc?key={id}&output=csv"
+SNAPSHOT_VERSION = 4 # Bump whenever process_df changes the layout of the processed tables
+
+
+
+class SpreadsheetUnavailable(Exception):
+    pass
+
+
+
+def download_file_from_google_drive(
+    id,
+    destination,
+    headers=None,
+    url=SPREADSHEET_URL,
+):
+    # Returns the final response : a 304 means `destination` was left untouched
+    def save_response_content(
+        response,
+        destination,
+    ):
+        CHUNK_SIZE = 32768
+
+        tmp_destination = destination + ".tmp"
+        with open(tmp_destination, "wb") as f:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                if chunk: # filter out keep-alive new chunks
+                    f.write(chunk)
+        os.replace(tmp_destination, destination)
+
+    URL = url.format(id=id)
+
+    with open_url(URL, headers=headers, timeout=TIMEOUT) as response:
+        response.raise_for_status()
+        if response.status_code != 304:
+            save_response_content(response, destination)
+        return response
+
+
+
+def file_sha256(
+    path,
+):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+
+class SpreadsheetCache:
+    # Keeps the validators (ETag / Last-Modified) of the last download of the CSV,
+    # and a pickled snapshot of the processed DataFrame keyed by the CSV content hash.
+    def __init__(
+        self,
+        cache_dir,
+        spreadsheet_id,
+        url=SPREADSHEET_URL,
+    ):
+        self.cache_dir = cache_dir
+        self.spreadsheet_id = spreadsheet_id
+        self.url = url
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @property
+    def meta_path(self):
+        return os.path.join(self.cache_dir, f"{self.spreadsheet_id}.json")
+
+    def snapshot_path(
+        self,
+        sha256,
+    ):
+        return os.path.join(self.cache_dir, f"index-v{SNAPSHOT_VERSION}-{sha256}.pkl")
+
+    def load_meta(
+        self,
+    ):
+        try:
+            with open(self.meta_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_meta(
+        self,
+        meta,
+    ):
+        tmp_path = self.meta_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self.meta_path)
+
+    def revalidate(
+        self,
+        destination,
+    ):
+        # Conditional GET : only transfers the CSV when it changed on Google's side
+        meta = self.load_meta()
+        headers = {}
+        if os.path.exists(destination) and meta.get("sha256") == self._local_sha256(destination, meta):
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+        response = download_file_from_google_drive(self.spreadsheet_id, destination, headers=headers, url=self.url)
+        if response.status_code == 304:
+            log.info("Spreadsheet not modified since the last run, using the cached copy")
+            return meta
+
+        st = os.stat(destination)
+        meta = {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "sha256": file_sha256(destination),
+            "size": st.st_size,
+            "mtime": st.st_mtime,
+        }
+        self.save_meta(meta)
+        return meta
+
+    def _local_sha256(
+        self,
+        destination,
+        meta,
+    ):
+        # Trust the stored hash while the file keeps the size and mtime it was hashed with
+        st = os.stat(destination)
+        if (meta.get("size"), meta.get("mtime")) == (st.st_size, st.st_mtime):
+            return meta.get("sha256")
+        return file_sha256(destination)
+
+    def load(
+        self,
+        destination,
+        process,
+        offline=False,
+    ):
+        # Deferred : pandas and requests are only needed once the spreadsheet is loaded
+        import requests
+        import pandas as pd
+        meta = self.load_meta()
+        if not offline:
+            try:
+                meta = self.revalidate(destination)
+            except (requests.RequestException, OSError) as e:
+                log.warning(f"Could not reach the spreadsheet ({e}), falling back to the cached copy")
+
+        if not os.path.exists(destination):
+            raise SpreadsheetUnavailable(destination)
+        sha256 = self._local_sha256(destination, meta)
+
+        # Unchanged sheet : skip the CSV parsing and process_df entirely
+        snapshot_path = self.snapshot_path(sha256)
+        if os.path.exists(snapshot_path):
+            return pd.read_pickle(snapshot_path)
+
+        df = pd.read_csv(
+            destination,
+            header=0,
+        )
+        tables = process(df) # Whatever `process` returns is what the snapshot holds
+        for name in os.listdir(self.cache_dir):
+            if name.startswith("index-") and name.endswith(".pkl"):
+                os.remove(os.path.join(self.cache_dir, name))
+        pd.to_pickle(tables, snapshot_path)
+        return tables
@@ -0,0 +1,397 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+
+# -----------------------
+# -------------------------------------------------
+# ------------------------------------------------------------------------------------------------
+# De profundiS : Persistent status index of the local datasets
+# ------------------------------------------------------------------------------------------------
+# -------------------------------------------------
+# -----------------------
+
+
+
+# ---
+# Standard library imports
+# ---
+import os
+import logging
+import sqlite3
+import collections
+import concurrent.futures
+from time import time
+
+
+
+# ---
+# Local imports
+# ---
+from walker import walk
+from walker import TreeStats
+from walker import WORKERS
+
+
+
+log = logging.getLogger("rich")
+INDEX_FILENAME = ".de-profundis-index.sqlite"
+PROBE_TTL = 7 * 24 * 3600 # Remote sizes are probed again after a week
+
+# Each dataset owns a few top-level entries (downloaded archives, extracted folders).
+# Resolving a status only stats those entries, never the files below them.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS datasets (
+    dataset TEXT PRIMARY KEY,
+    stage TEXT NOT NULL,
+    n_files INTEGER NOT NULL,
+    total_size INTEGER NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS entries (
+    dataset TEXT NOT NULL,
+    path TEXT NOT NULL,
+    is_dir INTEGER NOT NULL,
+    n_files INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    PRIMARY KEY (dataset, path)
+);
+CREATE TABLE IF NOT EXISTS directories (
+    dataset TEXT NOT NULL,
+    entry TEXT NOT NULL,
+    path TEXT NOT NULL,
+    mtime REAL NOT NULL,
+    PRIMARY KEY (dataset, path)
+);
+CREATE TABLE IF NOT EXISTS probes (
+    url TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    accept_ranges INTEGER NOT NULL,
+    probed_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS verified (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    algorithm TEXT NOT NULL,
+    digest TEXT NOT NULL
+);
+"""
+
+
+
+# Added to the copy of the index a shard works on (see StatusIndex.fork) : every dataset,
+# probe and digest it writes is logged, so that only those are folded back
+TRACKING = """
+CREATE TABLE IF NOT EXISTS changes (
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    PRIMARY KEY (kind, key)
+);
+CREATE TRIGGER IF NOT EXISTS dataset_inserted AFTER INSERT ON datasets
+    BEGIN INSERT OR IGNORE INTO changes VALUES ('datasets', NEW.dataset); END;
+CREATE TRIGGER IF NOT EXISTS dataset_deleted AFTER DELETE ON datasets
+    BEGIN INSERT OR IGNORE INTO changes VALUES ('datasets', OLD.dataset); END;
+CREATE TRIGGER IF NOT EXISTS entry_updated AFTER UPDATE ON entries
+    BEGIN INSERT OR IGNORE INTO changes VALUES ('datasets', NEW.dataset); END;
+CREATE TRIGGER IF NOT EXISTS probe_inserted AFTER INSERT ON probes
+    BEGIN INSERT OR IGNORE INTO changes VALUES ('probes', NEW.url); END;
+CREATE TRIGGER IF NOT EXISTS verified_inserted AFTER INSERT ON verified
+    BEGIN INSERT OR IGNORE INTO changes VALUES ('verified', NEW.path); END;
+"""
+
+
+
+def _mtime(
+    path,
+):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+
+def _scan(
+    paths,
+    workers=WORKERS,
+):
+    # One walk for {path: TreeStats} of each tree and the (entry, directory, mtime) of every
+    # directory below them : a file added, removed or renamed at any depth changes the
+    # mtime of its directory, not the one of the entry
+    stats, directories = {path: TreeStats() for path in paths}, []
+    for root, dirpath, files, _ in walk(paths, workers):
+        if dirpath != os.path.dirname(root): # Not the listing of a plain file entry
+            mtime = _mtime(dirpath)
+            if mtime is not None:
+                directories.append((root, dirpath, mtime))
+        for _, st in files:
+            stats[root].add(TreeStats(1, st.st_size, st.st_mtime))
+    return stats, directories
+
+
+
+class StatusIndex:
+    def __init__(
+        self,
+        path,
+        read_only=False,
+    ):
+        # `read_only` opens somebody else's index (e.g. the one of a mirror) without
+        # creating or migrating anything in it
+        self.path = path
+        if read_only:
+            self.connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+            return
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(
+        self,
+    ):
+        self.connection.commit()
+        self.connection.close()
+
+    def fork(
+        self,
+        path,
+    ):
+        # Writes a copy of the index to `path` that logs the changes made to it, for merge
+        copy = sqlite3.connect(path)
+        try:
+            self.connection.commit()
+            self.connection.backup(copy)
+            copy.executescript(TRACKING)
+        finally:
+            copy.close()
+
+    def merge(
+        self,
+        path,
+    ):
+        # Folds in the changes logged by a fork : the datasets it wrote or deleted (with all
+        # their entries), its probes and its digests. Other rows of the fork are stale.
+        changed = "SELECT key FROM fork.changes WHERE kind = ?"
+        self.connection.commit()
+        self.connection.execute("ATTACH DATABASE ? AS fork", (path,))
+        try:
+            with self.connection:
+                self.connection.execute(f"DELETE FROM entries WHERE dataset IN ({changed})", ("datasets",))
+                self.connection.execute(f"DELETE FROM directories WHERE dataset IN ({changed})", ("datasets",))
+                self.connection.execute(f"DELETE FROM datasets WHERE dataset IN ({changed})", ("datasets",))
+                self.connection.execute(f"INSERT INTO datasets SELECT * FROM fork.datasets WHERE dataset IN ({changed})", ("datasets",))
+                self.connection.execute(f"INSERT INTO entries SELECT * FROM fork.entries WHERE dataset IN ({changed})", ("datasets",))
+                self.connection.execute(f"INSERT INTO directories SELECT * FROM fork.directories WHERE dataset IN ({changed})", ("datasets",))
+                self.connection.execute(f"INSERT OR REPLACE INTO probes SELECT * FROM fork.probes WHERE url IN ({changed})", ("probes",))
+                self.connection.execute(f"INSERT OR REPLACE INTO verified SELECT * FROM fork.verified WHERE path IN ({changed})", ("verified",))
+        finally:
+            self.connection.execute("DETACH DATABASE fork")
+
+    def record(
+        self,
+        dataset,
+        paths,
+        stage="downloaded",
+        stats=None,
+    ):
+        # `stats` optionally maps each path to a TreeStats already known by the caller
+        # (e.g. the extractor counts its members), which avoids walking the tree again.
+        # The directories are listed either way, for their mtimes (see entry_stats).
+        stats = dict(stats or {})
+        scanned, directories = _scan([p for p in paths if p not in stats or os.path.isdir(p)])
+        stats.update({p: scanned[p] for p in paths if p not in stats})
+
+        rows = []
+        for p in paths:
+            st = os.stat(p)
+            rows.append((dataset, p, int(os.path.isdir(p)), stats[p].n_files, stats[p].size, st.st_mtime))
+        with self.connection:
+            self.connection.execute("DELETE FROM entries WHERE dataset = ?", (dataset,))
+            self.connection.executemany("INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self.connection.execute("DELETE FROM directories WHERE dataset = ?", (dataset,))
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?)",
+                [(dataset, entry, path, mtime) for entry, path, mtime in directories],
+            )
+            self.connection.execute(
+                "INSERT OR REPLACE INTO datasets VALUES (?, ?, ?, ?, ?)",
+                (dataset, stage, sum(r[3] for r in rows), sum(r[4] for r in rows), time()),
+            )
+
+    def forget(
+        self,
+        dataset,
+    ):
+        with self.connection:
+            self.connection.execute("DELETE FROM entries WHERE dataset = ?", (dataset,))
+            self.connection.execute("DELETE FROM directories WHERE dataset = ?", (dataset,))
+            self.connection.execute("DELETE FROM datasets WHERE dataset = ?", (dataset,))
+
+    def get(
+        self,
+        dataset,
+    ):
+        row = self.connection.execute(
+            "SELECT stage, n_files, total_size, updated_at FROM datasets WHERE dataset = ?",
+            (dataset,),
+        ).fetchone()
+        return None if row is None else dict(zip(("stage", "n_files", "total_size", "updated_at"), row))
+
+    def datasets(
+        self,
+    ):
+        return self.connection.execute(
+            "SELECT dataset, stage, n_files, total_size, updated_at FROM datasets ORDER BY dataset",
+        ).fetchall()
+
+    def entries(
+        self,
+        dataset,
+    ):
+        return self.connection.execute(
+            "SELECT path, is_dir, size, mtime FROM entries WHERE dataset = ?",
+            (dataset,),
+        ).fetchall()
+
+    def entry_stats(
+        self,
+        workers=WORKERS,
+    ):
+        # {path: TreeStats} of the indexed entries that did not change since they were
+        # recorded, so that an inventory can count them without walking them again : the
+        # entry and every directory below it keep their mtime (checked with parallel stats,
+        # far cheaper than listing them). Directory entries recorded without their
+        # directories are not trusted.
+        rows = self.connection.execute("SELECT dataset, path, is_dir, n_files, size, mtime FROM entries").fetchall()
+        below = collections.defaultdict(list)
+        for dataset, entry, path, mtime in self.connection.execute("SELECT dataset, entry, path, mtime FROM directories"):
+            below[(dataset, entry)].append((path, mtime))
+        checks = [(path, mtime) for _, path, _, _, _, mtime in rows] + [d for directories in below.values() for d in directories]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            unchanged = dict(zip(checks, pool.map(lambda check: _mtime(check[0]) == check[1], checks)))
+        stats = {}
+        for dataset, path, is_dir, n_files, size, mtime in rows:
+            directories = below.get((dataset, path), [])
+            if unchanged[(path, mtime)] and (directories or not is_dir) and all(unchanged[d] for d in directories):
+                stats[path] = TreeStats(n_files, size, mtime)
+        return stats
+
+    def resolve(
+        self,
+        dataset,
+    ):
+        # Returns a key of STATUSES : 'downloaded' when every recorded entry is still
+        # in place, 'warning' when one of them changed, and 'unknown' when not indexed.
+        if self.get(dataset) is None:
+            return "unknown"
+        for path, is_dir, size, mtime in self.entries(dataset):
+            try:
+                st = os.stat(path)
+            except OSError:
+                return "warning"
+            if st.st_mtime != mtime or (not is_dir and st.st_size != size):
+                return "warning"
+        return "downloaded"
+
+    def cached_probes(
+        self,
+        urls,
+        ttl=PROBE_TTL,
+    ):
+        # Returns {url: (size, accept_ranges)} for the URLs probed less than `ttl` seconds ago
+        probes = {}
+        for url in urls:
+            row = self.connection.execute(
+                "SELECT size, accept_ranges FROM probes WHERE url = ? AND probed_at > ?",
+                (url, time() - ttl),
+            ).fetchone()
+            if row is not None:
+                probes[url] = (row[0], bool(row[1]))
+        return probes
+
+    def record_probes(
+        self,
+        probes,
+    ):
+        # Failed probes (size -1) are not cached, so that they are retried on the next run
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO probes VALUES (?, ?, ?, ?)",
+                [(url, size, int(accept_ranges), time()) for url, (size, accept_ranges) in probes.items() if size >= 0],
+            )
+
+    def record_verified(
+        self,
+        path,
+        algorithm,
+        digest,
+    ):
+        # The digest stays valid as long as the file keeps this exact size and mtime
+        st = os.stat(path)
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO verified VALUES (?, ?, ?, ?, ?)",
+                (path, st.st_size, st.st_mtime, algorithm, digest),
+            )
+
+    def verified_digest(
+        self,
+        path,
+        algorithm,
+    ):
+        # Returns the cached digest of `path`, or None when the file changed since it was hashed
+        row = self.connection.execute(
+            "SELECT size, mtime, digest FROM verified WHERE path = ? AND algorithm = ?",
+            (path, algorithm),
+        ).fetchone()
+        if row is None:
+            return None
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return row[2] if (st.st_size, st.st_mtime) == (row[0], row[1]) else None
+
+    def rescan(
+        self,
+        workers=WORKERS,
+    ):
+        # Walks every indexed entry in parallel and refreshes the stored counts.
+        # Returns the list of datasets whose content changed or disappeared.
+        rows = self.connection.execute("SELECT dataset, path, n_files, size FROM entries").fetchall()
+        stats, directories = _scan([path for _, path, _, _ in rows], workers)
+        below = collections.defaultdict(list)
+        for entry, path, mtime in directories:
+            below[entry].append((path, mtime))
+        changed = set()
+        with self.connection:
+            for dataset, path, n_files, size in rows:
+                if not os.path.lexists(path):
+                    changed.add(dataset)
+                    continue
+                st = stats[path]
+                if (st.n_files, st.size) != (n_files, size):
+                    changed.add(dataset)
+                self.connection.execute(
+                    "UPDATE entries SET n_files = ?, size = ?, mtime = ? WHERE dataset = ? AND path = ?",
+                    (st.n_files, st.size, os.stat(path).st_mtime, dataset, path),
+                )
+                self.connection.execute("DELETE FROM directories WHERE dataset = ? AND entry = ?", (dataset, path))
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?)",
+                    [(dataset, path, directory, mtime) for directory, mtime in below[path]],
+                )
+            for dataset in changed:
+                log.warning(f"Index entry of {dataset} did not match the filesystem, it will be synchronized again")
+                self.connection.execute("DELETE FROM entries WHERE dataset = ?", (dataset,))
+                self.connection.execute("DELETE FROM directories WHERE dataset = ?", (dataset,))
+                self.connection.execute("DELETE FROM datasets WHERE dataset = ?", (dataset,))
+        return sorted(changed)
@@ -61,4 +61,10 @@ export PYTHONFAULTHANDLER=1
 
 wandb login
 
-python main.py
\ No newline at end of file
+# One task per node : each one picks its shard from SLURM_PROCID
+srun --ntasks-per-node=1 python main.py "$@" &
+wait $!
+# main.py saves its transfer journals and exits with code 3 on SIGUSR1 : requeue to resume
+if [ $? -eq 3 ]; then
+    scontrol requeue $SLURM_JOB_ID
+fi
\ No newline at end of file
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+
+# -----------------------
+# -------------------------------------------------
+# ------------------------------------------------------------------------------------------------
+# De profundiS : Test fixtures : the flat modules and a local HTTP server
+# ------------------------------------------------------------------------------------------------
+# -------------------------------------------------
+# -----------------------
+
+
+
+# ---
+# Standard library imports
+# ---
+import os
+import sys
+
+
+
+# ---
+# Scientific imports
+# ---
+import pytest
+
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, "benchmarks"))
+
+
+
+# ---
+# Local imports
+# ---
+from server import Catalog
+from server import ShapedServer
+
+
+
+@pytest.fixture
+def catalog(
+    tmp_path,
+):
+    return Catalog(str(tmp_path / "served"))
+
+
+
+@pytest.fixture
+def server(
+    catalog,
+):
+    # Serves the catalog (Range requests honoured) : yields the base URL
+    with ShapedServer(catalog) as running:
+        yield running.url
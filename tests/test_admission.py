@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+
+# -----------------------
+# -------------------------------------------------
+# ------------------------------------------------------------------------------------------------
+# De profundiS : Tests of the disk-space-aware admission
+# ------------------------------------------------------------------------------------------------
+# -------------------------------------------------
+# -----------------------
+
+
+# ---
+# Standard library imports
+# ---
+import os
+import json
+
+
+
+# ---
+# Local imports
+# ---
+from admission import Reservations
+from admission import admit
+
+
+
+def test_admit_first_fit():
+    # A dataset too large for what is left is held back, smaller ones behind it still fit
+    assert admit([50, 40, 30, 10], 90) == [0, 1]
+    assert admit([50, 60, 30, 10], 90) == [0, 2, 3]
+    assert admit([100], 0) == []
+
+
+
+def test_reservations_shared(
+    tmp_path,
+):
+    # Two shards of the same scratch see each other's reservations
+    path = str(tmp_path / "datasets" / "reservations.json")
+    first, second = Reservations(path, "42-0"), Reservations(path, "42-1")
+    assert first.total() == 0
+    first.reserve({"P/T/a": 100, "P/T/b": 50})
+    second.reserve({"P/T/c": 30})
+    assert first.total() == second.total() == 180
+
+    first.reserve({"P/T/a": 0, "P/T/b": 20}) # a extracted, b's archive still waiting
+    assert second.total() == 50
+    second.clear()
+    assert first.total() == 20
+    first.clear()
+    with open(path) as f:
+        assert json.load(f) == {}
+
+
+
+def test_reservations_expire(
+    tmp_path,
+):
+    # A job that died without releasing its reservations does not hold them forever
+    path = str(tmp_path / "reservations.json")
+    Reservations(path, "dead").reserve({"P/T/a": 100})
+    assert Reservations(path, "alive", ttl=3600).total() == 100
+    assert Reservations(path, "alive", ttl=0).total() == 0
+
+
+
+def test_reservations_unreadable(
+    tmp_path,
+):
+    path = tmp_path / "reservations.json"
+    path.write_text("{not json")
+    reservations = Reservations(str(path), "42-0")
+    assert reservations.total() == 0
+    reservations.reserve({"P/T/a": 10})
+    assert reservations.total() == 10
+    assert not [name for name in os.listdir(tmp_path) if name != "reservations.json"]
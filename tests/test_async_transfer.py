@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+
+# -----------------------
+# -------------------------------------------------
+# ------------------------------------------------------------------------------------------------
+# De profundiS : Tests of the asyncio download backend
+# ------------------------------------------------------------------------------------------------
+# -------------------------------------------------
+# -----------------------
+
+
+# ---
+# Standard library imports
+# ---
+import os
+import hashlib
+
+
+
+# ---
+# Scientific imports
+# ---
+import pytest
+
+
+
+# ---
+# Local imports
+# ---
+from transfer import TokenBucket
+
+aiohttp = pytest.importorskip("aiohttp")
+from async_transfer import download_urls_async # noqa: E402
+
+
+
+def test_download_duplicate_url(
+    catalog,
+    server,
+    tmp_path,
+):
+    # One URL listed with two destinations : fetched once, copied to the other, both verified
+    data = os.urandom(100 * 1024)
+    name = catalog.add_file("shared.bin", data)
+    url = f"{server}/files/{name}"
+    first, second = str(tmp_path / "a" / "shared.bin"), str(tmp_path / "b" / "shared.bin")
+    fetched, verified = [], []
+    errors = download_urls_async(
+        [(url, first, "a"), (url, second, "b")],
+        TokenBucket(0),
+        checksums={url: ("sha256", hashlib.sha256(data).hexdigest())},
+        on_verified=lambda url, destination, algorithm, digest: verified.append(destination),
+        on_fetched=lambda url, n, *_: fetched.append(n),
+    )
+    assert errors == {url: None}
+    assert fetched == [len(data)]
+    for destination in (first, second):
+        with open(destination, "rb") as f:
+            assert f.read() == data
+        assert not os.path.exists(destination + ".part")
+    assert sorted(verified) == sorted([first, second])
+
+
+
+@pytest.mark.parametrize("kept", [0.5, 1.0])
+def test_resume_part(
+    catalog,
+    server,
+    tmp_path,
+    kept,
+):
+    # A `.part` left by an interrupted run : only the rest is fetched, and a complete one
+    # (stopped before its rename) is verified and renamed without fetching anything
+    data = os.urandom(64 * 1024)
+    name = catalog.add_file("resumed.bin", data)
+    url = f"{server}/files/{name}"
+    destination = tmp_path / "resumed.bin"
+    with open(f"{destination}.part", "wb") as f:
+        f.write(data[:int(len(data) * kept)])
+    progress = []
+    errors = download_urls_async(
+        [(url, str(destination), "d")],
+        TokenBucket(0),
+        checksums={url: ("sha256", hashlib.sha256(data).hexdigest())},
+        on_progress=progress.append,
+    )
+    assert errors == {url: None}
+    assert destination.read_bytes() == data
+    assert sum(progress) == len(data) - int(len(data) * kept)
+    assert not os.path.exists(f"{destination}.part")
+
+
+
+def test_stale_part_restarted(
+    catalog,
+    server,
+    tmp_path,
+):
+    # A `.part` longer than the file is not the file it was started from : fetched again
+    name = catalog.add_file("small.bin", b"small")
+    url = f"{server}/files/{name}"
+    destination = tmp_path / "small.bin"
+    with open(f"{destination}.part", "wb") as f:
+        f.write(b"much longer than the file")
+    errors = download_urls_async([(url, str(destination), "d")], TokenBucket(0))
+    assert errors == {url: None}
+    assert destination.read_bytes() == b"small"
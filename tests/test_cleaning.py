@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+
+# -----------------------
+# -------------------------------------------------
+# ------------------------------------------------------------------------------------------------
+# De profundiS : Tests of the parallel tree removal
+# ------------------------------------------------------------------------------------------------
+# -------------------------------------------------
+# -----------------------
+
+
+
+# ---
+# Standard library imports
+# ---
+import os
+
+
+
+# ---
+# Local imports
+# ---
+from cleaning import remove_trees
+
+
+
+def test_remove_trees(
+    tmp_path,
+):
+    tree = tmp_path / "tree"
+    for i in range(3):
+        (tree / f"d{i}" / "nested").mkdir(parents=True)
+        for j in range(5):
+            (tree / f"d{i}" / "nested" / f"f{j}").write_bytes(b"x")
+        (tree / f"d{i}" / "top").write_bytes(b"y")
+    single = tmp_path / "single.bin"
+    single.write_bytes(b"z")
+    kept = tmp_path / "kept"
+    kept.mkdir()
+    (kept / "file").write_bytes(b"k")
+    os.symlink(kept, tree / "link") # Removed as a link, its target is kept
+
+    removed = []
+    n_files, n_dirs, errors = remove_trees([str(tree), str(single)], workers=4, on_removed=removed.append)
+    assert (n_files, n_dirs, errors) == (3 * 6 + 1 + 1, 1 + 3 * 2, 0)
+    assert sum(removed) == n_files
+    assert not tree.exists() and not single.exists()
+    assert (kept / "file").exists()
+
+
+
+def test_remove_trees_missing(
+    tmp_path,
+):
+    assert remove_trees([str(tmp_path / "missing")]) == (0, 0, 0)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+
+# -----------------------
+# -------------------------------------------------
+# ------------------------------------------------------------------------------------------------
+# De profundiS : Tests of the archive extraction
+# ------------------------------------------------------------------------------------------------
+# -------------------------------------------------
+# -----------------------
+
+
+
+# ---
+# Standard library imports
+# ---
+import os
+import io
+import tarfile
+import zipfile
+
+
+
+# ---
+# Local imports
+# ---
+from extract import _top_level
+from extract import extract_archives
+
+
+
+def _tar(
+    path,
+    members,
+):
+    with tarfile.open(path, "w:gz") as tar:
+        for name, data in members.items():
+            info = tarfile.TarInfo(name)
+            if data is None:
+                info.type = tarfile.DIRTYPE
+                tar.addfile(info)
+            else:
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+
+
+
+def test_top_level(
+    tmp_path,
+):
+    target = str(tmp_path)
+    assert _top_level(target, "dataset/part/item.txt") == os.path.join(target, "dataset")
+    assert _top_level(target, "./dataset/item.txt") == os.path.join(target, "dataset")
+    assert _top_level(target, "dataset/") == os.path.join(target, "dataset")
+    assert _top_level(target, "item.txt") == os.path.join(target, "item.txt")
+    assert _top_level(target, "./") is None
+    assert _top_level(target, ".") is None
+    assert _top_level(target, "") is None
+
+
+
+def test_extract_dot_rooted_tar(
+    tmp_path,
+):
+    # './'-rooted archives (tar -C dir .) must not report the target directory itself
+    archive = str(tmp_path / "dataset.tar.gz")
+    _tar(archive, {"./": None, "./train/": None, "./train/a.txt": b"aaa", "./b.txt": b"bb"})
+    target = str(tmp_path / "out")
+    results = extract_archives([(archive, target)], 2)
+    error, top_level, stats = results[archive]
+    assert error is None
+    assert top_level == [os.path.join(target, "b.txt"), os.path.join(target, "train")]
+    assert (stats.n_files, stats.size) == (2, 5)
+    with open(os.path.join(target, "train", "a.txt"), "rb") as f:
+        assert f.read() == b"aaa"
+
+
+
+def test_extract_zip(
+    tmp_path,
+):
+    archive = str(tmp_path / "dataset.zip")
+    with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as z:
+        for i in range(20):
+            z.writestr(f"dataset/part-{i % 2}/item-{i:02d}.txt", f"{i}" * 10)
+    target = str(tmp_path / "out")
+    extracted = []
+    results = extract_archives([(archive, target)], 2, on_extracted=lambda archive, stats: extracted.append(archive))
+    error, top_level, stats = results[archive]
+    assert error is None
+    assert top_level == [os.path.join(target, "dataset")]
+    assert stats.n_files == 20
+    assert extracted == [archive]
+    assert len(os.listdir(os.path.join(target, "dataset", "part-1"))) == 10
+
+
+
+def test_extract_corrupt(
+    tmp_path,
+):
+    archive = tmp_path / "broken.zip"
+    archive.write_bytes(b"not a zip")
+    results = extract_archives([(str(archive), str(tmp_path / "out"))], 1)
+    assert results[str(archive)][0] is not None
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+
+# -----------------------
+# -------------------------------------------------
+# ------------------------------------------------------------------------------------------------
+# De profundiS : Tests of the archive member index
+# ------------------------------------------------------------------------------------------------
+# -------------------------------------------------
+# -----------------------
+
+
+
+# ---
+# Standard library imports
+# ---
+import os
+import io
+import gc
+import tarfile
+import zipfile
+import warnings
+
+
+
+# ---
+# Scientific imports
+# ---
+import pytest
+
+
+
+# ---
+# Local imports
+# ---
+from members import ArchiveIndex
+from members import extract_members
+from members import index_path
+
+
+
+MEMBERS = {f"dataset/part-{i % 3}/item-{i:02d}.txt": f"{i:02d}".encode() * (i + 1) for i in range(12)}
+
+
+
+@pytest.fixture(params=["dataset.zip", "dataset.tar.gz", "dataset.tar"])
+def archive(
+    request,
+    tmp_path,
+):
+    path = str(tmp_path / request.param)
+    if path.endswith(".zip"):
+        with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as z:
+            z.writestr("dataset/", b"")
+            for name, data in MEMBERS.items():
+                z.writestr(name, data)
+    else:
+        with tarfile.open(path, "w:gz" if path.endswith(".gz") else "w") as tar:
+            for name, data in MEMBERS.items():
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+    return path
+
+
+
+def test_index_persisted(
+    archive,
+):
+    members = ArchiveIndex.load(archive)
+    assert os.path.exists(index_path(archive))
+    assert set(MEMBERS) <= set(members.names())
+    reloaded = ArchiveIndex.load(archive)
+    assert reloaded.names() == members.names()
+    assert list(reloaded.offsets) == list(members.offsets)
+
+
+
+def test_index_rebuilt_on_change(
+    archive,
+):
+    ArchiveIndex.load(archive)
+    with zipfile.ZipFile(archive, "w") if archive.endswith(".zip") else tarfile.open(archive, "w") as out:
+        if isinstance(out, zipfile.ZipFile):
+            out.writestr("other.txt", b"other")
+        else:
+            info = tarfile.TarInfo("other.txt")
+            info.size = 5
+            out.addfile(info, io.BytesIO(b"other"))
+    assert ArchiveIndex.load(archive).names() == ["other.txt"]
+
+
+
+def test_read(
+    archive,
+):
+    members = ArchiveIndex.load(archive)
+    for name, data in MEMBERS.items():
+        assert members.read(name) == data
+    with members.open(members.index("dataset/part-1/item-04.txt")) as f:
+        assert f.read(2) == b"04"
+    if archive.endswith(".zip"):
+        with pytest.raises(IsADirectoryError):
+            members.open("dataset/")
+
+
+
+def test_read_closes_archive(
+    archive,
+):
+    # Nothing left for the garbage collector to close (unclosed files warn when collected)
+    members = ArchiveIndex.load(archive)
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always", ResourceWarning)
+        for name in MEMBERS:
+            members.read(name)
+        gc.collect()
+    assert not [w for w in caught if issubclass(w.category, ResourceWarning)]
+
+
+
+def test_match_and_extract(
+    archive,
+    tmp_path,
+):
+    members = ArchiveIndex.load(archive)
+    positions = members.match(["*/part-1/*"])
+    assert sorted(members.name(i) for i in positions) == sorted(name for name in MEMBERS if "/part-1/" in name)
+
+    target = str(tmp_path / "out")
+    top_level, stats = members.extract(positions, target)
+    assert top_level == {os.path.join(target, "dataset")}
+    assert stats.n_files == len(positions)
+    assert sorted(os.listdir(os.path.join(target, "dataset"))) == ["part-1"]
+    for i in positions:
+        with open(os.path.join(target, members.name(i)), "rb") as f:
+            assert f.read() == MEMBERS[members.name(i)]
+
+
+
+def test_extract_members(
+    archive,
+    tmp_path,
+):
+    target = str(tmp_path / "out")
+    results = extract_members([(archive, target)], ["dataset/part-2/*"], workers=2)
+    error, top_level, stats = results[archive]
+    assert error is None
+    assert top_level == [os.path.join(target, "dataset")]
+    assert stats.n_files == 4
+    assert os.path.exists(archive) # Partial extraction keeps the archive
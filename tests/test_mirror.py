@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+
+# -----------------------
+# -------------------------------------------------
+# ------------------------------------------------------------------------------------------------
+# De profundiS : Tests of the block-level delta sync
+# ------------------------------------------------------------------------------------------------
+# -------------------------------------------------
+# -----------------------
+
+
+# ---
+# Standard library imports
+# ---
+import os
+import random
+
+
+
+# ---
+# Scientific imports
+# ---
+import pytest
+
+
+
+# ---
+# Local imports
+# ---
+import mirror
+from mirror import block_signatures
+from mirror import plan_delta
+from mirror import sync_file
+from mirror import sync_trees
+
+
+
+BLOCK = 64
+BASIS = random.Random(0).randbytes(64 * BLOCK + 17)
+EDITS = {
+    "insert": BASIS[:1000] + b"inserted bytes" + BASIS[1000:],
+    "delete": BASIS[:1000] + BASIS[1500:],
+    "append": BASIS + b"appended" * 40,
+    "shrink": BASIS[:20 * BLOCK + 5],
+    "replace": random.Random(1).randbytes(len(BASIS)),
+    "empty": b"",
+    "sub-block": BASIS[:BLOCK // 2],
+}
+REUSABLE = { # Bytes of the basis every edit leaves in whole blocks
+    "insert": 62 * BLOCK,
+    "delete": 54 * BLOCK,
+    "append": 64 * BLOCK,
+    "shrink": 20 * BLOCK,
+}
+
+
+
+def _write(
+    path,
+    data,
+    mtime=None,
+):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+
+
+def _read(
+    path,
+):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+
+@pytest.mark.parametrize("edit", list(EDITS))
+def test_plan_delta(
+    tmp_path,
+    edit,
+):
+    # Applying the instructions to the basis gives the source back
+    basis, source = str(tmp_path / "basis"), str(tmp_path / "source")
+    _write(basis, BASIS)
+    _write(source, EDITS[edit])
+    ops = plan_delta(source, block_signatures(basis, BLOCK), BLOCK)
+    rebuilt = b"".join(BASIS[o:o + n] if kind == "basis" else EDITS[edit][o:o + n] for kind, o, n in ops)
+    assert rebuilt == EDITS[edit]
+    # Only the blocks around the edit are sent again
+    matched = sum(n for kind, _, n in ops if kind == "basis")
+    assert matched >= REUSABLE.get(edit, 0)
+    if edit not in REUSABLE:
+        assert matched == 0
+
+
+
+@pytest.mark.parametrize("edit", list(EDITS))
+@pytest.mark.parametrize("zero_copy", [True, False])
+def test_sync_file(
+    tmp_path,
+    monkeypatch,
+    edit,
+    zero_copy,
+):
+    if not zero_copy:
+        monkeypatch.setattr(mirror, "_zero_copy", {"copy_file_range": False, "sendfile": False})
+    source, target = str(tmp_path / "mirror" / "f.bin"), str(tmp_path / "scratch" / "f.bin")
+    _write(target, BASIS, mtime=1000)
+    _write(source, EDITS[edit], mtime=2000)
+    stats = sync_file(source, target, BLOCK)
+    assert _read(target) == EDITS[edit]
+    assert os.stat(target).st_mtime == 2000
+    assert not os.path.exists(target + mirror.SUFFIX)
+    assert stats.matched + stats.literal == len(EDITS[edit])
+    assert stats.n_patched == 1
+    if edit == "insert":
+        assert stats.literal < 3 * BLOCK + len(b"inserted bytes")
+
+
+
+def test_sync_file_without_basis(
+    tmp_path,
+):
+    source, target = str(tmp_path / "mirror" / "f.bin"), str(tmp_path / "scratch" / "f.bin")
+    _write(source, BASIS)
+    stats = sync_file(source, target, BLOCK)
+    assert _read(target) == BASIS
+    assert (stats.n_copied, stats.literal) == (1, len(BASIS))
+    assert sync_file(source, target, BLOCK).n_skipped == 1 # Same size and mtime
+
+
+
+def test_sync_trees(
+    tmp_path,
+):
+    source, target = tmp_path / "mirror" / "dataset", tmp_path / "scratch" / "dataset"
+    _write(str(source / "a" / "changed.bin"), EDITS["insert"], mtime=2000)
+    _write(str(source / "b" / "new.bin"), b"new")
+    _write(str(source / "same.bin"), b"same", mtime=1000)
+    _write(str(target / "a" / "changed.bin"), BASIS, mtime=1000)
+    _write(str(target / "same.bin"), b"same", mtime=1000)
+    _write(str(target / "extra.bin"), b"kept")
+    os.symlink("same.bin", source / "link")
+    total, errors = sync_trees([(str(source), str(target)), (str(tmp_path / "mirror" / "missing"), str(tmp_path / "missing"))], workers=4, block_size=BLOCK)
+    assert list(errors) == [str(tmp_path / "mirror" / "missing")]
+    assert (total.n_files, total.n_skipped, total.n_patched, total.n_copied) == (4, 1, 1, 2)
+    assert _read(str(target / "a" / "changed.bin")) == EDITS["insert"]
+    assert _read(str(target / "b" / "new.bin")) == b"new"
+    assert os.readlink(target / "link") == "same.bin"
+    assert _read(str(target / "extra.bin")) == b"kept" # Nothing is deleted from the targets
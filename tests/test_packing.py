@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+
+# -----------------------
+# -------------------------------------------------
+# ------------------------------------------------------------------------------------------------
+# De profundiS : Tests of the dataset packing
+# ------------------------------------------------------------------------------------------------
+# -------------------------------------------------
+# -----------------------
+
+
+# ---
+# Standard library imports
+# ---
+import os
+
+
+
+# ---
+# Local imports
+# ---
+import packing
+from packing import PackReader
+from packing import is_packed
+from packing import pack_tree
+
+
+
+def _tree(
+    root,
+    files,
+):
+    for key, data in files.items():
+        path = os.path.join(root, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+
+
+
+def test_pack_round_trip(
+    tmp_path,
+    monkeypatch,
+):
+    # Small files read by the pool, large ones copied by the kernel, empty ones kept ;
+    # shards of about 1 KB
+    monkeypatch.setattr(packing, "READ_LIMIT", 256)
+    monkeypatch.setattr(packing, "BATCH", 3)
+    base = str(tmp_path / "dataset")
+    files = {f"train/{i:03d}.bin": os.urandom(i * 37 % 500) for i in range(30)}
+    files["train/empty.bin"] = b""
+    files["test/large.bin"] = os.urandom(3000) # Larger than a shard : alone in its own
+    files["test/ünicode.txt"] = "ü".encode()
+    _tree(base, files)
+    pack_dir = str(tmp_path / "dataset.pack")
+    packed = []
+    stats = pack_tree([os.path.join(base, "train"), os.path.join(base, "test")], base, pack_dir, shard_size=1024, workers=4, on_packed=packed.append)
+    assert is_packed(pack_dir)
+    assert not os.path.exists(pack_dir + packing.PARTIAL_SUFFIX)
+    assert (stats.n_files, stats.size) == (len(files), sum(len(data) for data in files.values()))
+    assert stats.n_shards > 3
+    assert sum(packed) == len(files)
+
+    with PackReader(pack_dir) as pack:
+        assert len(pack) == len(files)
+        assert pack.keys() == sorted(files)
+        for key, data in files.items():
+            assert bytes(pack[key]) == data
+        assert [(key, bytes(sample)) for key, sample in pack.iterate(prefetch=4)] == sorted(files.items())
+        assert [key for key, _ in pack.iterate(5, 8)] == sorted(files)[5:8]
+
+
+
+def test_pack_empty(
+    tmp_path,
+):
+    # Nothing but empty files, then nothing at all
+    base = str(tmp_path / "dataset")
+    _tree(base, {"a/empty-1": b"", "a/empty-2": b""})
+    pack_dir = str(tmp_path / "dataset.pack")
+    stats = pack_tree([os.path.join(base, "a")], base, pack_dir)
+    assert (stats.n_files, stats.size, stats.n_shards) == (2, 0, 1)
+    with PackReader(pack_dir) as pack:
+        assert [(key, bytes(sample)) for key, sample in pack.iterate()] == [("a/empty-1", b""), ("a/empty-2", b"")]
+
+    os.makedirs(os.path.join(base, "b"))
+    stats = pack_tree([os.path.join(base, "b")], base, pack_dir)
+    assert (stats.n_files, stats.n_shards) == (0, 0)
+    with PackReader(pack_dir) as pack:
+        assert len(pack) == 0 and list(pack.iterate()) == []
+
+
+
+def test_repack_replaces(
+    tmp_path,
+):
+    # An interrupted pack (no index) is not a pack ; packing again replaces the old one whole
+    base = str(tmp_path / "dataset")
+    pack_dir = str(tmp_path / "dataset.pack")
+    os.makedirs(pack_dir + packing.PARTIAL_SUFFIX)
+    assert not is_packed(pack_dir + packing.PARTIAL_SUFFIX)
+    _tree(base, {"a/x": b"1" * 100})
+    pack_tree([os.path.join(base, "a")], base, pack_dir, shard_size=10)
+    _tree(base, {"a/y": b"2"})
+    os.remove(os.path.join(base, "a", "x"))
+    pack_tree([os.path.join(base, "a")], base, pack_dir)
+    assert sorted(os.listdir(pack_dir)) == [packing.INDEX_FILENAME, packing.SHARD_PATTERN.format(0)]
+    with PackReader(pack_dir) as pack:
+        assert pack.keys() == ["a/y"] and bytes(pack[0]) == b"2"
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+
+# -----------------------
+# -------------------------------------------------
+# ------------------------------------------------------------------------------------------------
+# De profundiS : Tests of the dataset selection engine
+# ------------------------------------------------------------------------------------------------
+# -------------------------------------------------
+# -----------------------
+
+
+# ---
+# Standard library imports
+# ---
+import re
+import random
+import fnmatch
+
+
+
+# ---
+# Scientific imports
+# ---
+import pandas as pd
+import pytest
+
+
+
+# ---
+# Local imports
+# ---
+from selection import categorize
+from selection import match
+from selection import select
+
+
+
+RULES = [
+    [("Project", ["vision"], [])],
+    [("Project", ["vision", "audio"], []), ("Task", [], ["detection"])],
+    [("Task", ["seg*"], [])],
+    [("Dataset name", ["re:coco-\\d+", "imagenet?"], ["*-7"])],
+    [("Project", ["re:(vis|aud).*"], ["audio"]), ("Dataset name", ["[a-c]*"], [])],
+    [("Project", ["missing"], [])],
+    [("Task", [], ["re:.*"])],
+]
+
+
+
+def _catalog(
+    n=500,
+    seed=0,
+):
+    rng = random.Random(seed)
+    names = ["coco", "imagenet", "ade", "librispeech", "books", "c4"]
+    return pd.DataFrame({
+        "Project": [rng.choice(["vision", "audio", "text", None]) for _ in range(n)],
+        "Task": [rng.choice(["detection", "segmentation", "seg", "asr", "lm"]) for _ in range(n)],
+        "Dataset name": [f"{rng.choice(names)}{rng.choice(['', '-1', '-7', '-12', 's'])}" for _ in range(n)],
+    })
+
+
+
+def _naive(
+    value,
+    values,
+):
+    # One value against the CLI values, the slow and obvious way
+    if value is None:
+        return False
+    for v in values:
+        if v.startswith("re:"):
+            if re.fullmatch(v[3:], value):
+                return True
+        elif fnmatch.fnmatchcase(value, v) if set("*?[") & set(v) else value == v:
+            return True
+    return False
+
+
+
+def _naive_select(
+    df,
+    rules,
+):
+    keep = []
+    for _, row in df.iterrows():
+        value = lambda key: None if pd.isna(row[key]) else str(row[key])
+        keep.append(all(
+            (not include or _naive(value(key), include)) and not (exclude and _naive(value(key), exclude))
+            for key, include, exclude in rules
+        ))
+    return df[keep]
+
+
+
+@pytest.mark.parametrize("categorical", [False, True])
+@pytest.mark.parametrize("rules", RULES)
+def test_select_matches_naive(
+    rules,
+    categorical,
+):
+    df = _catalog()
+    expected = _naive_select(df, rules)
+    if categorical:
+        categorize(df)
+        assert isinstance(df["Project"].dtype, pd.CategoricalDtype)
+    selected = select(df, rules)
+    assert list(selected.index) == list(expected.index)
+
+
+
+def test_match_categorical_missing():
+    # Missing values (code -1) never match, even a pattern matching anything
+    column = pd.Series(["a", None, "b"], dtype="category")
+    assert list(match(column, ["re:.*"])) == [True, False, True]
+    assert list(match(column.astype(object), ["re:.*"])) == [True, False, True]
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+
+# -----------------------
+# -------------------------------------------------
+# ------------------------------------------------------------------------------------------------
+# De profundiS : Tests of the shared dataset cache
+# ------------------------------------------------------------------------------------------------
+# -------------------------------------------------
+# -----------------------
+
+
+# ---
+# Standard library imports
+# ---
+import os
+import errno
+import hashlib
+
+
+
+# ---
+# Scientific imports
+# ---
+import pytest
+
+
+
+# ---
+# Local imports
+# ---
+import shared_cache
+from shared_cache import SharedCache
+
+
+
+def _download(
+    path,
+    data,
+):
+    # A file as the downloader leaves it, with its sha256
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+    return hashlib.sha256(data).hexdigest()
+
+
+
+def _age(
+    cache,
+    digest,
+    seconds,
+):
+    used = os.path.join(cache.root, "used", digest[:2], digest)
+    os.utime(used, (seconds, seconds))
+
+
+
+def test_ingest_and_lookup(
+    tmp_path,
+):
+    cache = SharedCache(str(tmp_path / "cache"))
+    path = str(tmp_path / "project" / "a.bin")
+    digest = _download(path, b"payload")
+    obj = cache.ingest("http://host/a.bin", path, digest)
+    assert obj == cache.object_path(digest)
+    assert os.path.samefile(obj, path)
+    assert not os.stat(obj).st_mode & 0o222
+    assert cache.lookup("http://host/a.bin") == obj
+    assert cache.lookup("http://host/other.bin") is None
+    assert cache.usage() == (1, len(b"payload"))
+
+    # Same content from another URL : one object, shared
+    other = str(tmp_path / "other" / "b.bin")
+    _download(other, b"payload")
+    assert cache.ingest("http://mirror/b.bin", other, digest) == obj
+    assert os.path.samefile(obj, other)
+    assert cache.usage() == (1, len(b"payload"))
+
+
+
+def test_lookup_evicted(
+    tmp_path,
+):
+    cache = SharedCache(str(tmp_path / "cache"))
+    path = str(tmp_path / "a.bin")
+    obj = cache.ingest("http://host/a.bin", path, _download(path, b"payload"))
+    os.remove(obj)
+    assert cache.lookup("http://host/a.bin") is None
+
+
+
+@pytest.mark.parametrize("method", ["hardlink", "reflink", "copy"])
+def test_materialize(
+    tmp_path,
+    method,
+):
+    # Reflinks fall back to copies on filesystems without shared extents
+    cache = SharedCache(str(tmp_path / "cache"), method=method)
+    path = str(tmp_path / "a.bin")
+    obj = cache.ingest("http://host/a.bin", path, _download(path, b"payload"))
+    destination = str(tmp_path / "project" / "a.bin")
+    used = cache.materialize(obj, destination)
+    assert used in shared_cache.METHODS[shared_cache.METHODS.index(method):]
+    assert os.path.samefile(obj, destination) == (used == "hardlink")
+    with open(destination, "rb") as f:
+        assert f.read() == b"payload"
+    assert [name for name in os.listdir(os.path.dirname(destination))] == ["a.bin"]
+
+
+
+def test_materialize_fallback(
+    tmp_path,
+    monkeypatch,
+):
+    # Hardlinks refused (another filesystem) : the next methods are tried
+    cache = SharedCache(str(tmp_path / "cache"))
+    path = str(tmp_path / "a.bin")
+    obj = cache.ingest("http://host/a.bin", path, _download(path, b"payload"))
+    def link(
+        source,
+        destination,
+    ):
+        raise OSError(errno.EXDEV, "cross-device link")
+    monkeypatch.setattr(os, "link", link)
+    destination = str(tmp_path / "project" / "a.bin")
+    assert cache.materialize(obj, destination) in ("reflink", "copy")
+    assert not os.path.samefile(obj, destination)
+    with open(destination, "rb") as f:
+        assert f.read() == b"payload"
+
+
+
+def test_evict_lru(
+    tmp_path,
+):
+    # Oldest unreferenced objects go first, until the cache fits
+    cache = SharedCache(str(tmp_path / "cache"))
+    digests = []
+    for i in range(3):
+        path = str(tmp_path / f"{i}.bin")
+        digests.append(_download(path, bytes([i]) * 100))
+        cache.ingest(f"http://host/{i}.bin", path, digests[-1])
+        os.remove(path)
+        _age(cache, digests[-1], 1000 + i)
+    assert cache.evict(max_size=150) == (2, 200)
+    assert [digest for digest, _, _ in cache.objects()] == [digests[2]]
+    assert cache.lookup("http://host/0.bin") is None
+
+
+
+def test_evict_keeps_live_refs(
+    tmp_path,
+):
+    cache = SharedCache(str(tmp_path / "cache"), method="copy")
+    kept, dropped = str(tmp_path / "kept.bin"), str(tmp_path / "dropped.bin")
+    kept_digest = _download(kept, b"k" * 100)
+    dropped_digest = _download(dropped, b"d" * 100)
+    cache.ingest("http://host/kept.bin", kept, kept_digest)
+    cache.ingest("http://host/dropped.bin", dropped, dropped_digest)
+    os.remove(dropped)
+    copy = str(tmp_path / "project" / "kept.bin")
+    cache.materialize(cache.object_path(kept_digest), copy)
+    os.remove(kept) # Only the copy refers to it now
+    _age(cache, kept_digest, 1000)
+    _age(cache, dropped_digest, 2000)
+    assert cache.evict(max_size=0) == (1, 100)
+    assert os.path.exists(cache.object_path(kept_digest))
+    assert not os.path.exists(cache.object_path(dropped_digest))
+
+
+
+def test_replaced_copy_not_live(
+    tmp_path,
+):
+    # A copy rewritten with other content of the same size no longer pins its object
+    cache = SharedCache(str(tmp_path / "cache"), method="copy")
+    path = str(tmp_path / "a.bin")
+    digest = _download(path, b"a" * 100)
+    obj = cache.ingest("http://host/a.bin", path, digest)
+    os.remove(path)
+    copy = str(tmp_path / "project" / "a.bin")
+    cache.materialize(obj, copy)
+    assert cache.live_refs(digest) == 1
+    os.utime(copy, ns=(0, 0)) # Touched, same content : still live
+    assert cache.live_refs(digest) == 1
+    with open(copy, "wb") as f:
+        f.write(b"b" * 100)
+    assert cache.live_refs(digest) == 0
+    assert cache.evict(max_size=0) == (1, 100)
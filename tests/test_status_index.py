@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+
+# -----------------------
+# -------------------------------------------------
+# ------------------------------------------------------------------------------------------------
+# De profundiS : Tests of the persistent status index
+# ------------------------------------------------------------------------------------------------
+# -------------------------------------------------
+# -----------------------
+
+
+# ---
+# Standard library imports
+# ---
+import os
+import sqlite3
+
+
+
+# ---
+# Local imports
+# ---
+from status_index import StatusIndex
+from walker import TreeStats
+
+
+
+def _tree(
+    root,
+    files,
+):
+    for name, data in files.items():
+        path = os.path.join(root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+    return str(root)
+
+
+
+def _touch(
+    path,
+    mtime,
+):
+    os.utime(path, (mtime, mtime))
+
+
+
+def test_record_and_resolve(
+    tmp_path,
+):
+    extracted = _tree(tmp_path / "scratch" / "a", {"x/1.txt": b"11", "x/2.txt": b"2"})
+    archive = _tree(tmp_path / "scratch", {"b.zip": b"zip"})
+    archive = os.path.join(archive, "b.zip")
+    with StatusIndex(str(tmp_path / "index.sqlite")) as index:
+        assert index.resolve("P/T/a") == "unknown"
+        index.record("P/T/a", [extracted], stage="extracted")
+        index.record("P/T/b", [archive], stats={archive: TreeStats(1, 3, 0.0)})
+        assert index.get("P/T/a")["stage"] == "extracted"
+        assert (index.get("P/T/a")["n_files"], index.get("P/T/a")["total_size"]) == (2, 3)
+        assert [row[0] for row in index.datasets()] == ["P/T/a", "P/T/b"]
+        assert index.resolve("P/T/a") == index.resolve("P/T/b") == "downloaded"
+
+        _touch(archive, 1000) # A file entry that changed
+        assert index.resolve("P/T/b") == "warning"
+        os.rename(extracted, extracted + ".moved") # A directory entry gone
+        assert index.resolve("P/T/a") == "warning"
+        index.forget("P/T/a")
+        assert index.resolve("P/T/a") == "unknown"
+
+
+
+def test_entry_stats(
+    tmp_path,
+):
+    # Entries are trusted as long as no directory below them changed
+    extracted = _tree(tmp_path / "a", {"x/y/1.txt": b"1"})
+    with StatusIndex(str(tmp_path / "index.sqlite")) as index:
+        index.record("P/T/a", [extracted])
+        assert index.entry_stats() == {extracted: TreeStats(1, 1, os.stat(extracted).st_mtime)}
+        _tree(extracted, {"x/y/2.txt": b"2"})
+        _touch(os.path.join(extracted, "x", "y"), 1000)
+        assert index.entry_stats() == {}
+        assert index.rescan() == ["P/T/a"] # Counts changed : synchronized again
+        assert index.get("P/T/a") is None
+
+
+
+def test_probes_and_digests(
+    tmp_path,
+):
+    path = _tree(tmp_path, {"f.bin": b"payload"})
+    path = os.path.join(path, "f.bin")
+    with StatusIndex(str(tmp_path / "index.sqlite")) as index:
+        index.record_probes({"http://a": (10, True), "http://b": (-1, False)})
+        assert index.cached_probes(["http://a", "http://b"]) == {"http://a": (10, True)}
+        assert index.cached_probes(["http://a"], ttl=-1) == {}
+        index.record_verified(path, "sha256", "digest")
+        assert index.verified_digest(path, "sha256") == "digest"
+        assert index.verified_digest(path, "md5") is None
+        _touch(path, 1000)
+        assert index.verified_digest(path, "sha256") is None
+
+
+
+def test_fork_and_merge(
+    tmp_path,
+):
+    # A shard works on a fork : only what it wrote is folded back, so concurrent changes
+    # to the shared index (other shards) survive the merge
+    trees = {name: _tree(tmp_path / "scratch" / name, {"f": name.encode()}) for name in "abcde"}
+    shared_path, fork_path = str(tmp_path / "index.sqlite"), str(tmp_path / "index.sqlite.shard-1")
+    with StatusIndex(shared_path) as shared:
+        shared.record("a", [trees["a"]])
+        shared.record("b", [trees["b"]])
+        shared.record("c", [trees["c"]])
+        shared.record_probes({"http://old": (1, False)})
+        shared.fork(fork_path)
+
+        with StatusIndex(fork_path) as fork:
+            fork.record("d", [trees["d"]], stage="extracted") # Added
+            fork.forget("a") # Deleted
+            fork.record_probes({"http://new": (2, True)})
+            fork.record_verified(os.path.join(trees["d"], "f"), "sha256", "digest")
+            changes = fork.connection.execute("SELECT kind, key FROM changes ORDER BY kind, key").fetchall()
+        assert changes == [("datasets", "a"), ("datasets", "d"), ("probes", "http://new"), ("verified", os.path.join(trees["d"], "f"))]
+
+        shared.record("b", [trees["b"]], stage="extracted") # Another shard, after the fork
+        shared.record("e", [trees["e"]])
+        shared.merge(fork_path)
+        assert [row[0] for row in shared.datasets()] == ["b", "c", "d", "e"]
+        assert shared.get("b")["stage"] == "extracted" # The stale copy in the fork is ignored
+        assert shared.get("d")["stage"] == "extracted"
+        assert [row[0] for row in shared.entries("d")] == [trees["d"]]
+        assert shared.entry_stats().keys() == {trees[name] for name in "bcde"}
+        assert shared.cached_probes(["http://old", "http://new"]) == {"http://old": (1, False), "http://new": (2, True)}
+        assert shared.verified_digest(os.path.join(trees["d"], "f"), "sha256") == "digest"
+
+    # The shared index itself never logs changes
+    with sqlite3.connect(shared_path) as connection:
+        assert not connection.execute("SELECT name FROM sqlite_master WHERE name = 'changes'").fetchall()
+
+
+
+def test_rescan_tracked(
+    tmp_path,
+):
+    # Counts refreshed by a rescan on a fork are merged back too
+    tree = _tree(tmp_path / "a", {"f": b"1"})
+    shared_path, fork_path = str(tmp_path / "index.sqlite"), str(tmp_path / "fork.sqlite")
+    with StatusIndex(shared_path) as shared:
+        shared.record("a", [tree])
+        shared.fork(fork_path)
+        _touch(tree, 1000)
+        with StatusIndex(fork_path) as fork:
+            assert fork.rescan() == []
+        shared.merge(fork_path)
+        assert shared.entries("a")[0][3] == 1000
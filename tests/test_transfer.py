@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+
+# -----------------------
+# -------------------------------------------------
+# ------------------------------------------------------------------------------------------------
+# De profundiS : Tests of the segmented downloader
+# ------------------------------------------------------------------------------------------------
+# -------------------------------------------------
+# -----------------------
+
+
+
+# ---
+# Standard library imports
+# ---
+import os
+import hashlib
+
+
+
+# ---
+# Local imports
+# ---
+from transfer import TokenBucket
+from transfer import download_urls
+
+
+
+def _read(
+    path,
+):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+
+def test_download_segments(
+    catalog,
+    server,
+    tmp_path,
+):
+    name = catalog.add_synthetic("big.bin", 3 * 1024 * 1024 + 17)
+    destination = str(tmp_path / "out" / "big.bin")
+    errors = download_urls([(f"{server}/files/{name}", destination)], 4, TokenBucket(0), segment_size=1024 * 1024)
+    assert errors == {f"{server}/files/{name}": None}
+    assert _read(destination) == b"".join(catalog.read(name, 0, catalog.size(name) - 1))
+    assert not os.path.exists(destination + ".part")
+    assert not os.path.exists(destination + ".part.json")
+
+
+
+def test_download_duplicate_url(
+    catalog,
+    server,
+    tmp_path,
+):
+    # One URL listed with two destinations : fetched once, copied to the other, both verified
+    data = os.urandom(200 * 1024)
+    name = catalog.add_file("shared.bin", data)
+    url = f"{server}/files/{name}"
+    first, second = str(tmp_path / "a" / "shared.bin"), str(tmp_path / "b" / "shared.bin")
+    verified = []
+    errors = download_urls(
+        [(url, first), (url, second)],
+        4,
+        TokenBucket(0),
+        checksums={url: ("sha256", hashlib.sha256(data).hexdigest())},
+        on_verified=lambda url, destination, algorithm, digest: verified.append(destination),
+    )
+    assert errors == {url: None}
+    assert _read(first) == data and _read(second) == data
+    assert sorted(verified) == sorted([first, second])
+    assert not os.path.exists(second + ".part")
+
+
+
+def test_download_existing_kept(
+    catalog,
+    server,
+    tmp_path,
+):
+    # A destination without a .part is a finished download : left untouched
+    name = catalog.add_file("done.bin", b"new content")
+    destination = tmp_path / "done.bin"
+    destination.write_bytes(b"old")
+    errors = download_urls([(f"{server}/files/{name}", str(destination))], 2, TokenBucket(0))
+    assert errors == {f"{server}/files/{name}": None}
+    assert destination.read_bytes() == b"old"
+
+
+
+def test_download_errors(
+    catalog,
+    server,
+    tmp_path,
+):
+    name = catalog.add_file("bad.bin", b"payload")
+    missing, mismatched = f"{server}/files/missing.bin", f"{server}/files/{name}"
+    errors = download_urls(
+        [(missing, str(tmp_path / "missing.bin")), (mismatched, str(tmp_path / "bad.bin"))],
+        2,
+        TokenBucket(0),
+        checksums={mismatched: ("sha256", "0" * 64)},
+    )
+    assert errors[missing] is not None
+    assert errors[mismatched] is not None
+    assert not os.path.exists(tmp_path / "bad.bin")
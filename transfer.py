@@ -0,0 +1,570 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+
+# -----------------------
+# -------------------------------------------------
+# ------------------------------------------------------------------------------------------------
+# De profundiS : Parallel multi-connection download engine
+# ------------------------------------------------------------------------------------------------
+# -------------------------------------------------
+# -----------------------
+
+
+
+# ---
+# Standard library imports
+# ---
+import os
+import json
+import shutil
+import logging
+import threading
+import contextlib
+import concurrent.futures
+import urllib.parse
+from dataclasses import dataclass
+from dataclasses import field
+from time import monotonic
+from time import perf_counter
+from time import sleep
+
+
+
+# ---
+# Local imports
+# ---
+from http_client import get_session
+from http_client import open_url
+from http_client import backoff_delay
+from http_client import is_drive_url
+from http_client import drive_id
+from http_client import TIMEOUT
+from http_client import RETRY_STATUSES
+from integrity import StreamHasher
+from integrity import ChecksumMismatch
+
+
+
+log = logging.getLogger("rich")
+CHUNK_SIZE = 256 * 1024
+SEGMENT_SIZE = 64 * 1024 * 1024
+MAX_SEGMENTS = 8
+RETRIES = 5 # Attempts per segment for failures in the middle of a stream
+CHECKPOINT_SIZE = 8 * 1024 * 1024
+JOURNAL_INTERVAL = 5.0
+
+
+
+class TokenBucket:
+    # Global limiter shared by every worker : each chunk consumes its size in tokens,
+    # and the bucket refills at `rate` bytes per second. A rate <= 0 disables limiting.
+    def __init__(
+        self,
+        rate,
+        capacity=None,
+    ):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, CHUNK_SIZE)
+        self.tokens = self.capacity
+        self.timestamp = monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(
+        self,
+        n,
+    ):
+        # Takes `n` tokens and returns how long the caller must wait before using them
+        if self.rate <= 0:
+            return 0
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+            self.timestamp = now
+            # Tokens may go negative : the caller then sleeps off its own debt, outside the lock
+            self.tokens -= n
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+    def consume(
+        self,
+        n,
+    ):
+        wait = self.reserve(n)
+        if wait > 0:
+            sleep(wait)
+
+
+
+class TransferInterrupted(Exception):
+    pass
+
+
+
+# Set from the SIGUSR1 handler : workers stop at the next chunk and flush their journal
+STOP = threading.Event()
+
+def request_stop():
+    STOP.set()
+
+
+
+def merge_ranges(
+    ranges,
+):
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+
+@dataclass
+class Transfer:
+    url: str
+    destination: str
+    size: int = -1
+    accept_ranges: bool = False
+    segments: list = field(default_factory=list)
+    completed: list = field(default_factory=list) # Merged [start, end] byte ranges already on disk
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+    saved_at: float = 0.0
+    checksum: tuple = None # Expected (algorithm, digest), if the index provides one
+    hasher: StreamHasher = field(default=None, repr=False)
+
+    @property
+    def part_path(self):
+        return self.destination + ".part"
+
+    @property
+    def journal_path(self):
+        return self.destination + ".part.json"
+
+    @property
+    def resumable(self):
+        return self.size > 0 and self.accept_ranges
+
+    def load_journal(
+        self,
+    ):
+        if not (os.path.exists(self.journal_path) and os.path.exists(self.part_path)):
+            return
+        try:
+            with open(self.journal_path, "r") as f:
+                journal = json.load(f)
+        except (OSError, ValueError):
+            return
+        # A journal only applies to the exact same remote file
+        if journal.get("url") == self.url and journal.get("size") == self.size:
+            self.completed = merge_ranges(journal.get("completed", []))
+
+    def save_journal(
+        self,
+    ):
+        if not self.resumable:
+            return
+        with self.lock:
+            self.saved_at = monotonic()
+            tmp_path = self.journal_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"url": self.url, "size": self.size, "completed": self.completed}, f)
+            os.replace(tmp_path, self.journal_path)
+
+    def mark_done(
+        self,
+        start,
+        end,
+    ):
+        if end < start:
+            return
+        with self.lock:
+            self.completed = merge_ranges(self.completed + [[start, end]])
+            due = monotonic() - self.saved_at > JOURNAL_INTERVAL
+        if due:
+            self.save_journal()
+
+    def missing_ranges(
+        self,
+    ):
+        missing, position = [], 0
+        for start, end in self.completed:
+            if start > position:
+                missing.append([position, start - 1])
+            position = max(position, end + 1)
+        if position < self.size:
+            missing.append([position, self.size - 1])
+        return missing
+
+    def finalize(
+        self,
+    ):
+        if self.hasher is not None:
+            self.hasher.catch_up(self.part_path) # Bytes written out of order, or by a previous run
+            if self.hasher.hexdigest() != self.checksum[1]:
+                # Start over on the next run rather than resuming corrupted bytes
+                for path in (self.part_path, self.journal_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+                raise ChecksumMismatch(f"{self.url} : expected {self.checksum[1]}, got {self.hasher.hexdigest()}")
+        os.replace(self.part_path, self.destination)
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+
+
+
+@dataclass
+class Segment:
+    transfer: Transfer
+    start: int
+    end: int # Inclusive, -1 when the size of the file is unknown
+
+
+
+def url_basename(
+    url,
+):
+    if is_drive_url(url) and drive_id(url):
+        return drive_id(url)
+    path = urllib.parse.urlparse(url).path
+    return os.path.basename(path.rstrip("/")) or urllib.parse.quote(url, safe="")
+
+
+
+def _probe_range(
+    url,
+):
+    # Asks for the first byte : a 206 carries the total size in Content-Range, and proves
+    # that the server honours Range requests
+    with open_url(url, headers={"Range": "bytes=0-0"}) as response:
+        response.raise_for_status()
+        content_range = response.headers.get("Content-Range", "")
+        if response.status_code == 206 and "/" in content_range and not content_range.endswith("*"):
+            return int(content_range.rsplit("/", 1)[1]), True
+        return int(response.headers.get("Content-Length", -1)), False
+
+
+
+def probe_url(
+    url,
+):
+    # Returns (size or -1, whether Range requests are supported)
+    import requests # Deferred, see http_client.build_session
+    if is_drive_url(url):
+        return _probe_range(url) # Drive answers HEAD with its warning page
+
+    try:
+        response = get_session().head(url, allow_redirects=True, timeout=TIMEOUT)
+        response.raise_for_status()
+        size = int(response.headers.get("Content-Length", -1))
+        if size > 0:
+            return size, response.headers.get("Accept-Ranges", "").lower() == "bytes"
+    except requests.RequestException as e:
+        log.debug(f"HEAD failed for {url} ({e}), trying a Range request")
+    return _probe_range(url)
+
+
+
+def probe_urls(
+    urls,
+    workers,
+    on_probed=None,
+):
+    # Concurrent probes. Returns {url: (size or -1, accept_ranges)}, unreachable URLs included.
+    probes = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {pool.submit(probe_url, url): url for url in urls}
+        for future in concurrent.futures.as_completed(futures):
+            url = futures[future]
+            if future.exception() is not None:
+                log.debug(f"Could not probe {url} : {future.exception()}")
+                probes[url] = (-1, False)
+            else:
+                probes[url] = future.result()
+            if on_probed is not None:
+                on_probed(url, probes[url])
+    return probes
+
+
+
+def plan_transfer(
+    url,
+    destination,
+    segment_size=SEGMENT_SIZE,
+    max_segments=MAX_SEGMENTS,
+    checksum=None,
+    probe=None,
+):
+    import requests # Deferred, see http_client.build_session
+    transfer = Transfer(url, destination)
+    if os.path.exists(destination) and not os.path.exists(transfer.part_path):
+        return transfer # Already downloaded by a previous run
+    if checksum is not None:
+        transfer.checksum = checksum
+        transfer.hasher = StreamHasher(checksum[0])
+
+    try:
+        transfer.size, transfer.accept_ranges = probe if probe is not None else probe_url(url)
+    except requests.RequestException as e:
+        log.debug(f"Probe failed for {url} ({e}), falling back to a single stream")
+
+    if not transfer.resumable:
+        transfer.segments = [Segment(transfer, 0, transfer.size - 1 if transfer.size > 0 else -1)]
+        return transfer
+
+    transfer.load_journal()
+    missing = transfer.missing_ranges()
+    if not missing:
+        return transfer # Every byte landed before the previous run was interrupted : only finalize
+    total = sum(end - start + 1 for start, end in missing)
+    n_segments = max(1, min(max_segments, -(-total // segment_size)))
+    step = max(1, -(-total // n_segments))
+    for start, end in missing:
+        for s in range(start, end + 1, step):
+            transfer.segments.append(Segment(transfer, s, min(s + step, end + 1) - 1))
+    return transfer
+
+
+
+def prepare_destination(
+    transfer,
+):
+    os.makedirs(os.path.dirname(transfer.destination) or ".", exist_ok=True)
+    if transfer.completed and os.path.exists(transfer.part_path):
+        return # Resuming : keep the bytes already on disk
+    with open(transfer.part_path, "wb") as f:
+        if transfer.size > 0:
+            f.truncate(transfer.size)
+    transfer.save_journal()
+
+
+
+def fetch_segment(
+    segment,
+    limiter,
+    on_progress=None,
+    on_fetched=None,
+    controller=None,
+):
+    # `on_fetched(url, size, seconds, ttfb, retries)` is called once the segment is done or
+    # failed, with the time to first byte of the first attempt and the retries made by both
+    # urllib3 (before the body) and this loop (mid-stream). With a `controller`
+    # (concurrency.AdaptiveConcurrency), each attempt holds one connection slot of the host.
+    import requests # Deferred, see http_client.build_session
+    attempt, offset, started, timing = 0, segment.start, perf_counter(), {}
+    url = segment.transfer.url
+    try:
+        while True:
+            try:
+                with controller.slot(url) if controller is not None else contextlib.nullcontext():
+                    return _fetch_range(segment, limiter, on_progress, timing, controller)
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                # urllib3 only retries before the body starts : resume the rest of the range here
+                if controller is not None:
+                    controller.congestion(url)
+                attempt += 1
+                if not segment.transfer.resumable or attempt > RETRIES or STOP.is_set():
+                    raise
+                log.debug(f"Retrying {segment.transfer.url} from byte {segment.start} after {e}")
+                sleep(backoff_delay(attempt))
+            except requests.HTTPError as e:
+                # Still throttled after urllib3's retries : with the controller, which has
+                # just been told to back off, wait for fewer connections and try again
+                if controller is None or getattr(e.response, "status_code", None) not in RETRY_STATUSES:
+                    raise
+                controller.congestion(url)
+                attempt += 1
+                if attempt > RETRIES or STOP.is_set():
+                    raise
+                sleep(backoff_delay(attempt))
+    finally:
+        if on_fetched is not None:
+            on_fetched(segment.transfer.url, segment.start - offset, perf_counter() - started, timing.get("ttfb"), attempt + timing.get("retries", 0))
+
+
+
+def _fetch_range(
+    segment,
+    limiter,
+    on_progress=None,
+    timing=None,
+    controller=None,
+):
+    # Advances `segment.start` as bytes land on disk, so that a retry picks up from there
+    timing = {} if timing is None else timing
+    requested = perf_counter()
+    transfer = segment.transfer
+    headers = {}
+    ranged = transfer.resumable
+    if ranged:
+        headers["Range"] = f"bytes={segment.start}-{segment.end}"
+
+    with open_url(transfer.url, headers=headers) as response:
+        history = getattr(getattr(response.raw, "retries", None), "history", None) or ()
+        timing["retries"] = timing.get("retries", 0) + len(history)
+        if controller is not None and history:
+            controller.congestion(transfer.url, len(history)) # Throttled (429/5xx) or reset before the body
+        response.raise_for_status()
+        if ranged and response.status_code != 206:
+            raise IOError(f"Server ignored the Range request for {transfer.url}")
+
+        with open(transfer.part_path, "r+b") as f:
+            f.seek(segment.start)
+            checkpoint = segment.start
+            try:
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    if STOP.is_set():
+                        raise TransferInterrupted(transfer.url)
+                    if chunk: # filter out keep-alive new chunks
+                        timing.setdefault("ttfb", perf_counter() - requested)
+                        limiter.consume(len(chunk))
+                        f.write(chunk)
+                        if transfer.hasher is not None:
+                            transfer.hasher.feed(segment.start, chunk)
+                        segment.start += len(chunk)
+                        if controller is not None:
+                            controller.observe(transfer.url, len(chunk))
+                        if on_progress is not None:
+                            on_progress(len(chunk))
+                    if ranged and segment.start - checkpoint >= CHECKPOINT_SIZE:
+                        f.flush()
+                        transfer.mark_done(checkpoint, segment.start - 1)
+                        checkpoint = segment.start
+            finally:
+                # Whatever happens, the bytes written so far are recorded in the journal
+                if ranged:
+                    f.flush()
+                    transfer.mark_done(checkpoint, segment.start - 1)
+
+
+
+def copy_duplicates(
+    sources,
+    copies,
+    errors,
+    digests,
+    on_verified=None,
+):
+    # Copies each URL fetched once to `sources[url]` to its other destinations `copies[url]`,
+    # recording failures in `errors`. `digests` holds the (algorithm, digest) verified
+    # during this run, reported for the copies too.
+    for url, destinations in copies.items():
+        for destination in destinations:
+            if errors[url] is not None:
+                break
+            copy = Transfer(url, destination)
+            if os.path.exists(destination) and not os.path.exists(copy.part_path):
+                continue # Already in place from a previous run
+            try:
+                os.makedirs(os.path.dirname(destination) or ".", exist_ok=True)
+                shutil.copyfile(sources[url], copy.part_path)
+                os.replace(copy.part_path, destination)
+                if os.path.exists(copy.journal_path):
+                    os.remove(copy.journal_path) # Left by a run that fetched this destination itself
+            except OSError as e:
+                log.error(f"Failed to copy {url} to {destination} : {e}")
+                errors[url] = e
+                continue
+            if url in digests and on_verified is not None:
+                on_verified(url, destination, *digests[url])
+
+
+
+def download_urls(
+    jobs,
+    workers,
+    limiter,
+    segment_size=SEGMENT_SIZE,
+    max_segments=MAX_SEGMENTS,
+    on_planned=None,
+    on_progress=None,
+    checksums=None,
+    on_verified=None,
+    probes=None,
+    on_fetched=None,
+    controller=None,
+):
+    # `jobs` is a list of (url, destination) pairs. Returns {url: exception or None}.
+    # `probes` optionally maps URLs to a cached (size, accept_ranges), which skips the HEAD.
+    # `checksums` optionally maps URLs to an expected (algorithm, digest) : those files are
+    # hashed while they are written, and `on_verified(url, destination, algorithm, digest)`
+    # is called once their digest matched.
+    # Data is written to `<destination>.part`, with completed byte ranges journaled in
+    # `<destination>.part.json`, so that an interrupted run resumes where it stopped.
+    # A URL listed with several destinations is fetched once, then copied to the others.
+    errors, sources, copies, digests = {}, {}, {}, {}
+    for url, destination in jobs:
+        if sources.setdefault(url, destination) != destination:
+            copies.setdefault(url, []).append(destination)
+    jobs = list(sources.items())
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        # 1. Probe every URL concurrently to decide how each one is split
+        transfers = list(pool.map(
+            lambda job: plan_transfer(job[0], job[1], segment_size, max_segments, (checksums or {}).get(job[0]), (probes or {}).get(job[0])),
+            jobs,
+        ))
+        if on_planned is not None:
+            on_planned(sum(
+                segment.end - segment.start + 1
+                for t in transfers for segment in t.segments if segment.end >= 0
+            ))
+
+        # 2. Flatten all segments into a single queue, so that the pool is never idle
+        futures = {}
+        remaining = {}
+        segments = []
+        def finalize(
+            transfer,
+        ):
+            try:
+                transfer.finalize()
+            except (OSError, ChecksumMismatch) as e:
+                log.error(f"Failed to finalize {transfer.url} : {e}")
+                return e
+            if transfer.hasher is not None:
+                digests[transfer.url] = (transfer.checksum[0], transfer.hasher.hexdigest())
+                if on_verified is not None:
+                    on_verified(transfer.url, transfer.destination, *digests[transfer.url])
+            return None
+
+        for transfer in transfers:
+            errors[transfer.url] = None
+            if not transfer.segments:
+                if os.path.exists(transfer.part_path):
+                    errors[transfer.url] = finalize(transfer)
+                continue
+            try:
+                prepare_destination(transfer)
+            except OSError as e:
+                errors[transfer.url] = e
+                continue
+            remaining[transfer.url] = len(transfer.segments)
+            segments.extend(transfer.segments)
+
+        # Longest first : a big file started last would leave every other worker idle at the
+        # end. Segments of unknown size (end = -1) may be anything, so they start first too.
+        segments.sort(key=lambda segment: segment.start - segment.end if segment.end >= 0 else float("-inf"))
+        for segment in segments:
+            futures[pool.submit(fetch_segment, segment, limiter, on_progress, on_fetched, controller)] = segment.transfer
+
+        for future in concurrent.futures.as_completed(futures):
+            transfer = futures[future]
+            remaining[transfer.url] -= 1
+            exception = TransferInterrupted(transfer.url) if future.cancelled() else future.exception()
+            if exception is not None and errors[transfer.url] is None:
+                errors[transfer.url] = exception
+                if not isinstance(exception, TransferInterrupted):
+                    log.error(f"Failed to download {transfer.url} : {exception}")
+            if remaining[transfer.url] == 0:
+                if errors[transfer.url] is None:
+                    errors[transfer.url] = finalize(transfer)
+                else:
+                    transfer.save_journal()
+            if STOP.is_set():
+                for f in futures:
+                    f.cancel()
+
+    copy_duplicates(sources, copies, errors, digests, on_verified)
+    return errors
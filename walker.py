@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+
+# -----------------------
+# -------------------------------------------------
+# ------------------------------------------------------------------------------------------------
+# De profundiS : Parallel os.scandir walker
+# ------------------------------------------------------------------------------------------------
+# -------------------------------------------------
+# -----------------------
+
+
+
+# ---
+# Standard library imports
+# ---
+import os
+import concurrent.futures
+from dataclasses import dataclass
+
+
+
+WORKERS = 16
+
+
+
+@dataclass
+class TreeStats:
+    n_files: int = 0
+    size: int = 0
+    mtime: float = 0.0
+
+    def add(
+        self,
+        other,
+    ):
+        self.n_files += other.n_files
+        self.size += other.size
+        self.mtime = max(self.mtime, other.mtime)
+
+
+
+def _scan_dir(
+    root,
+    path,
+):
+    # One directory per task : on network filesystems the latency of each listing
+    # dominates, so many listings in flight hide it.
+    files, dirs = [], []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.path)
+                    else:
+                        files.append((entry.path, entry.stat(follow_symlinks=False)))
+                except OSError:
+                    continue
+    except OSError:
+        pass
+    return root, path, files, dirs
+
+
+
+def walk(
+    roots,
+    workers=WORKERS,
+    skip=(),
+):
+    # Yields (root, dirpath, files, dirs) for every directory below each root, in no
+    # particular order, with `files` a list of (path, stat_result) pairs. Roots that are
+    # plain files are yielded as a single-file listing. Paths in `skip` (files or whole
+    # subtrees, e.g. already known from a cache) are left out.
+    skip = set(skip)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        pending = set()
+        for root in roots:
+            if os.path.isdir(root) and not os.path.islink(root):
+                pending.add(pool.submit(_scan_dir, root, root))
+            elif os.path.lexists(root):
+                yield root, os.path.dirname(root), [(root, os.lstat(root))], []
+
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                root, path, files, dirs = future.result()
+                if skip:
+                    files = [f for f in files if f[0] not in skip]
+                    dirs = [d for d in dirs if d not in skip]
+                for d in dirs:
+                    pending.add(pool.submit(_scan_dir, root, d))
+                yield root, path, files, dirs
+
+
+
+def scan_trees(
+    roots,
+    workers=WORKERS,
+):
+    # Returns {root: TreeStats} aggregated over every file below each root
+    stats = {root: TreeStats() for root in roots}
+    for root, _, files, _ in walk(roots, workers):
+        for _, st in files:
+            stats[root].add(TreeStats(1, st.st_size, st.st_mtime))
+    return stats